@@ -5,8 +5,10 @@ __author__ = 'davidbyttow@google.com (David Byttow)'
 from waveapi import events
 from waveapi import model
 from waveapi import robot
+from google.appengine.api import memcache
 from google.appengine.ext import db 
 import cgi
+import datetime
 
 class Participant(db.Model):
   email_to_add = db.StringProperty(multiline=False)
@@ -20,24 +22,173 @@ def OnDocumentChanged(properties, context):
   """Invoked when document changes"""
   InviteAll(context)
 
-def InviteAll(context):	  
-  root_wavelet = context.GetRootWavelet()
-  participants = db.GqlQuery("SELECT * FROM Participant ORDER BY date DESC")
-  for participant in participants:
-    value = participant.email_to_add
-    if ((value != None) and (str(value).lower().endswith("@wavesandbox.com") or str(value).lower().endswith("gwave.com"))):
-      output = root_wavelet.AddParticipant(cgi.escape(str(value).lower()))
+# Maximum number of sign-ups processed, and so WAVELET_ADD_PARTICIPANT
+# operations emitted, per event.
+MAX_INVITES_PER_EVENT = 50
+
+# Number of sign-ups read per query while rebuilding a lost mark.
+REBUILD_BATCH_SIZE = 100
+
+# Mark of a wavelet that has not processed any sign-ups yet. A mark is the
+# date of the newest sign-up processed and the keys of the sign-ups with that
+# date that were processed, since several sign-ups can share a date.
+INITIAL_MARK = (datetime.datetime(1970, 1, 1), [])
+
+MARK_MEMCACHE_PREFIX = 'invite_mark:'
+
+class InviteMark(db.Model):
+  """Mark of the sign-ups processed for a single wavelet.
+
+  Keyed by MarkKeyName(wavelet) and mirrored in memcache as a (date, keys)
+  tuple.
+  """
+  date = db.DateTimeProperty()
+  keys = db.ListProperty(db.Key)
+
+def IsInvitable(email):
+  """Returns True if the address belongs to a domain the robot can invite."""
+  email = email.lower()
+  return email.endswith('@wavesandbox.com') or email.endswith('gwave.com')
+
+def ParticipantId(participant):
+  """Returns the wave participant id to invite or None if not invitable."""
+  value = participant.email_to_add
+  if value is None or not IsInvitable(value):
+    return None
+  return cgi.escape(value.lower())
+
+def MarkKeyName(wave_id, wavelet_id):
+  """Returns the InviteMark key name; wavelet ids are only unique per wave."""
+  return '%s/%s' % (wave_id, wavelet_id)
+
+def SignUpsAfter(mark, limit):
+  """Returns up to limit sign-ups that a mark has not processed, oldest first.
+
+  Sign-ups are read from the date of the mark on, skipping the ones the mark
+  lists, so that sign-ups sharing the date of the mark are not lost.
+  """
+  date, keys = mark
+  processed = set(keys)
+  batch = (Participant.all().filter('date >=', date).order('date')
+           .fetch(limit + len(processed)))
+  return [p for p in batch if p.key() not in processed][:limit]
+
+def AdvanceMark(mark, participants):
+  """Returns a mark moved past sign-ups returned by SignUpsAfter."""
+  if not participants:
+    return mark
+  date, keys = mark
+  newest = participants[-1].date
+  if newest != date:
+    date, keys = newest, []
+  keys = keys + [p.key() for p in participants if p.date == newest]
+  return date, keys
+
+def RebuildMark(on_wavelet):
+  """Rebuilds a lost mark from the wavelet's current participant set.
+
+  Walks sign-ups oldest first and stops at the first invitable one that is
+  not on the wavelet yet; everything before it has already been handled.
+  """
+  mark = INITIAL_MARK
+  while True:
+    batch = SignUpsAfter(mark, REBUILD_BATCH_SIZE)
+    for index, participant in enumerate(batch):
+      participant_id = ParticipantId(participant)
+      if participant_id is not None and participant_id not in on_wavelet:
+        return AdvanceMark(mark, batch[:index])
+    mark = AdvanceMark(mark, batch)
+    if len(batch) < REBUILD_BATCH_SIZE:
+      return mark
+
+def GetMark(wave_id, wavelet_id, on_wavelet):
+  """Returns the wavelet's mark from memcache, the datastore or a rebuild."""
+  key_name = MarkKeyName(wave_id, wavelet_id)
+  mark = memcache.get(MARK_MEMCACHE_PREFIX + key_name)
+  # Marks cached before they listed keys were bare dates; read them again.
+  if not isinstance(mark, tuple):
+    entity = InviteMark.get_by_key_name(key_name)
+    if entity is not None:
+      mark = (entity.date, entity.keys)
+    else:
+      mark = RebuildMark(on_wavelet)
+    memcache.set(MARK_MEMCACHE_PREFIX + key_name, mark)
+  return mark
+
+def InviteSignUps(context, wave_id, wavelet_id):
+  """Invites sign-ups newer than a wavelet's mark.
+
+  At most MAX_INVITES_PER_EVENT sign-ups are read per call, so the work
+  scales with new sign-ups rather than with all of them. Sign-ups that are
+  already on the wavelet are flagged without emitting an operation; that is
+  only known when the wavelet is part of the context. The added flags and
+  the advanced mark are deferred until the response has been sent, where
+  they are written with a single batched put before the memcache copy of
+  the mark is updated.
+
+  Returns:
+    True if every sign-up has been handled, False if more are left.
+  """
+  wavelet = context.GetWaveletById(wavelet_id)
+  if wavelet is not None and wavelet.GetWaveId() == wave_id:
+    on_wavelet = wavelet.GetParticipants()
+    add_participant = wavelet.AddParticipant
+  else:
+    on_wavelet = set()
+    add_participant = lambda participant_id: (
+        context.builder.WaveletAddParticipant(wave_id, wavelet_id,
+                                              participant_id))
+  mark = GetMark(wave_id, wavelet_id, on_wavelet)
+  new = SignUpsAfter(mark, MAX_INVITES_PER_EVENT)
+  if not new:
+    return True
+  updated = []
+  for participant in new:
+    participant_id = ParticipantId(participant)
+    if participant_id is None:
+      continue
+    if participant_id not in on_wavelet:
+      add_participant(participant_id)
+    if not participant.added:
       participant.added = True
-      participant.put
-	  
+      updated.append(participant)
+  mark = AdvanceMark(mark, new)
+  key_name = MarkKeyName(wave_id, wavelet_id)
+  updated.append(InviteMark(key_name=key_name, date=mark[0], keys=mark[1]))
+  context.DeferPut(updated)
+  context.Defer(memcache.set, MARK_MEMCACHE_PREFIX + key_name, mark)
+  return len(new) < MAX_INVITES_PER_EVENT
+
+def InviteQueued(context, item):
+  """Invites the next sign-ups for a wavelet queued by InviteAll."""
+  return InviteSignUps(context, item.wave_id, item.wavelet_id)
+
+# Wavelets with more sign-ups left than one event invites, drained by the
+# cron job a few wavelets per tick.
+INVITE_QUEUE = robot.CronWorkQueue('invites', InviteQueued, slice_size=5)
+
+def InviteAll(context):
+  """Invites new sign-ups to the root wavelet.
+
+  If there are more than one event should handle, the wavelet is queued
+  and the cron job invites the rest.
+  """
+  root_wavelet = context.GetRootWavelet()
+  if root_wavelet is None:
+    return
+  wave_id = root_wavelet.GetWaveId()
+  wavelet_id = root_wavelet.GetId()
+  if not InviteSignUps(context, wave_id, wavelet_id):
+    INVITE_QUEUE.Enqueue(wave_id, wavelet_id, context=context)
+
 def Announce(context):
   """Called when this robot is first added to the wave."""
   root_wavelet = context.GetRootWavelet()
   root_wavelet.CreateBlip().GetDocument().SetText("I'm alive!")
  
 def OnUpdate(context):
-  root_wavelet = context.GetRootWavelet()
-  root_wavelet.CreateBlip().GetDocument().SetText("I'm a crontask!")
+  """Invoked by the cron job; invites sign-ups to a few queued wavelets."""
+  INVITE_QUEUE.RunSlice(context)
   
 if __name__ == '__main__':
   dummy = robot.Robot('Invitation-bot',
@@ -46,6 +197,6 @@ if __name__ == '__main__':
   dummy.RegisterHandler(events.WAVELET_PARTICIPANTS_CHANGED,
                         OnParticipantsChanged)
   dummy.RegisterHandler(events.DOCUMENT_CHANGED,
-                        OnDocumentChanged)
-  dummy.RegisterCronJob("/_wave/robot/update", 10)						
+                        OnDocumentChanged, coalesce=True)
+  dummy.RegisterCronJob("/_wave/robot/update", 10, OnUpdate)						
   dummy.Run()
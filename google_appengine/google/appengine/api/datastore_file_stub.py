@@ -19,10 +19,13 @@
 In-memory persistent stub for the Python datastore API. Gets, queries,
 and searches are implemented as in-memory scans over all entities.
 
-Stores entities across sessions as pickled proto bufs in a single file. On
-startup, all entities are read from the file and loaded into memory. On
-every Put(), the file is wiped and all entities are written from scratch.
-Clients can also manually Read() and Write() the file themselves.
+Stores entities across sessions as pickled proto bufs in a single snapshot
+file, plus an append-only log of the puts and deletes made since the snapshot
+was written. On startup, the snapshot is read and the log is replayed on top
+of it. Every Put() and Delete() appends its entities or keys to the log, and
+once the log outgrows the datastore it is compacted: a new snapshot is
+written and the log is emptied. Clients can also manually Read() and Write()
+the files themselves.
 
 Transactions are serialized through __tx_lock. Each transaction acquires it
 when it begins and releases it when it commits or rolls back. This is
@@ -35,14 +38,18 @@ per-transaction, so they should only be used by one tx at a time.
 
 
 
+import bisect
 import datetime
+import heapq
 import logging
 import md5
+import operator
 import os
 import struct
 import sys
 import tempfile
 import threading
+import time
 import warnings
 
 import cPickle as pickle
@@ -76,9 +83,32 @@ _MAX_QUERY_OFFSET = 1000
 _MAX_QUERY_COMPONENTS = 100
 
 
+LOG_FILE_SUFFIX = '.log'
+
+
+_LOG_PUT = 'P'
+_LOG_DELETE = 'D'
+
+
+_LOG_HEADER_FORMAT = '>cI'
+_LOG_HEADER_SIZE = struct.calcsize(_LOG_HEADER_FORMAT)
+
+
+_FILTER_OPERATORS = {'<': operator.lt,
+                     '<=': operator.le,
+                     '>': operator.gt,
+                     '>=': operator.ge,
+                     '==': operator.eq,
+                     }
+
+
 class _StoredEntity(object):
   """Simple wrapper around an entity stored by the stub.
 
+  The protobuf is a copy owned by the stub and is never modified, so the
+  property values decoded from it can be cached. Responses get copies of it.
+  The native entity and the property values are decoded when first needed.
+
   Public properties:
     protobuf: Native protobuf Python object, entity_pb.EntityProto.
     encoded_protobuf: Encoded binary representation of above protobuf.
@@ -95,7 +125,187 @@ class _StoredEntity(object):
 
     self.encoded_protobuf = entity.Encode()
 
-    self.native = datastore.Entity._FromPb(entity)
+    self.__native = None
+
+    self.__values = None
+
+    self.__unindexed_properties = None
+
+  @property
+  def native(self):
+    if self.__native is None:
+      self.__native = datastore.Entity._FromPb(self.protobuf)
+    return self.__native
+
+  def __DecodeProperties(self):
+    """ Decodes the values of all the properties of the protobuf.
+    """
+    values = {}
+    for prop in self.protobuf.property_list():
+      values.setdefault(prop.name().decode('utf-8'), []).append(
+          datastore_types.FromPropertyPb(prop))
+    unindexed_properties = set()
+    for prop in self.protobuf.raw_property_list():
+      name = prop.name().decode('utf-8')
+      values.setdefault(name, []).append(datastore_types.FromPropertyPb(prop))
+      unindexed_properties.add(name)
+    self.__values = values
+    self.__unindexed_properties = unindexed_properties
+
+  def PropertyNames(self):
+    """ Returns the names of the properties of the entity.
+    """
+    if self.__values is None:
+      self.__DecodeProperties()
+    return self.__values.keys()
+
+  def IsIndexed(self, prop):
+    """ Returns True if the property is indexed, unless it is missing.
+    """
+    if self.__values is None:
+      self.__DecodeProperties()
+    return prop not in self.__unindexed_properties
+
+  def PropertyValues(self, prop):
+    """ Returns the list of values of a property of the entity.
+
+    Args:
+      prop: the property name, or a special property like __key__.
+
+    Returns:
+      A list of native values, empty if the entity does not have the property.
+    """
+    if self.__values is None:
+      self.__DecodeProperties()
+    if prop in self.__values:
+      return self.__values[prop]
+    if prop in datastore_types._SPECIAL_PROPERTIES:
+      assert prop == datastore_types._KEY_SPECIAL_PROPERTY
+      values = [datastore_types.Key._FromPb(self.protobuf.key())]
+      self.__values[prop] = values
+      return values
+    return []
+
+
+class _Highest(object):
+  """Compares greater than anything else, to bound index ranges."""
+
+  def __lt__(self, other):
+    return False
+
+  def __le__(self, other):
+    return self is other
+
+  def __gt__(self, other):
+    return self is not other
+
+  def __ge__(self, other):
+    return True
+
+  def __eq__(self, other):
+    return self is other
+
+  def __ne__(self, other):
+    return self is not other
+
+
+_HIGHEST = _Highest()
+
+
+class _Descending(object):
+  """Wraps a value to invert its order, for descending sort orders."""
+
+  __slots__ = ('value',)
+
+  def __init__(self, value):
+    self.value = value
+
+  def __lt__(self, other):
+    return other.value < self.value
+
+  def __le__(self, other):
+    return other.value <= self.value
+
+  def __gt__(self, other):
+    return other.value > self.value
+
+  def __ge__(self, other):
+    return other.value >= self.value
+
+  def __eq__(self, other):
+    return self.value == other.value
+
+  def __ne__(self, other):
+    return self.value != other.value
+
+
+class _SortedIndex(object):
+  """An index of stored entities, sorted by value.
+
+  Entries are (value, encoded key, _StoredEntity) tuples kept in a sorted list,
+  so that the entities whose value falls in a range are found by bisection.
+  An entity has one entry per distinct value it is indexed under.
+
+  Public properties:
+    entries: the sorted list of entries.
+  """
+
+  def __init__(self):
+    self.entries = []
+    self.__entries_by_key = {}
+
+  def Add(self, encoded_key, values, stored):
+    """Indexes a stored entity under the given values.
+
+    Args:
+      encoded_key: the encoded entity_pb.Reference of the entity.
+      values: list of index values.
+      stored: the _StoredEntity.
+    """
+    entries = []
+    for value in values:
+      entry = (value, encoded_key, stored)
+      if entry[:2] in [e[:2] for e in entries]:
+        continue
+      bisect.insort(self.entries, entry)
+      entries.append(entry)
+    if entries:
+      self.__entries_by_key[encoded_key] = entries
+
+  def Remove(self, encoded_key):
+    """Removes all the entries of an entity, if it is indexed."""
+    for entry in self.__entries_by_key.pop(encoded_key, ()):
+      position = bisect.bisect_left(self.entries, entry[:2])
+      del self.entries[position]
+
+  def Bounds(self, op, value):
+    """Returns the range of positions of the entries matching a comparison.
+
+    Args:
+      op: one of '==', '<', '<=', '>' and '>='.
+      value: the index value compared with.
+
+    Returns:
+      A (start, end) tuple such that entries[start:end] match.
+    """
+    start = 0
+    end = len(self.entries)
+    if op in ('==', '>='):
+      start = bisect.bisect_left(self.entries, (value,))
+    elif op == '>':
+      start = bisect.bisect_right(self.entries, (value, _HIGHEST))
+    if op in ('==', '<='):
+      end = bisect.bisect_right(self.entries, (value, _HIGHEST))
+    elif op == '<':
+      end = bisect.bisect_left(self.entries, (value,))
+    return start, end
+
+  def PrefixBounds(self, prefix):
+    """Returns the range of positions of the entries whose value tuple starts
+    with the given prefix tuple.
+    """
+    return (bisect.bisect_left(self.entries, (prefix,)),
+            bisect.bisect_right(self.entries, (prefix + (_HIGHEST,),)))
 
 
 class _Cursor(object):
@@ -129,8 +339,8 @@ class _Cursor(object):
     result.mutable_cursor().set_cursor(self.cursor)
     result.set_keys_only(self.keys_only)
 
-    results_pbs = [r._ToPb() for r in self.__results[:count]]
-    result.result_list().extend(results_pbs)
+    for entity in self.__results[:count]:
+      result.add_result().CopyFrom(entity)
     del self.__results[:count]
 
     result.set_more_results(len(self.__results) > 0)
@@ -179,13 +389,19 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     DELETED: frozenset((ERROR,)),
   }
 
+  LOG_SYNC_RECORDS = 100
+  LOG_SYNC_SECONDS = 1.0
+
+  LOG_COMPACT_MIN_RECORDS = 1000
+
   def __init__(self,
                app_id,
                datastore_file,
                history_file,
                require_indexes=False,
                service_name='datastore_v3',
-               trusted=False):
+               trusted=False,
+               use_log=True):
     """Constructor.
 
     Initializes and loads the datastore from the backing files, if they exist.
@@ -201,6 +417,9 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
       service_name: Service name expected for all calls.
       trusted: bool, default False.  If True, this stub allows an app to
         access the data of another app.
+      use_log: bool, default True.  If True, writes are appended to a log
+        next to datastore_file, named with LOG_FILE_SUFFIX.  If False, the
+        whole datastore file is rewritten on every write.
     """
     super(DatastoreFileStub, self).__init__(service_name)
 
@@ -211,12 +430,23 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     self.__history_file = history_file
     self.SetTrusted(trusted)
 
+    self.__log_file = None
+    if (use_log and datastore_file and datastore_file != '/dev/null'):
+      self.__log_file = datastore_file + LOG_FILE_SUFFIX
+    self.__log = None
+    self.__log_records = 0
+    self.__log_unsynced = 0
+    self.__log_synced_at = time.time()
+    self.__cleared = False
+
     self.__entities = {}
 
     self.__schema_cache = {}
 
     self.__tx_snapshot = {}
 
+    self.__tx_log_records = []
+
     self.__queries = {}
 
     self.__transactions = {}
@@ -224,6 +454,10 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     self.__indexes = {}
     self.__require_indexes = require_indexes
 
+    self.__property_indexes = {}
+
+    self.__composite_indexes = {}
+
     self.__query_history = {}
 
     self.__next_id = 1
@@ -241,12 +475,19 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
 
   def Clear(self):
     """ Clears the datastore by deleting all currently stored entities and
-    queries. """
+    queries.
+
+    The files are left alone, so Read() loads them again. The next write
+    replaces them with a snapshot, as when the whole file was written on
+    every change, so the cleared entities are not replayed from the log.
+    """
     self.__entities = {}
     self.__queries = {}
     self.__transactions = {}
     self.__query_history = {}
     self.__schema_cache = {}
+    self.__RebuildIndexes()
+    self.__cleared = True
 
   def SetTrusted(self, trusted):
     """Set/clear the trusted bit in the stub.
@@ -293,15 +534,271 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
 
     Args:
       entity: entity_pb.EntityProto
+
+    Returns:
+      The _StoredEntity.
     """
     key = entity.key()
     app_kind = self._AppKindForKey(key)
     if app_kind not in self.__entities:
       self.__entities[app_kind] = {}
-    self.__entities[app_kind][key] = _StoredEntity(entity)
+    stored = _StoredEntity(entity)
+    if key in self.__entities[app_kind]:
+      self.__UnindexEntity(app_kind, key)
+    self.__entities[app_kind][key] = stored
+    self.__IndexEntity(app_kind, key, stored)
 
     if app_kind in self.__schema_cache:
       del self.__schema_cache[app_kind]
+    return stored
+
+  def _RemoveEntity(self, key):
+    """ Remove the entity with the given key, if it is stored.
+
+    Args:
+      key: entity_pb.Reference
+
+    Returns:
+      True if an entity was removed.
+    """
+    app_kind = self._AppKindForKey(key)
+    if key not in self.__entities.get(app_kind, {}):
+      return False
+    self.__UnindexEntity(app_kind, key)
+    del self.__entities[app_kind][key]
+    if not self.__entities[app_kind]:
+      del self.__entities[app_kind]
+    if app_kind in self.__schema_cache:
+      del self.__schema_cache[app_kind]
+    return True
+
+  def __IndexValue(self, value):
+    """ Returns the value a property value is indexed and compared under.
+
+    Values are ordered by the tag of their type first, as in the real
+    datastore, and datetimes by their timestamp.
+
+    Args:
+      value: a native property value.
+
+    Returns:
+      A (type tag, value) tuple.
+    """
+    if isinstance(value, datetime.datetime):
+      value = datastore_types.DatetimeToTimestamp(value)
+    return (self._PROPERTY_TYPE_TAGS.get(value.__class__), value)
+
+  def __IndexedValues(self, stored, prop):
+    """ Returns the index values of an indexed property of an entity.
+
+    Args:
+      stored: _StoredEntity
+      prop: the property name.
+
+    Returns:
+      A list of index values, empty if the property is missing or unindexed.
+    """
+    if not stored.IsIndexed(prop):
+      return []
+    return [self.__IndexValue(value) for value in stored.PropertyValues(prop)
+            if not isinstance(value, datastore_types._RAW_PROPERTY_TYPES)]
+
+  def __IndexEntity(self, app_kind, key, stored):
+    """ Adds an entity to the property and composite indexes of its kind.
+    """
+    encoded_key = key.Encode()
+    for prop in stored.PropertyNames():
+      values = self.__IndexedValues(stored, prop)
+      if not values:
+        continue
+      index_key = app_kind + (prop,)
+      if index_key not in self.__property_indexes:
+        self.__property_indexes[index_key] = _SortedIndex()
+      self.__property_indexes[index_key].Add(encoded_key, values, stored)
+
+    for index_app_kind, props, index in self.__composite_indexes.values():
+      if index_app_kind != app_kind:
+        continue
+      tuples = [()]
+      for prop in props:
+        values = self.__IndexedValues(stored, prop)
+        tuples = [t + (value,) for t in tuples for value in values]
+      index.Add(encoded_key, tuples, stored)
+
+  def __UnindexEntity(self, app_kind, key):
+    """ Removes an entity from the property and composite indexes of its kind.
+    """
+    encoded_key = key.Encode()
+    stored = self.__entities[app_kind][key]
+    for prop in stored.PropertyNames():
+      index = self.__property_indexes.get(app_kind + (prop,))
+      if index is not None:
+        index.Remove(encoded_key)
+    for index_app_kind, props, index in self.__composite_indexes.values():
+      if index_app_kind == app_kind:
+        index.Remove(encoded_key)
+
+  def __AddCompositeIndex(self, index):
+    """ Builds the sorted index of a composite index definition.
+
+    Only indexes without an ancestor are built; queries with an ancestor are
+    answered from the property indexes.
+
+    Args:
+      index: entity_pb.CompositeIndex
+    """
+    definition = datastore_admin.ProtoToIndexDefinition(index)
+    kind, ancestor, props = datastore_index.IndexToKey(definition)
+    if ancestor:
+      return
+    app_kind = (index.app_id(), kind)
+    props = tuple([name.decode('utf-8') for name, direction in props])
+    self.__composite_indexes[index.id()] = (app_kind, props, _SortedIndex())
+    self.__RebuildIndexes()
+
+  def __RebuildIndexes(self):
+    """ Rebuilds all indexes from the entities in memory.
+    """
+    self.__property_indexes = {}
+    composite_indexes = self.__composite_indexes
+    self.__composite_indexes = {}
+    for index_id, (app_kind, props, index) in composite_indexes.items():
+      self.__composite_indexes[index_id] = (app_kind, props, _SortedIndex())
+    for app_kind, entities in self.__entities.items():
+      for key, stored in entities.items():
+        self.__IndexEntity(app_kind, key, stored)
+
+  def __QueryCandidates(self, query, filters):
+    """ Returns the stored entities a query has to consider.
+
+    Picks the narrowest index range that the filters allow, the way the real
+    datastore scans an index: a composite index on queried properties whose
+    leading properties are exactly the equality filters, else the most
+    selective equality filter on a property index, else the most selective
+    inequality filter. Filters on a multi-valued property may match
+    different values, so ranges are never intersected. The candidates are a
+    superset of the results; the filters and sort orders of the query are
+    still applied to them.
+
+    Args:
+      query: datastore_pb.Query
+      filters: list of (property name, operator, list of native values)
+          tuples, one for each filter of the query.
+
+    Returns:
+      A list of _StoredEntity.
+    """
+    app_kind = (query.app(), query.kind())
+    entities = self.__entities.get(app_kind)
+    if not entities:
+      return []
+
+    equalities = {}
+    inequalities = []
+    for prop, op, values in filters:
+      if len(values) != 1 or prop in datastore_types._SPECIAL_PROPERTIES:
+        continue
+      value = self.__IndexValue(values[0])
+      if value[0] is None:
+        continue
+      if op == '==':
+        equalities.setdefault(prop, value)
+      else:
+        inequalities.append((prop, op, value))
+
+    queried = set([prop for prop, op, values in filters])
+    queried.update([order.property().decode('utf-8')
+                    for order in query.order_list()])
+
+    ranges = []
+    for index_app_kind, props, index in self.__composite_indexes.values():
+      num_equalities = len(equalities)
+      if (index_app_kind == app_kind and num_equalities and
+          set(props[:num_equalities]) == set(equalities) and
+          queried.issuperset(props)):
+        prefix = tuple([equalities[prop] for prop in props[:num_equalities]])
+        ranges.append((index, index.PrefixBounds(prefix)))
+
+    if not ranges:
+      for prop, value in equalities.items():
+        index = self.__property_indexes.get(app_kind + (prop,))
+        if index is None:
+          return []
+        ranges.append((index, index.Bounds('==', value)))
+
+    if not ranges:
+      for prop, op, value in inequalities:
+        index = self.__property_indexes.get(app_kind + (prop,))
+        if index is None:
+          return []
+        ranges.append((index, index.Bounds(op, value)))
+
+    if not ranges:
+      return entities.values()
+
+    index, (start, end) = min(ranges, key=lambda r: r[1][1] - r[1][0])
+    candidates = []
+    seen = set()
+    for value, encoded_key, stored in index.entries[start:end]:
+      if encoded_key not in seen:
+        seen.add(encoded_key)
+        candidates.append(stored)
+    return candidates
+
+  def __KeyOrder(self, reference):
+    """ Returns a list that orders keys like datastore_types.Key.__cmp__ does.
+
+    Args:
+      reference: entity_pb.Reference
+
+    Returns:
+      A list of the app and the kinds and ids or names of the key's path.
+    """
+    order = [reference.app().decode('utf-8')]
+    for elem in reference.path().element_list():
+      order.append(repr(elem.type()))
+      if elem.has_name():
+        order.append(repr(elem.name().decode('utf-8')))
+      else:
+        order.append(elem.id())
+    return order
+
+  def __CompileFilter(self, prop, op, filter_values):
+    """ Returns a function that evaluates a query filter on an entity.
+
+    Values of the same type are compared with each other. Values of
+    different types are ordered by their type tags, and are never equal.
+
+    Args:
+      prop: the property name.
+      op: one of '==', '<', '<=', '>' and '>='.
+      filter_values: list of native values the property is compared with.
+
+    Returns:
+      A function that takes a _StoredEntity and returns True if one of its
+      values of the property passes the filter.
+    """
+    compare = _FILTER_OPERATORS[op]
+    type_tags = self._PROPERTY_TYPE_TAGS
+    typed_filter_values = [(type_tags.get(value.__class__), value)
+                           for value in filter_values]
+    is_equality = (op == '==')
+
+    def passes_filter(entity):
+      for entity_value in entity.PropertyValues(prop):
+        entity_type = type_tags.get(entity_value.__class__)
+        for filter_type, filter_value in typed_filter_values:
+          if entity_type == filter_type:
+            try:
+              if compare(entity_value, filter_value):
+                return True
+            except TypeError:
+              pass
+          elif not is_equality and compare(entity_type, filter_type):
+            return True
+      return False
+
+    return passes_filter
 
   READ_PB_EXCEPTIONS = (ProtocolBuffer.ProtocolBufferDecodeError, LookupError,
                         TypeError, ValueError)
@@ -328,7 +825,12 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     Also sets __next_id to one greater than the highest id allocated so far.
     """
     if self.__datastore_file and self.__datastore_file != '/dev/null':
-      for encoded_entity in self.__ReadPickled(self.__datastore_file):
+      if (self.__log_file and os.path.isfile(self.__log_file) and
+          not os.path.isfile(self.__datastore_file)):
+        encoded_entities = []
+      else:
+        encoded_entities = self.__ReadPickled(self.__datastore_file)
+      for encoded_entity in encoded_entities:
         try:
           entity = entity_pb.EntityProto(encoded_entity)
         except self.READ_PB_EXCEPTIONS, e:
@@ -349,6 +851,8 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
         if last_path.has_id() and last_path.id() >= self.__next_id:
           self.__next_id = last_path.id() + 1
 
+      self.__ReplayLog()
+
       self.__query_history = {}
       for encoded_query, count in self.__ReadPickled(self.__history_file):
         try:
@@ -365,13 +869,19 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
   def Write(self):
     """ Writes out the datastore and history files. Be careful! If the files
     already exist, this method overwrites them!
+
+    The datastore file is written as a new snapshot and the log is emptied.
     """
-    self.__WriteDatastore()
+    self.__CompactLog()
     self.__WriteHistory()
 
-  def __WriteDatastore(self):
+  def __WriteDatastore(self, sync=False):
     """ Writes out the datastore file. Be careful! If the file already exist,
     this method overwrites it!
+
+    Args:
+      sync: bool, default False.  If True, the file is forced to disk before
+          it replaces the old one.
     """
     if self.__datastore_file and self.__datastore_file != '/dev/null':
       encoded = []
@@ -379,7 +889,145 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
         for entity in kind_dict.values():
           encoded.append(entity.encoded_protobuf)
 
-      self.__WritePickled(encoded, self.__datastore_file)
+      if encoded:
+        self.__WritePickled(encoded, self.__datastore_file, sync=sync)
+      elif os.path.isfile(self.__datastore_file):
+        self.__file_lock.acquire()
+        try:
+          os.remove(self.__datastore_file)
+        finally:
+          self.__file_lock.release()
+
+  def __WriteChanges(self, records):
+    """ Persists puts and deletes that were applied in memory.
+
+    With a log, the changes are appended to it, unless the datastore was
+    cleared since the files were last written. Otherwise, the whole datastore
+    file is written out.
+
+    Args:
+      records: list of (_LOG_PUT, encoded entity_pb.EntityProto) and
+          (_LOG_DELETE, encoded entity_pb.Reference) tuples, in order.
+    """
+    if not self.__log_file or self.__cleared:
+      self.__CompactLog()
+      return
+    if not records:
+      return
+
+    self.__file_lock.acquire()
+    try:
+      if self.__log is None:
+        self.__log = open(self.__log_file, 'ab')
+      for op, encoded in records:
+        self.__log.write(struct.pack(_LOG_HEADER_FORMAT, op, len(encoded)))
+        self.__log.write(encoded)
+      self.__log.flush()
+      self.__log_records += len(records)
+      self.__log_unsynced += len(records)
+      if (self.__log_unsynced >= self.LOG_SYNC_RECORDS or
+          time.time() - self.__log_synced_at >= self.LOG_SYNC_SECONDS):
+        self.__SyncLog()
+    finally:
+      self.__file_lock.release()
+
+    num_entities = sum([len(kind_dict)
+                        for kind_dict in self.__entities.values()])
+    if self.__log_records > max(self.LOG_COMPACT_MIN_RECORDS, num_entities):
+      self.__CompactLog()
+
+  def __SyncLog(self):
+    """ Forces the appended log records to disk. Call with __file_lock held.
+    """
+    if self.__log is not None and self.__log_unsynced:
+      os.fsync(self.__log.fileno())
+    self.__log_unsynced = 0
+    self.__log_synced_at = time.time()
+
+  def __CompactLog(self):
+    """ Writes out a snapshot of the datastore and empties the log.
+
+    The log is only emptied once the snapshot is on disk and has replaced the
+    datastore file, so a crash in between at worst replays records the
+    snapshot already holds.
+    """
+    self.__WriteDatastore(sync=bool(self.__log_file))
+    self.__cleared = False
+    if not self.__log_file:
+      return
+
+    self.__file_lock.acquire()
+    try:
+      if self.__log is not None:
+        self.__log.close()
+        self.__log = None
+      if os.path.isfile(self.__log_file):
+        open(self.__log_file, 'wb').close()
+      self.__log_records = 0
+      self.__log_unsynced = 0
+      self.__log_synced_at = time.time()
+    finally:
+      self.__file_lock.release()
+
+  def __ReplayLog(self):
+    """ Applies the puts and deletes of the log to the entities in memory.
+
+    A truncated record at the end of the log, left by a crash in the middle of
+    an append, is ignored and cut off, so that new records follow the last
+    complete one.
+    """
+    if not self.__log_file or not os.path.isfile(self.__log_file):
+      return
+
+    self.__file_lock.acquire()
+    try:
+      log = open(self.__log_file, 'rb')
+      try:
+        data = log.read()
+      finally:
+        log.close()
+    finally:
+      self.__file_lock.release()
+
+    pos = 0
+    records = 0
+    while pos + _LOG_HEADER_SIZE <= len(data):
+      op, size = struct.unpack(_LOG_HEADER_FORMAT,
+                               data[pos:pos + _LOG_HEADER_SIZE])
+      start = pos + _LOG_HEADER_SIZE
+      if start + size > len(data):
+        break
+      encoded = data[start:start + size]
+      try:
+        if op == _LOG_PUT:
+          entity = entity_pb.EntityProto(encoded)
+          self._StoreEntity(entity)
+          last_path = entity.key().path().element_list()[-1]
+          if last_path.has_id() and last_path.id() >= self.__next_id:
+            self.__next_id = last_path.id() + 1
+        elif op == _LOG_DELETE:
+          self._RemoveEntity(entity_pb.Reference(encoded))
+        else:
+          raise ValueError('unknown log record %r' % op)
+      except self.READ_PB_EXCEPTIONS, e:
+        raise datastore_errors.InternalError(self.READ_ERROR_MSG %
+                                             (self.__log_file, e))
+      pos = start + size
+      records += 1
+
+    if pos != len(data):
+      logging.warning('Ignoring a truncated record at the end of %s',
+                      self.__log_file)
+      self.__file_lock.acquire()
+      try:
+        log = open(self.__log_file, 'r+b')
+        try:
+          log.truncate(pos)
+        finally:
+          log.close()
+      finally:
+        self.__file_lock.release()
+    self.__log_records = records
 
   def __WriteHistory(self):
     """ Writes out the history file. Be careful! If the file already exist,
@@ -412,8 +1060,11 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
 
     return []
 
-  def __WritePickled(self, obj, filename, openfile=file):
+  def __WritePickled(self, obj, filename, openfile=file, sync=False):
     """Pickles the object and writes it to the given file.
+
+    If sync is True, the file is forced to disk before it is renamed over the
+    old one.
     """
     if not filename or filename == '/dev/null' or not obj:
       return
@@ -424,6 +1075,9 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     pickler.fast = True
     pickler.dump(obj)
 
+    if sync:
+      tmpfile.flush()
+      os.fsync(tmpfile.fileno())
     tmpfile.close()
 
     self.__file_lock.acquire()
@@ -493,16 +1147,20 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
         assert (clone.has_entity_group() and
                 clone.entity_group().element_size() > 0)
 
+    records = []
     self.__entities_lock.acquire()
 
     try:
       for clone in clones:
-        self._StoreEntity(clone)
+        stored = self._StoreEntity(clone)
+        records.append((_LOG_PUT, stored.encoded_protobuf))
     finally:
       self.__entities_lock.release()
 
-    if not put_request.has_transaction():
-      self.__WriteDatastore()
+    if put_request.has_transaction():
+      self.__tx_log_records.extend(records)
+    else:
+      self.__WriteChanges(records)
 
     put_response.key_list().extend([c.key() for c in clones])
 
@@ -523,25 +1181,21 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
 
 
   def _Dynamic_Delete(self, delete_request, delete_response):
+    records = []
     self.__entities_lock.acquire()
     try:
       for key in delete_request.key_list():
         self.__ValidateAppId(key.app())
-        app_kind = self._AppKindForKey(key)
-        try:
-          del self.__entities[app_kind][key]
-          if not self.__entities[app_kind]:
-            del self.__entities[app_kind]
-
-          del self.__schema_cache[app_kind]
-        except KeyError:
-          pass
-
-        if not delete_request.has_transaction():
-          self.__WriteDatastore()
+        if self._RemoveEntity(key):
+          records.append((_LOG_DELETE, key.Encode()))
     finally:
       self.__entities_lock.release()
 
+    if delete_request.has_transaction():
+      self.__tx_log_records.extend(records)
+    else:
+      self.__WriteChanges(records)
+
 
   def _Dynamic_RunQuery(self, query, query_result):
     if not self.__tx_lock.acquire(False):
@@ -596,20 +1250,6 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
               "This query requires a composite index that is not defined. "
               "You must update the index.yaml file in your application root.")
 
-    try:
-      query.set_app(app)
-      results = self.__entities[app, query.kind()].values()
-      results = [entity.native for entity in results]
-    except KeyError:
-      results = []
-
-    if query.has_ancestor():
-      ancestor_path = query.ancestor().path().element_list()
-      def is_descendant(entity):
-        path = entity.key()._Key__reference.path().element_list()
-        return path[:len(ancestor_path)] == ancestor_path
-      results = filter(is_descendant, results)
-
     operators = {datastore_pb.Query_Filter.LESS_THAN:             '<',
                  datastore_pb.Query_Filter.LESS_THAN_OR_EQUAL:    '<=',
                  datastore_pb.Query_Filter.GREATER_THAN:          '>',
@@ -617,131 +1257,66 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
                  datastore_pb.Query_Filter.EQUAL:                 '==',
                  }
 
+    query.set_app(app)
+    filters = []
+    for filt in query.filter_list():
+      assert filt.op() != datastore_pb.Query_Filter.IN
+      filters.append((filt.property(0).name().decode('utf-8'),
+                      operators[filt.op()],
+                      [datastore_types.FromPropertyPb(filter_prop)
+                       for filter_prop in filt.property_list()]))
+    results = self.__QueryCandidates(query, filters)
+
+    if query.has_ancestor():
+      ancestor_path = query.ancestor().path().element_list()
+      def is_descendant(entity):
+        path = entity.protobuf.key().path().element_list()
+        return path[:len(ancestor_path)] == ancestor_path
+      results = filter(is_descendant, results)
+
     def has_prop_indexed(entity, prop):
       """Returns True if prop is in the entity and is indexed."""
       if prop in datastore_types._SPECIAL_PROPERTIES:
         return True
-      elif prop in entity.unindexed_properties():
+      elif not entity.IsIndexed(prop):
         return False
 
-      values = entity.get(prop, [])
-      if not isinstance(values, (tuple, list)):
-        values = [values]
-
-      for value in values:
+      for value in entity.PropertyValues(prop):
         if type(value) not in datastore_types._RAW_PROPERTY_TYPES:
           return True
       return False
 
-    for filt in query.filter_list():
-      assert filt.op() != datastore_pb.Query_Filter.IN
-
-      prop = filt.property(0).name().decode('utf-8')
-      op = operators[filt.op()]
-
-      filter_val_list = [datastore_types.FromPropertyPb(filter_prop)
-                         for filter_prop in filt.property_list()]
-
-      def passes_filter(entity):
-        """Returns True if the entity passes the filter, False otherwise.
-
-        The filter being evaluated is filt, the current filter that we're on
-        in the list of filters in the query.
-        """
-        if not has_prop_indexed(entity, prop):
-          return False
-
-        try:
-          entity_vals = datastore._GetPropertyValue(entity, prop)
-        except KeyError:
-          entity_vals = []
-
-        if not isinstance(entity_vals, list):
-          entity_vals = [entity_vals]
-
-        for fixed_entity_val in entity_vals:
-          for filter_val in filter_val_list:
-            fixed_entity_type = self._PROPERTY_TYPE_TAGS.get(
-              fixed_entity_val.__class__)
-            filter_type = self._PROPERTY_TYPE_TAGS.get(filter_val.__class__)
-            if fixed_entity_type == filter_type:
-              comp = u'%r %s %r' % (fixed_entity_val, op, filter_val)
-            elif op != '==':
-              comp = '%r %s %r' % (fixed_entity_type, op, filter_type)
-            else:
-              continue
-
-            logging.log(logging.DEBUG - 1,
-                        'Evaling filter expression "%s"', comp)
-
-            try:
-              ret = eval(comp)
-              if ret and ret != NotImplementedError:
-                return True
-            except TypeError:
-              pass
-
-        return False
-
-      results = filter(passes_filter, results)
+    for prop, op, filter_val_list in filters:
+      passes_filter = self.__CompileFilter(prop, op, filter_val_list)
+      results = [entity for entity in results
+                 if has_prop_indexed(entity, prop) and passes_filter(entity)]
 
     for order in query.order_list():
       prop = order.property().decode('utf-8')
       results = [entity for entity in results if has_prop_indexed(entity, prop)]
 
-    def order_compare_entities(a, b):
-      """ Return a negative, zero or positive number depending on whether
-      entity a is considered smaller than, equal to, or larger than b,
-      according to the query's orderings. """
-      cmped = 0
-      for o in query.order_list():
-        prop = o.property().decode('utf-8')
+    orders = [(order.property().decode('utf-8'),
+               order.direction() == datastore_pb.Query_Order.DESCENDING)
+              for order in query.order_list()]
 
-        reverse = (o.direction() is datastore_pb.Query_Order.DESCENDING)
+    def sort_key(entity):
+      """Returns the sort key of an entity, according to the query's orderings.
 
-        a_val = datastore._GetPropertyValue(a, prop)
-        if isinstance(a_val, list):
-          a_val = sorted(a_val, order_compare_properties, reverse=reverse)[0]
-
-        b_val = datastore._GetPropertyValue(b, prop)
-        if isinstance(b_val, list):
-          b_val = sorted(b_val, order_compare_properties, reverse=reverse)[0]
-
-        cmped = order_compare_properties(a_val, b_val)
-
-        if o.direction() is datastore_pb.Query_Order.DESCENDING:
-          cmped = -cmped
-
-        if cmped != 0:
-          return cmped
-
-      if cmped == 0:
-        return cmp(a.key(), b.key())
-
-    def order_compare_properties(x, y):
-      """Return a negative, zero or positive number depending on whether
-      property value x is considered smaller than, equal to, or larger than
-      property value y. If x and y are different types, they're compared based
-      on the type ordering used in the real datastore, which is based on the
-      tag numbers in the PropertyValue PB.
+      Property values are ordered by their index values, as in the real
+      datastore. A multi-valued property sorts by its smallest value in
+      ascending orders and by its largest value in descending orders. Ties are
+      broken by the entity key.
       """
-      if isinstance(x, datetime.datetime):
-        x = datastore_types.DatetimeToTimestamp(x)
-      if isinstance(y, datetime.datetime):
-        y = datastore_types.DatetimeToTimestamp(y)
-
-      x_type = self._PROPERTY_TYPE_TAGS.get(x.__class__)
-      y_type = self._PROPERTY_TYPE_TAGS.get(y.__class__)
-
-      if x_type == y_type:
-        try:
-          return cmp(x, y)
-        except TypeError:
-          return 0
-      else:
-        return cmp(x_type, y_type)
-
-    results.sort(order_compare_entities)
+      key = []
+      for prop, descending in orders:
+        values = [self.__IndexValue(value)
+                  for value in entity.PropertyValues(prop)]
+        if descending:
+          key.append(_Descending(max(values)))
+        else:
+          key.append(min(values))
+      key.append(self.__KeyOrder(entity.protobuf.key()))
+      return key
 
     offset = 0
     limit = len(results)
@@ -751,6 +1326,11 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
       limit = query.limit()
     if limit > _MAXIMUM_RESULTS:
       limit = _MAXIMUM_RESULTS
+
+    if offset + limit < len(results):
+      results = heapq.nsmallest(offset + limit, results, key=sort_key)
+    else:
+      results.sort(key=sort_key)
     results = results[offset:limit + offset]
 
     clone = datastore_pb.Query()
@@ -762,7 +1342,8 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
       self.__query_history[clone] = 1
     self.__WriteHistory()
 
-    cursor = _Cursor(results, query.keys_only())
+    cursor = _Cursor([entity.protobuf for entity in results],
+                     query.keys_only())
     self.__queries[cursor.cursor] = cursor
     cursor.PopulateQueryResult(query_result, 0)
 
@@ -798,6 +1379,7 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     snapshot = [(app_kind, dict(entities))
                 for app_kind, entities in self.__entities.items()]
     self.__tx_snapshot = dict(snapshot)
+    self.__tx_log_records = []
 
   def _Dynamic_Commit(self, transaction, transaction_response):
     if not self.__transactions.has_key(transaction.handle()):
@@ -806,8 +1388,10 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
         'Transaction handle %d not found' % transaction.handle())
 
     self.__tx_snapshot = {}
+    records = self.__tx_log_records
+    self.__tx_log_records = []
     try:
-      self.__WriteDatastore()
+      self.__WriteChanges(records)
     finally:
       self.__tx_lock.release()
 
@@ -819,6 +1403,8 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
 
     self.__entities = self.__tx_snapshot
     self.__tx_snapshot = {}
+    self.__tx_log_records = []
+    self.__RebuildIndexes()
     self.__tx_lock.release()
 
   def _Dynamic_GetSchema(self, app_str, schema):
@@ -911,6 +1497,7 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
       if app not in self.__indexes:
         self.__indexes[app] = []
       self.__indexes[app].append(clone)
+      self.__AddCompositeIndex(clone)
     finally:
       self.__indexes_lock.release()
 
@@ -950,6 +1537,8 @@ class DatastoreFileStub(apiproxy_stub.APIProxyStub):
     self.__indexes_lock.acquire()
     try:
       self.__indexes[app].remove(stored_index)
+      if stored_index.id() in self.__composite_indexes:
+        del self.__composite_indexes[stored_index.id()]
     finally:
       self.__indexes_lock.release()
 
@@ -3185,7 +3185,8 @@ def SetupStubs(app_id, **config):
   os.environ['APPLICATION_ID'] = app_id
 
   if clear_datastore:
-    for path in (datastore_path, history_path):
+    datastore_log_path = datastore_path + datastore_file_stub.LOG_FILE_SUFFIX
+    for path in (datastore_path, datastore_log_path, history_path):
       if os.path.lexists(path):
         logging.info('Attempting to remove file at %s', path)
         try:
@@ -0,0 +1,145 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc. All Rights Reserved.
+
+"""Helpers shared by the benchmark modules of this package."""
+
+
+import time
+
+import simplejson
+
+
+def _JavaList(values):
+  return {'javaClass': 'java.util.ArrayList', 'list': values}
+
+
+def _JavaMap(values):
+  return {'javaClass': 'java.util.HashMap', 'map': values}
+
+
+def MakeWireBundle(num_blips, num_annotations, num_events,
+                   event_type='DOCUMENT_CHANGED'):
+  """Generates an incoming robot bundle in the wire format.
+
+  Args:
+    num_blips: Number of blips in the bundle, each with a paragraph of text.
+    num_annotations: Number of annotations on each blip.
+    num_events: Number of events in the bundle.
+    event_type: Type of the generated events.
+
+  Returns:
+    A JSON string with the Java collection wrappers of the wave server.
+  """
+  wave_id = 'example.com!w+bench'
+  wavelet_id = 'example.com!conv+root'
+  blip_ids = ['b+%d' % i for i in range(num_blips)]
+  content = 'The quick brown fox jumps over the lazy dog. ' * 10
+  blips = {}
+  for i, blip_id in enumerate(blip_ids):
+    annotations = []
+    for j in range(num_annotations):
+      start = j % len(content)
+      annotations.append({
+          'javaClass': 'com.google.wave.api.Annotation',
+          'name': 'style/fontWeight',
+          'value': 'bold',
+          'range': {'javaClass': 'com.google.wave.api.Range',
+                    'start': start, 'end': start + 1},
+      })
+    blips[blip_id] = {
+        'javaClass': 'com.google.wave.api.impl.BlipData',
+        'annotations': _JavaList(annotations),
+        'blipId': blip_id,
+        'childBlipIds': _JavaList(blip_ids[i + 1:i + 2]),
+        'content': content,
+        'contributors': _JavaList(['author@example.com']),
+        'creator': 'author@example.com',
+        'elements': _JavaMap({}),
+        'lastModifiedTime': 1242079608457,
+        'parentBlipId': i and blip_ids[i - 1] or None,
+        'version': 3,
+        'waveId': wave_id,
+        'waveletId': wavelet_id,
+    }
+  events = []
+  for i in range(num_events):
+    events.append({
+        'javaClass': 'com.google.wave.api.impl.EventData',
+        'type': event_type,
+        'timestamp': 1242079611003 + i,
+        'modifiedBy': 'author@example.com',
+        'properties': _JavaMap({'blipId': blip_ids and blip_ids[0] or None}),
+    })
+  wavelet = {
+      'javaClass': 'com.google.wave.api.impl.WaveletData',
+      'creationTime': 1242079608457,
+      'creator': 'author@example.com',
+      'dataDocuments': None,
+      'lastModifiedTime': 1242079611003,
+      'participants': _JavaList(['author@example.com', 'robot@appspot.com']),
+      'rootBlipId': blip_ids and blip_ids[0] or None,
+      'title': 'Benchmark',
+      'version': 5,
+      'waveId': wave_id,
+      'waveletId': wavelet_id,
+  }
+  return simplejson.dumps({
+      'blips': _JavaMap(blips),
+      'events': _JavaList(events),
+      'wavelet': wavelet,
+  })
+
+
+def Time(function, repeat=3):
+  """Returns the best wall time of several calls to a function.
+
+  Args:
+    function: A function taking no arguments.
+    repeat: Number of times to call the function.
+
+  Returns:
+    The fastest call in seconds.
+  """
+  best = None
+  for _ in range(repeat):
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best
+
+
+def Percentile(samples, fraction):
+  """Returns the sample below which a fraction of the samples fall.
+
+  Args:
+    samples: A non-empty list of numbers.
+    fraction: Fraction between 0 and 1, e.g. 0.99 for the 99th percentile.
+  """
+  ordered = sorted(samples)
+  index = int(round(fraction * (len(ordered) - 1)))
+  return ordered[index]
+
+
+def ReportLatencies(name, samples):
+  """Prints the throughput and p50/p99 latencies of timed calls.
+
+  Args:
+    name: Name of the benchmark.
+    samples: The wall time of every call in seconds.
+  """
+  total = sum(samples)
+  throughput = total and len(samples) / total or 0.0
+  print '%-40s %10.1f /s  p50 %8.3f ms  p99 %8.3f ms' % (
+      name, throughput, Percentile(samples, 0.5) * 1000,
+      Percentile(samples, 0.99) * 1000)
+
+
+def Report(name, seconds, baseline=None):
+  """Prints a single benchmark result, optionally relative to a baseline."""
+  line = '%-40s %10.2f ms' % (name, seconds * 1000)
+  if baseline:
+    line += '  %5.2fx' % (baseline / seconds)
+  print line
@@ -0,0 +1,152 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc. All Rights Reserved.
+
+"""Measures query filters in the datastore stub of the SDK.
+
+Runs a range query through DatastoreFileStub with its compiled filters, and
+with filters that format every comparison and eval() it, the way the stub
+used to. The stub comes from the App Engine SDK vendored next to this package.
+"""
+
+
+import logging
+import os
+import sys
+
+SDK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir, 'google_appengine')
+sys.path.extend([SDK_PATH,
+                 os.path.join(SDK_PATH, 'lib', 'webob'),
+                 os.path.join(SDK_PATH, 'lib', 'yaml', 'lib')])
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore
+from google.appengine.api import datastore_file_stub
+
+import benchmark
+
+APP_ID = 'benchmark'
+NUM_ENTITIES = 100000
+NUM_MATCHES = 90000
+PUT_BATCH_SIZE = 5000
+
+
+def EvalFilter(stub, prop, op, filter_values):
+  """Returns a query filter that evaluates every comparison with eval().
+
+  This is how DatastoreFileStub used to evaluate filters, and it takes the
+  same arguments as the filter compiler of the stub.
+  """
+  type_tags = stub._PROPERTY_TYPE_TAGS
+
+  def PassesFilter(entity):
+    for entity_value in entity.PropertyValues(prop):
+      for filter_value in filter_values:
+        entity_type = type_tags.get(entity_value.__class__)
+        filter_type = type_tags.get(filter_value.__class__)
+        if entity_type == filter_type:
+          comparison = u'%r %s %r' % (entity_value, op, filter_value)
+        elif op != '==':
+          comparison = '%r %s %r' % (entity_type, op, filter_type)
+        else:
+          continue
+        logging.log(logging.DEBUG - 1, 'Evaling filter expression "%s"',
+                    comparison)
+        try:
+          result = eval(comparison)
+          if result and result != NotImplementedError:
+            return True
+        except TypeError:
+          pass
+    return False
+
+  return PassesFilter
+
+
+def CompiledFilter(stub, prop, op, filter_values):
+  """Returns a query filter compiled by the stub."""
+  return stub._DatastoreFileStub__CompileFilter(prop, op, filter_values)
+
+
+def EvalFilters(stub, function):
+  """Returns a function calling another with the eval() filters in a stub."""
+  def Call():
+    stub._DatastoreFileStub__CompileFilter = (
+        lambda *args: EvalFilter(stub, *args))
+    try:
+      return function()
+    finally:
+      del stub._DatastoreFileStub__CompileFilter
+  return Call
+
+
+def CreateStub():
+  """Returns an empty in-memory datastore stub and registers it."""
+  os.environ['APPLICATION_ID'] = APP_ID
+  apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+  stub = datastore_file_stub.DatastoreFileStub(APP_ID, None, None)
+  apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+  return stub
+
+
+def PutEntities():
+  """Puts NUM_ENTITIES entities with an increasing 'n' property.
+
+  Returns:
+    The list of entities that were put.
+  """
+  entities = []
+  for i in range(NUM_ENTITIES):
+    entity = datastore.Entity('Item')
+    entity['n'] = i
+    entity['group'] = i % 100
+    entity['name'] = u'item %d' % (i % 7)
+    entities.append(entity)
+  for start in range(0, NUM_ENTITIES, PUT_BATCH_SIZE):
+    datastore.Put(entities[start:start + PUT_BATCH_SIZE])
+  return entities
+
+
+def RunBenchmarks():
+  """Runs the datastore benchmarks and prints the results."""
+  stub = CreateStub()
+  entities = PutEntities()
+
+  # The query runs both filters on the entities its index finds for the
+  # narrower upper bound, which is every entity that matches.
+  filters = [('n', '>=', [0]), ('n', '<', [NUM_MATCHES])]
+  candidates = [datastore_file_stub._StoredEntity(entity._ToPb())
+                for entity in entities[:NUM_MATCHES]]
+
+  def Filter(make_filter):
+    def Call():
+      results = candidates
+      for prop, op, filter_values in filters:
+        passes_filter = make_filter(stub, prop, op, filter_values)
+        results = [entity for entity in results if passes_filter(entity)]
+      return len(results)
+    return Call
+
+  # The first calls also decode the property values of the candidates.
+  assert Filter(EvalFilter)() == Filter(CompiledFilter)() == NUM_MATCHES
+  name = '%d filter checks' % (len(filters) * NUM_MATCHES)
+  baseline = benchmark.Time(Filter(EvalFilter))
+  benchmark.Report('%s, eval' % name, baseline)
+  benchmark.Report('%s, compiled' % name,
+                   benchmark.Time(Filter(CompiledFilter)), baseline)
+
+  def Query():
+    query = datastore.Query('Item', {'n >=': 0, 'n <': NUM_MATCHES})
+    return query.Count(NUM_ENTITIES)
+
+  # The stub caps counts, but only after filtering every candidate.
+  assert Query() == EvalFilters(stub, Query)()
+  name = 'query, %d of %d entities' % (NUM_MATCHES, NUM_ENTITIES)
+  baseline = benchmark.Time(EvalFilters(stub, Query))
+  benchmark.Report('%s, eval' % name, baseline)
+  benchmark.Report('%s, compiled' % name, benchmark.Time(Query), baseline)
+
+
+if __name__ == '__main__':
+  RunBenchmarks()
@@ -0,0 +1,517 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc. All Rights Reserved.
+
+"""Unit tests for the datastore stub of the App Engine SDK.
+
+The robot keeps its state in the datastore, and the stub from the SDK
+vendored next to this package is what it runs against locally and in tests.
+"""
+
+
+import datetime
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+SDK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir, 'google_appengine')
+sys.path.extend([SDK_PATH,
+                 os.path.join(SDK_PATH, 'lib', 'webob'),
+                 os.path.join(SDK_PATH, 'lib', 'yaml', 'lib')])
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore
+from google.appengine.api import datastore_admin
+from google.appengine.api import datastore_file_stub
+from google.appengine.api import datastore_types
+from google.appengine.api import users
+from google.appengine.datastore import datastore_index
+from google.appengine.datastore import datastore_pb
+from google.appengine.ext import db
+
+APP_ID = 'test-stub'
+
+# Values of a property that has a different type on every entity.
+MIXED_VALUES = [
+    None, True, False, -3, 0, 7, 2 ** 40, -1.5, 2.5, u'', u'a', u'b',
+    u'caf\xe9', datetime.datetime(1999, 12, 31), datetime.datetime(2009, 1, 1),
+    datastore_types.GeoPt(1, 2), datastore_types.GeoPt(-1, 5),
+    datastore_types.Key.from_path('Other', 1, _app=APP_ID),
+    datastore_types.Key.from_path('Other', u'b', _app=APP_ID),
+    users.User('a@example.com', _auth_domain='example.com'),
+    datastore_types.Text(u'unindexed'),
+]
+
+# Values of a multi-valued property.
+LIST_VALUES = [1, 3, 5, 8, u'e', u'm', u'x']
+
+OLD_OPERATORS = {'=': '==', '<': '<', '<=': '<=', '>': '>', '>=': '>='}
+
+
+class Note(db.Model):
+  text = db.StringProperty()
+
+
+def OldHasPropIndexed(entity, prop):
+  """Returns True if prop is in the entity and is indexed."""
+  if prop in datastore_types._SPECIAL_PROPERTIES:
+    return True
+  elif prop in entity.unindexed_properties():
+    return False
+  values = entity.get(prop, [])
+  if not isinstance(values, (tuple, list)):
+    values = [values]
+  for value in values:
+    if type(value) not in datastore_types._RAW_PROPERTY_TYPES:
+      return True
+  return False
+
+
+def OldPassesFilter(entity, prop, op, filter_value):
+  """Evaluates a filter on an entity with eval(), as the stub used to."""
+  type_tags = datastore_file_stub.DatastoreFileStub._PROPERTY_TYPE_TAGS
+  if not OldHasPropIndexed(entity, prop):
+    return False
+  try:
+    entity_values = datastore._GetPropertyValue(entity, prop)
+  except KeyError:
+    entity_values = []
+  if not isinstance(entity_values, list):
+    entity_values = [entity_values]
+  for entity_value in entity_values:
+    entity_type = type_tags.get(entity_value.__class__)
+    filter_type = type_tags.get(filter_value.__class__)
+    if entity_type == filter_type:
+      comparison = u'%r %s %r' % (entity_value, op, filter_value)
+    elif op != '==':
+      comparison = '%r %s %r' % (entity_type, op, filter_type)
+    else:
+      continue
+    try:
+      result = eval(comparison)
+      if result and result != NotImplementedError:
+        return True
+    except TypeError:
+      pass
+  return False
+
+
+def OldCompareValues(x, y):
+  """Compares property values with cmp(), as the stub used to."""
+  type_tags = datastore_file_stub.DatastoreFileStub._PROPERTY_TYPE_TAGS
+  if isinstance(x, datetime.datetime):
+    x = datastore_types.DatetimeToTimestamp(x)
+  if isinstance(y, datetime.datetime):
+    y = datastore_types.DatetimeToTimestamp(y)
+  x_type = type_tags.get(x.__class__)
+  y_type = type_tags.get(y.__class__)
+  if x_type == y_type:
+    try:
+      return cmp(x, y)
+    except TypeError:
+      return 0
+  return cmp(x_type, y_type)
+
+
+def OldQuery(entities, filters, orders=(), limit=None, offset=0):
+  """Runs a query the way the stub did before it had indexes.
+
+  Every entity is checked against every filter with eval(), and the results
+  are sorted with cmp().
+
+  Args:
+    entities: list of datastore.Entity of the queried kind.
+    filters: list of (property, operator, value) tuples.
+    orders: list of (property, direction) tuples.
+    limit: optional maximum number of results.
+    offset: number of results to skip.
+
+  Returns:
+    The list of the keys of the results.
+  """
+  results = list(entities)
+  for prop, op, value in filters:
+    results = [entity for entity in results
+               if OldPassesFilter(entity, prop, OLD_OPERATORS[op], value)]
+  for prop, direction in orders:
+    results = [entity for entity in results if OldHasPropIndexed(entity, prop)]
+
+  def CompareEntities(a, b):
+    for prop, direction in orders:
+      reverse = direction == datastore.Query.DESCENDING
+      a_value = datastore._GetPropertyValue(a, prop)
+      if isinstance(a_value, list):
+        a_value = sorted(a_value, OldCompareValues, reverse=reverse)[0]
+      b_value = datastore._GetPropertyValue(b, prop)
+      if isinstance(b_value, list):
+        b_value = sorted(b_value, OldCompareValues, reverse=reverse)[0]
+      compared = OldCompareValues(a_value, b_value)
+      if reverse:
+        compared = -compared
+      if compared:
+        return compared
+    return cmp(a.key(), b.key())
+
+  results.sort(CompareEntities)
+  if limit is None:
+    limit = len(results)
+  return [entity.key() for entity in results[offset:limit + offset]]
+
+
+class WarningCollector(logging.Handler):
+  """Collects the messages of the warnings that are logged."""
+
+  def __init__(self):
+    logging.Handler.__init__(self, logging.WARNING)
+    self.messages = []
+
+  def emit(self, record):
+    self.messages.append(record.getMessage())
+
+
+class TestLog(unittest.TestCase):
+  """Tests persisting writes through the log next to the datastore file."""
+
+  def setUp(self):
+    os.environ['APPLICATION_ID'] = APP_ID
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'datastore')
+    self.log_path = self.path + datastore_file_stub.LOG_FILE_SUFFIX
+    self.warnings = WarningCollector()
+    logging.getLogger().addHandler(self.warnings)
+
+  def tearDown(self):
+    logging.getLogger().removeHandler(self.warnings)
+    shutil.rmtree(self.directory)
+
+  def Start(self, use_log=True):
+    """Starts a stub on the datastore file, as when the server restarts."""
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    stub = datastore_file_stub.DatastoreFileStub(APP_ID, self.path, None,
+                                                 use_log=use_log)
+    apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', stub)
+    return stub
+
+  def Put(self, name, text=''):
+    Note(key_name=name, text=text).put()
+
+  def Notes(self):
+    return sorted([(note.key().name(), note.text) for note in Note.all()])
+
+  def testReplay(self):
+    self.Start()
+    for name in 'abc':
+      self.Put(name)
+    self.Put('a', 'changed')
+    db.delete(db.Key.from_path('Note', 'b'))
+    self.assertFalse(os.path.exists(self.path))
+    self.assertTrue(os.path.getsize(self.log_path))
+
+    del self.warnings.messages[:]
+    self.Start()
+    self.assertEqual([('a', 'changed'), ('c', '')], self.Notes())
+    # Until the first compaction, only the log exists.
+    self.assertFalse([message for message in self.warnings.messages
+                      if self.path in message])
+
+  def testTruncatedRecord(self):
+    self.Start()
+    self.Put('a')
+    self.Put('b')
+    size = os.path.getsize(self.log_path)
+    log = open(self.log_path, 'r+b')
+    log.truncate(size - 3)
+    log.close()
+
+    self.Start()
+    self.assertEqual([('a', '')], self.Notes())
+    self.assertTrue(os.path.getsize(self.log_path) < size - 3)
+    self.Put('c')
+    self.Start()
+    self.assertEqual([('a', ''), ('c', '')], self.Notes())
+
+  def testRollbackNotLogged(self):
+    self.Start()
+    self.Put('a')
+    size = os.path.getsize(self.log_path)
+
+    def PutAndFail():
+      self.Put('b')
+      raise ValueError('rolled back')
+    self.assertRaises(ValueError, db.run_in_transaction, PutAndFail)
+    self.assertEqual(size, os.path.getsize(self.log_path))
+    self.assertEqual([('a', '')], self.Notes())
+
+    db.run_in_transaction(self.Put, 'c')
+    self.assertTrue(os.path.getsize(self.log_path) > size)
+    self.Start()
+    self.assertEqual([('a', ''), ('c', '')], self.Notes())
+
+  def testCompaction(self):
+    stub = self.Start()
+    stub.LOG_COMPACT_MIN_RECORDS = 5
+    for i in range(5):
+      self.Put('a', str(i))
+    self.assertFalse(os.path.exists(self.path))
+    self.assertTrue(os.path.getsize(self.log_path))
+
+    # The log is compacted once it holds more records than both the minimum
+    # and the number of entities.
+    self.Put('a', 'compacted')
+    self.assertTrue(os.path.exists(self.path))
+    self.assertEqual(0, os.path.getsize(self.log_path))
+    self.Put('b')
+    self.Start()
+    self.assertEqual([('a', 'compacted'), ('b', '')], self.Notes())
+
+  def CheckClear(self, use_log):
+    stub = self.Start(use_log)
+    self.Put('a')
+    self.Put('b')
+    stub.Clear()
+    self.assertEqual([], self.Notes())
+    stub.Read()
+    self.assertEqual([('a', ''), ('b', '')], self.Notes())
+
+    # The first write after a clear replaces the files.
+    stub.Clear()
+    self.Put('c')
+    self.Start(use_log)
+    self.assertEqual([('c', '')], self.Notes())
+
+  def testClear(self):
+    self.CheckClear(True)
+
+  def testClearWithoutLog(self):
+    self.CheckClear(False)
+
+
+class QueryTestCase(unittest.TestCase):
+  """Compares the results of queries with the old implementation."""
+
+  def setUp(self):
+    os.environ['APPLICATION_ID'] = APP_ID
+    os.environ['AUTH_DOMAIN'] = 'example.com'
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    self.stub = datastore_file_stub.DatastoreFileStub(APP_ID, None, None)
+    apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', self.stub)
+    self.parent = datastore.Entity('Parent')
+    datastore.Put(self.parent)
+    rand = random.Random(0)
+    entities = []
+    for i in range(3 * len(MIXED_VALUES)):
+      entity = datastore.Entity('Item', parent=self.parent.key())
+      entity['g'] = i % 3
+      entity['v'] = MIXED_VALUES[i % len(MIXED_VALUES)]
+      if i % 4:
+        entity['tags'] = rand.sample(LIST_VALUES, i % 4)
+      entities.append(entity)
+    self.keys = datastore.Put(entities)
+
+  def Entities(self):
+    return [entity for entity in datastore.Get(self.keys) if entity]
+
+  def Query(self, filters, orders=(), limit=None, offset=0):
+    """Returns the keys of the results of a query through the stub."""
+    query = datastore.Query('Item', dict([('%s %s' % (prop, op), value)
+                                          for prop, op, value in filters]))
+    query.Order(*orders)
+    return [entity.key()
+            for entity in query.Get(limit or 1000, offset)]
+
+  def assertSameResults(self, filters, orders=(), limit=None, offset=0):
+    expected = OldQuery(self.Entities(), filters, orders, limit, offset)
+    self.assertEqual(expected, self.Query(filters, orders, limit, offset),
+                     (filters, orders, limit, offset))
+
+
+class TestQueryIndexes(QueryTestCase):
+
+  def testMultiValuedInequality(self):
+    for op in ('<', '<=', '>', '>=', '='):
+      for value in (0, 3, 5, 9, u'a', u'm', u'z'):
+        self.assertSameResults([('tags', op, value)])
+        self.assertSameResults([('tags', op, value)],
+                               [('tags', datastore.Query.DESCENDING)])
+    self.assertSameResults([('tags', '>', 2), ('tags', '<', 6)],
+                           [('tags', datastore.Query.ASCENDING)])
+    self.assertSameResults([('tags', '>=', u'e'), ('g', '=', 1)],
+                           [('tags', datastore.Query.DESCENDING)])
+
+  def testCompositeIndex(self):
+    queries = [
+        ([('g', '=', 1), ('v', '>', 0)], [('v', datastore.Query.ASCENDING)]),
+        ([('g', '=', 2)], [('v', datastore.Query.DESCENDING)]),
+        ([('g', '=', 0), ('tags', '=', 5)], []),
+        ([('g', '=', 0)], [('tags', datastore.Query.ASCENDING)]),
+    ]
+    before = [self.Query(filters, orders) for filters, orders in queries]
+
+    definition = datastore_index.Index(
+        kind='Item', properties=[datastore_index.Property(name='g'),
+                                 datastore_index.Property(name='v')])
+    datastore_admin.CreateIndex(
+        datastore_admin.IndexDefinitionToProto(APP_ID, definition))
+    prefixes = []
+    prefix_bounds = datastore_file_stub._SortedIndex.PrefixBounds
+
+    def RecordPrefixBounds(index, prefix):
+      prefixes.append(prefix)
+      return prefix_bounds(index, prefix)
+    datastore_file_stub._SortedIndex.PrefixBounds = RecordPrefixBounds
+    try:
+      for (filters, orders), results in zip(queries, before):
+        del prefixes[:]
+        self.assertEqual(results, self.Query(filters, orders))
+        self.assertSameResults(filters, orders)
+        # Only queries on exactly the properties of the index scan it.
+        props = set([f[0] for f in filters] + [o[0] for o in orders])
+        self.assertEqual(props == set(['g', 'v']), bool(prefixes), props)
+    finally:
+      datastore_file_stub._SortedIndex.PrefixBounds = prefix_bounds
+
+    # Entities put and deleted later are indexed as well.
+    datastore.Delete(self.keys[:5])
+    entity = datastore.Entity('Item')
+    entity['g'] = 1
+    entity['v'] = 5
+    self.keys.append(datastore.Put(entity))
+    for filters, orders in queries:
+      self.assertSameResults(filters, orders)
+
+  def testIndexesAfterRollback(self):
+    def ChangeAndFail():
+      entities = datastore.Get(self.keys[:6])
+      for entity in entities[:3]:
+        entity['v'] = 1000
+        entity['tags'] = [1000]
+      datastore.Put(entities[:3])
+      datastore.Delete(self.keys[3:6])
+      entity = datastore.Entity('Item', parent=self.parent.key())
+      entity['v'] = 1000
+      datastore.Put(entity)
+      raise ValueError('rolled back')
+
+    self.assertRaises(ValueError, datastore.RunInTransaction, ChangeAndFail)
+    self.assertEqual([], self.Query([('v', '=', 1000)]))
+    self.assertEqual([], self.Query([('tags', '=', 1000)]))
+    self.assertSameResults([('v', '>=', 0)],
+                           [('v', datastore.Query.ASCENDING)])
+    self.assertSameResults([('tags', '<', 4)])
+    self.assertEqual(len(self.keys), len(self.Query([])))
+
+
+class TestQueryFilters(QueryTestCase):
+
+  def testMixedTypes(self):
+    for value in MIXED_VALUES:
+      if isinstance(value, datastore_types._RAW_PROPERTY_TYPES):
+        continue
+      for op in ('<', '<=', '>', '>=', '='):
+        self.assertSameResults([('v', op, value)])
+        self.assertSameResults([('tags', op, value)])
+
+  def testSeveralFilters(self):
+    self.assertSameResults([('v', '>', -2), ('v', '<', u'b')])
+    self.assertSameResults([('v', '>=', None), ('v', '<=', 2.5),
+                            ('g', '=', 2)])
+    self.assertSameResults([('g', '=', 1), ('tags', '<', u'm')],
+                           [('tags', datastore.Query.ASCENDING),
+                            ('v', datastore.Query.DESCENDING)])
+
+
+class TestQuerySorting(QueryTestCase):
+
+  DIRECTIONS = (datastore.Query.ASCENDING, datastore.Query.DESCENDING)
+
+  def testMixedTypes(self):
+    for direction in self.DIRECTIONS:
+      self.assertSameResults([], [('v', direction)])
+      self.assertSameResults([('v', '>', 0)], [('v', direction)])
+      self.assertSameResults([('g', '=', 1)], [('v', direction)])
+
+  def testMultiValued(self):
+    for direction in self.DIRECTIONS:
+      self.assertSameResults([], [('tags', direction)])
+      self.assertSameResults([('tags', '>=', 3)], [('tags', direction)])
+      self.assertSameResults([('tags', '<', u'm')], [('tags', direction)])
+      self.assertSameResults([('tags', '>', 1), ('tags', '<=', u'e')],
+                             [('tags', direction)])
+
+  def testSeveralOrders(self):
+    for first in self.DIRECTIONS:
+      for second in self.DIRECTIONS:
+        self.assertSameResults([], [('g', first), ('v', second)])
+        self.assertSameResults([], [('g', first), ('tags', second)])
+        self.assertSameResults([('tags', '>', 1)],
+                               [('tags', first), ('g', second)])
+
+  def testLimitAndOffset(self):
+    for direction in self.DIRECTIONS:
+      for limit in (1, 5, 20):
+        for offset in (0, 3, 50):
+          self.assertSameResults([], [('v', direction)], limit, offset)
+          self.assertSameResults([('tags', '>=', 3)],
+                                 [('tags', direction), ('v', direction)],
+                                 limit, offset)
+
+
+class TestCopies(QueryTestCase):
+  """Tests that callers cannot change the entities stored by the stub."""
+
+  def Call(self, call, request, response):
+    apiproxy_stub_map.MakeSyncCall('datastore_v3', call, request, response)
+    return response
+
+  def Change(self, entity):
+    for prop in entity.property_list():
+      prop.mutable_value().Clear()
+      prop.mutable_value().set_int64value(1000)
+
+  def testPutRequestChanged(self):
+    entity = datastore.Entity('Item', parent=self.parent.key())
+    entity['v'] = 5
+    request = datastore_pb.PutRequest()
+    request.add_entity().CopyFrom(entity._ToPb())
+    response = self.Call('Put', request, datastore_pb.PutResponse())
+    key = datastore_types.Key._FromPb(response.key(0))
+    self.keys.append(key)
+
+    self.Change(request.mutable_entity(0))
+    self.assertEqual(5, datastore.Get(key)['v'])
+    self.assertEqual([], self.Query([('v', '=', 1000)]))
+    self.assertSameResults([('v', '=', 5)])
+
+  def testGetResponseChanged(self):
+    request = datastore_pb.GetRequest()
+    request.add_key().CopyFrom(self.keys[3]._ToPb())
+    response = self.Call('Get', request, datastore_pb.GetResponse())
+    encoded = response.entity(0).entity().Encode()
+
+    self.Change(response.mutable_entity(0).mutable_entity())
+    response = self.Call('Get', request, datastore_pb.GetResponse())
+    self.assertEqual(encoded, response.entity(0).entity().Encode())
+    self.assertEqual([], self.Query([('v', '=', 1000)]))
+
+  def testQueryResultChanged(self):
+    query = datastore.Query('Item', {'g =': 1})._ToPb()
+    result = self.Call('RunQuery', query, datastore_pb.QueryResult())
+    request = datastore_pb.NextRequest()
+    request.mutable_cursor().CopyFrom(result.cursor())
+    request.set_count(5)
+    result = self.Call('Next', request, datastore_pb.QueryResult())
+    self.assertEqual(5, result.result_size())
+
+    for entity in result.result_list():
+      self.Change(entity)
+    self.assertEqual([], self.Query([('v', '=', 1000)]))
+    self.assertSameResults([('g', '=', 1)])
+
+
+if __name__ == '__main__':
+  unittest.main()
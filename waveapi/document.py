@@ -10,6 +10,8 @@ their operations.
 
 __author__ = 'davidbyttow@google.com (David Byttow)'
 
+import bisect
+
 import util
 
 
@@ -22,6 +24,8 @@ class Range(object):
 
   java_class = 'com.google.wave.api.Range'
 
+  __slots__ = ('start', 'end')
+
   def __init__(self, start=0, end=1):
     """Initializes the range with a start and end position.
 
@@ -55,6 +59,8 @@ class Annotation(object):
 
   java_class = 'com.google.wave.api.Annotation'
 
+  __slots__ = ('name', 'value', 'range')
+
   def __init__(self, name, value, r=None):
     """Initializes this annotation with a name and value pair and a range.
 
@@ -68,6 +74,378 @@ class Annotation(object):
     self.range = r or Range()
 
 
+class TextBuffer(object):
+  """Mutable text of a document, kept as a list of bounded chunks.
+
+  Edits only rebuild the chunk they touch instead of the whole text, and the
+  start offset of every chunk is cached so that positions are found with a
+  binary search. The offsets after an edited chunk are recomputed lazily on
+  the next lookup, and the joined text is cached until the next edit.
+
+  Positions past the end of the text are clamped to it, as with slicing.
+  """
+
+  CHUNK_SIZE = 8192
+
+  __slots__ = ('_chunks', '_length', '_starts', '_text', '_valid')
+
+  def __init__(self, text=''):
+    """Initializes the buffer with some text.
+
+    Args:
+      text: The initial text content.
+    """
+    size = self.CHUNK_SIZE
+    self._chunks = [text[i:i + size] for i in xrange(0, len(text), size)]
+    self._length = len(text)
+    self._starts = []
+    self._text = text
+    self._valid = 0
+
+  def __len__(self):
+    return self._length
+
+  def __str__(self):
+    return self.GetText()
+
+  def GetText(self):
+    """Returns the text content of this buffer."""
+    if self._text is None:
+      self._text = ''.join(self._chunks)
+    return self._text
+
+  def Insert(self, index, text):
+    """Inserts text at a given position.
+
+    Args:
+      index: Position to insert the text at.
+      text: The text to insert.
+
+    Raises:
+      IndexError: If the position is negative.
+    """
+    if index < 0:
+      raise IndexError('Position cannot be less than 0')
+    if not text:
+      return
+    index = min(index, self._length)
+    chunks = self._chunks
+    self._length += len(text)
+    if len(chunks) == 1:
+      # Short texts are a single chunk and are edited in place.
+      chunk = chunks[0][:index] + text + chunks[0][index:]
+      chunks[0] = chunk
+      self._text = None
+      if len(chunk) > 2 * self.CHUNK_SIZE:
+        self._Changed(0)
+      return
+    if chunks:
+      i = self._Locate(index)
+      offset = index - self._starts[i]
+      chunks[i] = chunks[i][:offset] + text + chunks[i][offset:]
+    else:
+      i = 0
+      chunks.append(text)
+    self._Changed(i)
+
+  def Append(self, text):
+    """Appends text to the end of this buffer."""
+    self.Insert(self._length, text)
+
+  def Delete(self, start, end):
+    """Deletes the text within [start, end).
+
+    Args:
+      start: Start position of the text to delete.
+      end: End position of the text to delete.
+
+    Raises:
+      IndexError: If the range is invalid.
+    """
+    if start < 0 or end < start:
+      raise IndexError('Invalid range (%d, %d)' % (start, end))
+    end = min(end, self._length)
+    if start >= end:
+      return
+    chunks = self._chunks
+    self._length -= end - start
+    if len(chunks) == 1:
+      chunk = chunks[0][:start] + chunks[0][end:]
+      if chunk:
+        chunks[0] = chunk
+      else:
+        del chunks[0]
+      self._text = None
+      return
+    starts = self._starts
+    i = self._Locate(start)
+    j = self._Locate(end)
+    merged = chunks[i][:start - starts[i]] + chunks[j][end - starts[j]:]
+    following = j + 1 < len(chunks) and chunks[j + 1] or ''
+    if following and len(merged) + len(following) <= self.CHUNK_SIZE:
+      # Fold small leftovers into the next chunk to avoid fragmentation.
+      merged += following
+      j += 1
+    if merged:
+      chunks[i:j + 1] = [merged]
+    else:
+      del chunks[i:j + 1]
+    self._Changed(i)
+
+  def _Changed(self, i):
+    """Splits an oversized chunk and invalidates the offsets after it."""
+    chunks = self._chunks
+    self._text = None
+    if self._valid > i + 1:
+      self._valid = i + 1
+    if i < len(chunks) and len(chunks[i]) > 2 * self.CHUNK_SIZE:
+      size = self.CHUNK_SIZE
+      chunk = chunks[i]
+      chunks[i:i + 1] = [chunk[k:k + size] for k in xrange(0, len(chunk), size)]
+
+  def _Locate(self, index):
+    """Returns the index of the chunk containing a position.
+
+    A position at the boundary of two chunks maps to the later one, and the
+    end of the text maps to the last chunk.
+    """
+    chunks = self._chunks
+    starts = self._starts
+    if self._valid < len(chunks) or len(starts) > len(chunks):
+      del starts[self._valid:]
+      offset = 0
+      if starts:
+        offset = starts[-1] + len(chunks[len(starts) - 1])
+      for k in xrange(len(starts), len(chunks)):
+        starts.append(offset)
+        offset += len(chunks[k])
+      self._valid = len(chunks)
+    return max(bisect.bisect_right(starts, index) - 1, 0)
+
+
+class AnnotationIndex(object):
+  """Index over the annotations of a document.
+
+  Keeps the annotation list of a blip along with a hash of the annotations
+  by name and a copy of the list sorted by start position. Overlap queries
+  use an interval tree laid out over the sorted list, where every node holds
+  the largest end position below it. The tree is rebuilt lazily by the first
+  query after a change.
+
+  Inserting or deleting text keeps the order by start position, so edits
+  only touch the annotations at or after the edit and the few that span it.
+  Ranges are updated in place, so the index owns the Range instances of its
+  annotations.
+  """
+
+  __slots__ = ('_annotations', '_by_name', '_by_start', '_max_ends',
+               '_max_length')
+
+  def __init__(self, annotations):
+    """Initializes the index.
+
+    Args:
+      annotations: List of Annotation instances that the index maintains.
+    """
+    self._annotations = annotations
+    self._by_name = {}
+    self._by_start = []
+    self._max_ends = None
+    self._max_length = 0
+    by_start = [(annotation.range.start, i, annotation)
+                for i, annotation in enumerate(annotations)]
+    by_start.sort()
+    for _, _, annotation in by_start:
+      self._Index(annotation)
+      self._by_start.append(annotation)
+
+  def __len__(self):
+    return len(self._annotations)
+
+  def IsIndexing(self, annotations):
+    """Returns whether this index is up to date with a list of annotations."""
+    return (annotations is self._annotations and
+            len(annotations) == len(self._by_start))
+
+  def Add(self, annotation):
+    """Adds an annotation to the document and the index."""
+    self._annotations.append(annotation)
+    self._Index(annotation)
+    self._by_start.insert(self._Bisect(annotation.range.start + 1),
+                          annotation)
+    self._max_ends = None
+
+  def HasAnnotation(self, name):
+    """Returns whether any annotation has the given name."""
+    return name in self._by_name
+
+  def GetAnnotationsByName(self, name):
+    """Returns the list of annotations with the given name."""
+    return list(self._by_name.get(name, ()))
+
+  def GetAnnotationsInRange(self, r, name=None):
+    """Returns the annotations overlapping a range, ordered by start.
+
+    A collapsed range finds the annotations that contain its position.
+
+    Args:
+      r: The Range to look up.
+      name: Optionally, only return annotations with this name.
+
+    Returns:
+      A list of Annotation instances.
+    """
+    start = r.start
+    end = max(r.end, r.start + 1)
+    by_start = self._by_start
+    max_ends = self._BuildTree()
+    found = []
+    stack = [(0, len(by_start))]
+    while stack:
+      lo, hi = stack.pop()
+      if lo >= hi:
+        continue
+      mid = (lo + hi) / 2
+      if max_ends[mid] <= start:
+        # Nothing below this node ends after the start of the range.
+        continue
+      annotation = by_start[mid]
+      if annotation.range.start < end:
+        if annotation.range.end > start:
+          found.append((mid, annotation))
+        stack.append((mid + 1, hi))
+      stack.append((lo, mid))
+    found.sort()
+    return [annotation for _, annotation in found
+            if name is None or annotation.name == name]
+
+  def RemoveByName(self, name):
+    """Removes all annotations with the given name."""
+    if self._by_name.pop(name, None):
+      self._Remove(lambda annotation: annotation.name == name)
+
+  def RemoveInRange(self, r, name):
+    """Removes an annotation from a range, splitting the ones it covers.
+
+    Args:
+      r: The Range to clear.
+      name: Name of the annotation to clear.
+    """
+    overlapping = self.GetAnnotationsInRange(r, name)
+    if not overlapping:
+      return
+    clipped = set(map(id, overlapping))
+    self._Remove(lambda annotation: id(annotation) in clipped)
+    for annotation in overlapping:
+      for piece in util.ClipRange(annotation.range, r):
+        self.Add(Annotation(annotation.name, annotation.value, piece))
+
+  def Shift(self, position, length):
+    """Moves the annotations to account for inserted text.
+
+    Ranges that start at or after the position move along with the text, and
+    ranges that span it grow to cover the inserted text.
+
+    Args:
+      position: Position the text was inserted at.
+      length: Length of the inserted text.
+    """
+    by_start = self._by_start
+    i = self._Bisect(position)
+    for annotation in by_start[self._Bisect(position - self._max_length):i]:
+      r = annotation.range
+      if r.end > position:
+        r.end += length
+        self._max_length = max(self._max_length, r.end - r.start)
+    for annotation in by_start[i:]:
+      r = annotation.range
+      r.start += length
+      r.end += length
+    self._max_ends = None
+
+  def Clip(self, start, end):
+    """Moves the annotations to account for deleted text.
+
+    Ranges lose the deleted part of their text, and annotations left without
+    any text are removed.
+
+    Args:
+      start: Start position of the deleted text.
+      end: End position of the deleted text.
+    """
+    length = end - start
+    emptied = []
+    for annotation in self._by_start[self._Bisect(start - self._max_length):]:
+      r = annotation.range
+      if r.end <= start:
+        continue
+      collapsed = r.start == r.end
+      if r.start >= end:
+        r.start -= length
+      elif r.start > start:
+        r.start = start
+      if r.end >= end:
+        r.end -= length
+      else:
+        r.end = start
+      if r.start == r.end and not collapsed:
+        emptied.append(annotation)
+    if emptied:
+      emptied = set(map(id, emptied))
+      self._Remove(lambda annotation: id(annotation) in emptied)
+    self._max_ends = None
+
+  def _Index(self, annotation):
+    """Adds an annotation to the name hash."""
+    r = annotation.range
+    self._by_name.setdefault(annotation.name, []).append(annotation)
+    self._max_length = max(self._max_length, r.end - r.start)
+
+  def _Remove(self, predicate):
+    """Removes all annotations matching a predicate."""
+    self._annotations[:] = [annotation for annotation in self._annotations
+                            if not predicate(annotation)]
+    self._by_start = [annotation for annotation in self._by_start
+                      if not predicate(annotation)]
+    self._by_name = {}
+    for annotation in self._annotations:
+      self._by_name.setdefault(annotation.name, []).append(annotation)
+    self._max_ends = None
+
+  def _Bisect(self, position):
+    """Returns the index of the first annotation starting at a position."""
+    by_start = self._by_start
+    lo = 0
+    hi = len(by_start)
+    while lo < hi:
+      mid = (lo + hi) / 2
+      if by_start[mid].range.start < position:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def _BuildTree(self):
+    """Returns the largest end position below every node of the tree."""
+    if self._max_ends is not None:
+      return self._max_ends
+    by_start = self._by_start
+    max_ends = [0] * len(by_start)
+
+    def Build(lo, hi):
+      if lo >= hi:
+        return -1
+      mid = (lo + hi) / 2
+      max_end = max(by_start[mid].range.end, Build(lo, mid),
+                    Build(mid + 1, hi))
+      max_ends[mid] = max_end
+      return max_end
+
+    Build(0, len(by_start))
+    self._max_ends = max_ends
+    return max_ends
+
+
 class StringEnum(object):
   """Enum like class that is configured with a list of values.
 
@@ -111,12 +489,7 @@ class Element(object):
     """
     props = {}
     data = {}
-    for attr in dir(self):
-      if attr.startswith('_'):
-        continue
-      val = getattr(self, attr)
-      if val is None or callable(val):
-        continue
+    for attr, val in util.GetPublicAttributes(self):
       val = util.Serialize(val)
       if attr == 'type' or attr == 'java_class':
         data[attr] = val
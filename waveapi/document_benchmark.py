@@ -0,0 +1,164 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc. All Rights Reserved.
+
+"""Measures editing a large blip through the op-based document.
+
+Applies a fixed script of random inserts and deletes to a 100 KB blip and
+compares it with rebuilding the content string on every edit, which is what
+the document did before it was backed by a TextBuffer. Also compares
+annotation lookups through the AnnotationIndex with scanning the list.
+"""
+
+
+import random
+
+import benchmark
+import document
+import model
+import ops
+
+DOCUMENT_SIZE = 100 * 1024
+NUM_EDITS = 10000
+NUM_ANNOTATIONS = 100
+NUM_QUERIES = 10000
+
+
+def MakeEdits(size, count, seed=0):
+  """Generates a script of edits that keeps the document around its size.
+
+  Returns:
+    A list of ('insert', position, text) and ('delete', start, end) tuples.
+  """
+  rand = random.Random(seed)
+  edits = []
+  for _ in range(count):
+    position = rand.randint(0, size - 16)
+    if rand.random() < 0.5:
+      text = 'edit %d ' % rand.randint(0, 9999)
+      edits.append(('insert', position, text))
+      size += len(text)
+    else:
+      length = rand.randint(1, 16)
+      edits.append(('delete', position, position + length))
+      size -= length
+  return edits
+
+
+def MakeBlip(size, num_annotations):
+  """Returns a context and the op-based blip of the given size in it."""
+  context = ops._ContextImpl()
+  blip_data = model.BlipData()
+  blip_data.blip_id = 'b+bench'
+  blip_data.wave_id = 'example.com!w+bench'
+  blip_data.wavelet_id = 'example.com!conv+root'
+  text = 'The quick brown fox jumps over the lazy dog. '
+  blip_data.content = (text * (size / len(text) + 1))[:size]
+  step = size / max(num_annotations, 1)
+  for i in range(num_annotations):
+    r = document.Range(i * step, i * step + step / 2)
+    blip_data.annotations.append(
+        document.Annotation('style/fontWeight', 'bold', r))
+  return context, context.AddBlip(blip_data)
+
+
+def ApplyEdits(doc, edits):
+  """Applies an edit script through the op-based document."""
+  for edit, start, arg in edits:
+    if edit == 'insert':
+      doc.InsertText(start, arg)
+    else:
+      # DeleteRange removes the character at the end of the range as well.
+      doc.DeleteRange(document.Range(start, arg - 1))
+  return doc.GetText()
+
+
+def ApplyEditsLegacy(context, blip_data, edits):
+  """Applies an edit script the way the document did before TextBuffer."""
+  builder = context.builder
+  for edit, start, arg in edits:
+    if edit == 'insert':
+      builder.DocumentInsert(blip_data.wave_id, blip_data.wavelet_id,
+                             blip_data.blip_id, arg, index=start)
+      content = blip_data.content
+      blip_data.content = content[:start] + arg + content[start:]
+    else:
+      builder.DocumentDelete(blip_data.wave_id, blip_data.wavelet_id,
+                             blip_data.blip_id, start, arg - 1)
+      content = blip_data.content
+      blip_data.content = content[:start] + content[arg:]
+  return blip_data.content
+
+
+def ApplyEditsToString(text, edits):
+  """Applies an edit script by slicing and concatenating a string."""
+  for edit, start, arg in edits:
+    if edit == 'insert':
+      text = text[:start] + arg + text[start:]
+    else:
+      text = text[:start] + text[arg:]
+  return text
+
+
+def RunBenchmarks():
+  """Runs the editing benchmarks and prints the results."""
+  edits = MakeEdits(DOCUMENT_SIZE, NUM_EDITS)
+  initial = MakeBlip(DOCUMENT_SIZE, 0)[1].GetDocument().GetText()
+  expected = ApplyEditsToString(initial, edits)
+
+  baseline = benchmark.Time(lambda: ApplyEditsToString(initial, edits))
+  benchmark.Report('string slicing', baseline)
+
+  def EditBuffer():
+    text_buffer = document.TextBuffer(initial)
+    for edit, start, arg in edits:
+      if edit == 'insert':
+        text_buffer.Insert(start, arg)
+      else:
+        text_buffer.Delete(start, arg)
+    return text_buffer.GetText()
+
+  assert EditBuffer() == expected
+  benchmark.Report('TextBuffer', benchmark.Time(EditBuffer), baseline)
+
+  def EditLegacyDocument():
+    context, blip = MakeBlip(DOCUMENT_SIZE, 0)
+    return ApplyEditsLegacy(context, blip._data, edits)
+
+  assert EditLegacyDocument() == expected
+  legacy = benchmark.Time(EditLegacyDocument)
+  benchmark.Report('document with string slicing', legacy)
+
+  for num_annotations in (0, NUM_ANNOTATIONS):
+    def EditDocument():
+      _, blip = MakeBlip(DOCUMENT_SIZE, num_annotations)
+      return ApplyEdits(blip.GetDocument(), edits)
+
+    assert EditDocument() == expected
+    benchmark.Report('document, %d annotations' % num_annotations,
+                     benchmark.Time(EditDocument), legacy)
+
+
+  _, blip = MakeBlip(DOCUMENT_SIZE, 10 * NUM_ANNOTATIONS)
+  annotations = blip._data.annotations
+  queries = [document.Range(start, start + 10)
+             for _, start, _ in MakeEdits(DOCUMENT_SIZE, NUM_QUERIES, seed=1)]
+
+  def ScanRanges():
+    for r in queries:
+      [a for a in annotations
+       if a.range.start < r.end and a.range.end > r.start]
+
+  def QueryRanges():
+    index = document.AnnotationIndex(annotations)
+    for r in queries:
+      index.GetAnnotationsInRange(r)
+
+  seconds = benchmark.Time(ScanRanges)
+  benchmark.Report('scan for overlapping annotations', seconds)
+  benchmark.Report('query the annotation index', benchmark.Time(QueryRanges),
+                   seconds)
+
+
+if __name__ == '__main__':
+  RunBenchmarks()
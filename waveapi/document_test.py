@@ -8,6 +8,7 @@
 __author__ = 'davidbyttow@google.com (David Byttow)'
 
 
+import random
 import unittest
 
 import document
@@ -53,6 +54,126 @@ class TestAnnotation(unittest.TestCase):
     self.assertEquals(3, annotation.range.end)
 
 
+class TestTextBuffer(unittest.TestCase):
+  """Tests for the document.TextBuffer class."""
+
+  def testEdits(self):
+    text_buffer = document.TextBuffer('hello world')
+    text_buffer.Insert(5, ',')
+    text_buffer.Append('!')
+    text_buffer.Delete(0, 1)
+    text_buffer.Insert(0, 'J')
+    self.assertEquals('Jello, world!', text_buffer.GetText())
+    self.assertEquals(13, len(text_buffer))
+
+  def testClampsPositions(self):
+    text_buffer = document.TextBuffer('abc')
+    text_buffer.Insert(10, 'd')
+    text_buffer.Delete(2, 10)
+    self.assertEquals('ab', text_buffer.GetText())
+    self.assertRaises(IndexError, text_buffer.Insert, -1, 'x')
+    self.assertRaises(IndexError, text_buffer.Delete, 2, 1)
+
+  def testMatchesStringAcrossChunks(self):
+    rand = random.Random(42)
+    text = ''.join(chr(ord('a') + i % 26) for i in range(5000))
+    text_buffer = document.TextBuffer(text)
+    for _ in range(500):
+      start = rand.randint(0, len(text))
+      if rand.random() < 0.5:
+        insert = 'x' * rand.randint(1, 3000)
+        text = text[:start] + insert + text[start:]
+        text_buffer.Insert(start, insert)
+      else:
+        end = min(start + rand.randint(0, 3000), len(text))
+        text = text[:start] + text[end:]
+        text_buffer.Delete(start, end)
+      self.assertEquals(len(text), len(text_buffer))
+    self.assertEquals(text, text_buffer.GetText())
+
+
+class TestAnnotationIndex(unittest.TestCase):
+  """Tests for the document.AnnotationIndex class."""
+
+  def MakeIndex(self, *ranges):
+    annotations = [
+        document.Annotation('name%d' % (i % 2), i, document.Range(start, end))
+        for i, (start, end) in enumerate(ranges)]
+    return annotations, document.AnnotationIndex(annotations)
+
+  def Ranges(self, annotations):
+    return [(a.range.start, a.range.end) for a in annotations]
+
+  def testHasAnnotation(self):
+    annotations, index = self.MakeIndex((0, 1))
+    self.assertTrue(index.HasAnnotation('name0'))
+    self.assertFalse(index.HasAnnotation('name1'))
+    index.Add(document.Annotation('name1', 'value', document.Range(0, 1)))
+    self.assertTrue(index.HasAnnotation('name1'))
+    self.assertEquals(2, len(annotations))
+    index.RemoveByName('name0')
+    self.assertFalse(index.HasAnnotation('name0'))
+    self.assertEquals(['name1'], [a.name for a in annotations])
+
+  def testAnnotationsInRange(self):
+    _, index = self.MakeIndex((5, 9), (0, 2), (1, 5), (3, 4), (0, 20))
+    self.assertEquals([(0, 2), (0, 20), (1, 5)],
+                      self.Ranges(index.GetAnnotationsInRange(
+                          document.Range(1, 2))))
+    self.assertEquals([(0, 20), (1, 5), (3, 4)],
+                      self.Ranges(index.GetAnnotationsInRange(
+                          document.Range(3, 3))))
+    self.assertEquals([(0, 20), (5, 9)],
+                      self.Ranges(index.GetAnnotationsInRange(
+                          document.Range(5, 6), 'name0')))
+    self.assertEquals([], index.GetAnnotationsInRange(document.Range(20, 30)))
+
+  def testMatchesScan(self):
+    rand = random.Random(42)
+    ranges = []
+    for _ in range(200):
+      start = rand.randint(0, 1000)
+      ranges.append((start, start + rand.randint(0, 50)))
+    _, index = self.MakeIndex(*ranges)
+    for _ in range(100):
+      start = rand.randint(0, 1000)
+      end = start + rand.randint(0, 100)
+      expected = sorted((s, e) for s, e in ranges
+                        if s < max(end, start + 1) and e > start)
+      found = self.Ranges(
+          index.GetAnnotationsInRange(document.Range(start, end)))
+      self.assertEquals(expected, sorted(found))
+
+  def testShift(self):
+    annotations, index = self.MakeIndex((0, 2), (1, 5), (5, 8), (6, 6))
+    index.Shift(5, 3)
+    self.assertEquals([(0, 2), (1, 5), (8, 11), (9, 9)],
+                      self.Ranges(annotations))
+    index.Shift(1, 1)
+    self.assertEquals([(0, 3), (2, 6), (9, 12), (10, 10)],
+                      self.Ranges(annotations))
+    self.assertEquals([(2, 6)],
+                      self.Ranges(index.GetAnnotationsInRange(
+                          document.Range(4, 6))))
+
+  def testClip(self):
+    annotations, index = self.MakeIndex((0, 2), (1, 5), (3, 4), (4, 9),
+                                        (6, 8), (2, 2))
+    index.Clip(2, 5)
+    self.assertEquals([(0, 2), (1, 2), (2, 6), (3, 5), (2, 2)],
+                      self.Ranges(annotations))
+    self.assertEquals(5, len(index))
+
+  def testRemoveInRange(self):
+    annotations, index = self.MakeIndex((0, 10), (2, 4), (4, 12))
+    index.RemoveInRange(document.Range(3, 6), 'name0')
+    self.assertEquals([(2, 4), (0, 3), (6, 10), (6, 12)],
+                      self.Ranges(annotations))
+    self.assertEquals([(0, 3), (2, 4)],
+                      self.Ranges(index.GetAnnotationsInRange(
+                          document.Range(1, 3))))
+
+
 class TestElement(unittest.TestCase):
   """Tests for the document.Element class."""
 
@@ -0,0 +1,81 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc. All Rights Reserved.
+
+"""Measures decoding and encoding robot bundles with simplejson.
+
+Compares the pure Python implementation of simplejson with its optional C
+speedups, when they have been built with simplejson/build_speedups.py.
+"""
+
+
+import benchmark
+import ops
+import robot_abstract
+import serialize_benchmark
+import simplejson
+import util
+
+from simplejson import decoder
+from simplejson import encoder
+
+NUM_OPERATIONS = 10000
+
+
+def PurePython(function):
+  """Returns a function calling another without the simplejson speedups."""
+  def Call():
+    saved = (decoder.c_scan, encoder.c_encode,
+             encoder.encode_basestring_ascii)
+    decoder.c_scan = None
+    encoder.c_encode = None
+    encoder.encode_basestring_ascii = encoder.py_encode_basestring_ascii
+    try:
+      return function()
+    finally:
+      (decoder.c_scan, encoder.c_encode,
+       encoder.encode_basestring_ascii) = saved
+  return Call
+
+
+def RunBenchmarks():
+  """Runs the JSON benchmarks and prints the results."""
+  if decoder.c_scan is None:
+    print 'The simplejson speedups are not built, see build_speedups.py.'
+    return
+  for num_blips, num_annotations in ((10, 5), (100, 10), (500, 20)):
+    json_body = benchmark.MakeWireBundle(num_blips, num_annotations, 5)
+    name = '%d blips, %d annotations' % (num_blips, num_annotations)
+
+    def Decode():
+      return robot_abstract.DecodeJSONBody(json_body)
+
+    assert Decode() == PurePython(Decode)()
+    baseline = benchmark.Time(PurePython(Decode))
+    benchmark.Report('decode %s, Python' % name, baseline)
+    benchmark.Report('decode %s, C' % name, benchmark.Time(Decode), baseline)
+
+    data = simplejson.loads(json_body)
+
+    def Encode():
+      return simplejson.dumps(data)
+
+    assert Encode() == PurePython(Encode)()
+    baseline = benchmark.Time(PurePython(Encode))
+    benchmark.Report('encode %s, Python' % name, baseline)
+    benchmark.Report('encode %s, C' % name, benchmark.Time(Encode), baseline)
+
+  operations = serialize_benchmark.MakeOperations(NUM_OPERATIONS)
+
+  def EncodeOperations():
+    return [ops.EncodeOperation(op) for op in operations]
+
+  assert EncodeOperations() == PurePython(EncodeOperations)()
+  baseline = benchmark.Time(PurePython(EncodeOperations))
+  benchmark.Report('encode %d operations, Python' % NUM_OPERATIONS, baseline)
+  benchmark.Report('encode %d operations, C' % NUM_OPERATIONS,
+                   benchmark.Time(EncodeOperations), baseline)
+
+
+if __name__ == '__main__':
+  RunBenchmarks()
@@ -21,6 +21,8 @@ ROOT_WAVELET_ID_SUFFIX = '!conv+root'
 class WaveData(object):
   """Defines the data for a single wave."""
 
+  __slots__ = ('id', 'wavelet_ids')
+
   def __init__(self):
     self.id = None
     self.wavelet_ids = set()
@@ -55,11 +57,15 @@ class WaveletData(object):
 
   java_class = 'com.google.wave.api.impl.WaveletData'
 
+  __slots__ = ('creator', 'creation_time', 'data_documents',
+               'last_modified_time', 'participants', 'root_blip_id', 'title',
+               'version', 'wave_id', 'wavelet_id')
+
   def __init__(self):
     self.creator = None
     self.creation_time = 0
     self.data_documents = {}
-    self.last_modifed_time = 0
+    self.last_modified_time = 0
     self.participants = set()
     self.root_blip_id = None
     self.title = ''
@@ -125,7 +131,13 @@ class BlipData(object):
 
   java_class = 'com.google.wave.api.impl.BlipData'
 
+  __slots__ = ('_annotation_index', '_content', 'annotations', 'blip_id',
+               'child_blip_ids', 'contributors', 'creator', 'elements',
+               'last_modified_time', 'parent_blip_id', 'version', 'wave_id',
+               'wavelet_id')
+
   def __init__(self):
+    self._annotation_index = None
     self.annotations = []
     self.blip_id = None
     self.child_blip_ids = set()
@@ -139,6 +151,36 @@ class BlipData(object):
     self.wave_id = None
     self.wavelet_id = None
 
+  def _GetContent(self):
+    content = self._content
+    if isinstance(content, document.TextBuffer):
+      return content.GetText()
+    return content
+
+  def _SetContent(self, content):
+    self._content = content
+
+  content = property(_GetContent, _SetContent,
+                     doc='The text content of this blip.')
+
+  def GetTextBuffer(self):
+    """Returns the content as a TextBuffer that can be edited in place."""
+    if not isinstance(self._content, document.TextBuffer):
+      self._content = document.TextBuffer(self._content)
+    return self._content
+
+  def GetAnnotationIndex(self):
+    """Returns the AnnotationIndex over the annotations of this blip.
+
+    The index is rebuilt if the annotation list was replaced or changed
+    without going through it.
+    """
+    index = self._annotation_index
+    if index is None or not index.IsIndexing(self.annotations):
+      index = document.AnnotationIndex(self.annotations)
+      self._annotation_index = index
+    return index
+
 
 class Blip(object):
   """Models a single blip instance.
@@ -224,6 +266,8 @@ class Document(object):
 class Event(object):
   """Data describing a single event."""
 
+  __slots__ = ('type', 'timestamp', 'modified_by', 'properties')
+
   def __init__(self):
     self.type = ''
     self.timestamp = 0
@@ -304,6 +348,10 @@ class Context(object):
 
   This includes the current waves in this session
   and any operations that have been enqueued during request processing.
+
+  Handlers can also defer side effects, such as datastore writes, that the
+  server does not need to wait for. These are flushed after the response has
+  been written.
   """
 
   def __init__(self):
@@ -311,6 +359,56 @@ class Context(object):
     self._wavelets = {}
     self._blips = {}
     self._operations = []
+    self._deferred_calls = []
+    self._deferred_puts = []
+
+  def GetOperationCount(self):
+    """Returns the number of operations enqueued in this context."""
+    return len(self._operations)
+
+  def Defer(self, function, *args, **kwargs):
+    """Schedules a call to be made after the response has been written.
+
+    Deferred calls are made in order, after the deferred entities have been
+    put. They are not made if putting the entities fails.
+
+    Args:
+      function: The function to call.
+      *args: Positional arguments for the call.
+      **kwargs: Keyword arguments for the call.
+    """
+    self._deferred_calls.append((function, args, kwargs))
+
+  def DeferPut(self, entities):
+    """Schedules entities to be put after the response has been written.
+
+    The deferred entities of a request are written together with as few
+    batched puts as possible.
+
+    Args:
+      entities: A datastore entity or a list of them.
+    """
+    if not isinstance(entities, (list, tuple)):
+      entities = [entities]
+    self._deferred_puts.extend(entities)
+
+  def PopDeferredWork(self):
+    """Returns and clears the deferred work of this context.
+
+    Returns:
+      A tuple of the list of entities to put, each only once, and the list
+      of (function, args, kwargs) calls to make.
+    """
+    seen = set()
+    puts = []
+    for entity in self._deferred_puts:
+      if id(entity) not in seen:
+        seen.add(id(entity))
+        puts.append(entity)
+    calls = self._deferred_calls
+    self._deferred_calls = []
+    self._deferred_puts = []
+    return puts, calls
 
   def GetBlipById(self, blip_id):
     """Returns a blip by id or None if it does not exist."""
@@ -324,15 +422,30 @@ class Context(object):
     """Returns a wavelet by id or None if it does not exist."""
     return self._wavelets.get(wavelet_id, None)
 
-  def GetRootWavelet(self):
-    """Returns the root wavelet or None if it is not in this context."""
+  def GetRootWavelet(self, wave_id=None):
+    """Returns the root wavelet or None if it is not in this context.
+
+    Args:
+      wave_id: Optionally, the id of the wave to return the root wavelet of.
+    """
     for wavelet in self._wavelets.values():
       wavelet_id = wavelet.GetId()
-      if wavelet_id.endswith(ROOT_WAVELET_ID_SUFFIX):
+      if (wavelet_id.endswith(ROOT_WAVELET_ID_SUFFIX) and
+          (wave_id is None or wavelet.GetWaveId() == wave_id)):
         return wavelet
     logging.warning("Could not retrieve root wavelet.")
     return None
 
+  def GetBlipsByWaveletId(self, wavelet_id):
+    """Returns the list of blips of a wavelet in this context."""
+    return [blip for blip in self.GetBlips()
+            if blip.GetWaveletId() == wavelet_id]
+
+  def GetChildBlips(self, blip_id):
+    """Returns the list of blips in this context that are children of a blip."""
+    return [blip for blip in self.GetBlips()
+            if blip.GetParentBlipId() == blip_id]
+
   def GetWaves(self):
     """Returns the list of waves associated with this session."""
     return self._waves.values()
@@ -0,0 +1,82 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc. All Rights Reserved.
+
+"""Measures the memory footprint of the wave model.
+
+Reports the size of single model instances and the objects allocated to
+parse a bundle and build every blip of its context, which is what a robot
+request holds on to while its handlers run.
+"""
+
+
+import gc
+import sys
+
+import benchmark
+import document
+import model
+import ops
+import robot_abstract
+
+
+def InstanceSize(obj):
+  """Returns the size of an instance, including its attribute dict if any."""
+  size = sys.getsizeof(obj)
+  if hasattr(obj, '__dict__'):
+    size += sys.getsizeof(obj.__dict__)
+  return size
+
+
+def Footprint(function):
+  """Measures the objects allocated and kept alive by a function.
+
+  Only objects tracked by the garbage collector, such as instances, dicts
+  and lists, are counted.
+
+  Args:
+    function: A function taking no arguments whose result is kept alive.
+
+  Returns:
+    A tuple of the number of new objects and their total size in bytes.
+  """
+  gc.collect()
+  before = set(id(obj) for obj in gc.get_objects())
+  result = function()
+  gc.collect()
+  allocated = [obj for obj in gc.get_objects() if id(obj) not in before]
+  size = sum(InstanceSize(obj) for obj in allocated)
+  del result
+  return len(allocated) - 1, size
+
+
+def BuildContext(json_body):
+  """Parses a bundle and builds all of its blips."""
+  context, events = robot_abstract.ParseJSONBody(json_body)
+  context.GetBlips()
+  return context, events
+
+
+def RunBenchmarks():
+  """Runs the memory benchmarks and prints the results."""
+  instances = [
+      ('WaveData', model.WaveData()),
+      ('WaveletData', model.WaveletData()),
+      ('BlipData', model.BlipData()),
+      ('Event', model.Event()),
+      ('Operation', ops.Operation(ops.DOCUMENT_INSERT, 'wave', 'wavelet')),
+      ('Range', document.Range()),
+      ('Annotation', document.Annotation('name', 'value')),
+  ]
+  for name, instance in instances:
+    print '%-40s %10d bytes' % (name, InstanceSize(instance))
+  for num_blips, num_annotations in ((10, 10), (100, 10), (500, 20)):
+    json_body = benchmark.MakeWireBundle(num_blips, num_annotations, 5)
+    count, size = Footprint(lambda: BuildContext(json_body))
+    print '%-40s %10d objects %10d bytes' % (
+        'context of %d blips, %d annotations' % (num_blips, num_annotations),
+        count, size)
+
+
+if __name__ == '__main__':
+  RunBenchmarks()
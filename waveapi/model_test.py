@@ -76,6 +76,12 @@ class TestWaveModel(unittest.TestCase):
     b = model.Blip(self.test_blip_data, model.Document(self.test_blip_data))
     self.assertEquals(False, b.IsRoot())
 
+  def testDataHasFixedFields(self):
+    self.assertRaises(AttributeError, setattr, self.test_blip_data,
+                      'no_such_field', 1)
+    self.assertRaises(AttributeError, setattr, self.test_wavelet_data,
+                      'no_such_field', 1)
+
   def testCreateEvent(self):
     data = {'type': 'WAVELET_PARTICIPANTS_CHANGED',
             'properties': {'blipId': 'blip-1'},
@@ -11,10 +11,12 @@ applied on the server.
 __author__ = 'davidbyttow@google.com (David Byttow)'
 
 
+import logging
 import random
 
 import document
 import model
+import simplejson
 import util
 
 
@@ -47,6 +49,30 @@ DOCUMENT_INLINE_BLIP_INSERT = 'DOCUMENT_INLINE_BLIP_INSERT'
 DOCUMENT_INLINE_BLIP_INSERT_AFTER_ELEMENT = ('DOCUMENT_INLINE_BLIP_INSERT_'
                                              'AFTER_ELEMENT')
 
+# Attribute and JSON key of every field of an encoded Operation, in the order
+# they are written. This is the order simplejson wrote the serialized dict
+# in, so that encoded bundles stay byte for byte the same.
+_OPERATION_FIELDS = (('blip_id', 'blipId'), ('index', 'index'),
+                     ('wavelet_id', 'waveletId'), ('java_class', 'javaClass'),
+                     ('wave_id', 'waveId'), ('property', 'property'),
+                     ('type', 'type'))
+
+# Encoded '"key": ' fragments of the Operation fields, keyed by attribute.
+_OPERATION_KEYS = dict((attr_name, '"%s": ' % key)
+                       for attr_name, key in _OPERATION_FIELDS)
+
+# Encoded trailing '"type": ...}' fragments, keyed by operation type.
+_OPERATION_TYPE_FRAGMENTS = {}
+
+_BUNDLE_PREFIX = '{"operations": {"javaClass": "java.util.ArrayList", "list": ['
+_BUNDLE_SUFFIX = (']}, "javaClass": '
+                  '"com.google.wave.api.impl.OperationMessageBundle"}')
+
+# Operations on the text content of a document that are superseded when the
+# whole content is replaced right after them.
+_CONTENT_OPERATION_TYPES = frozenset([DOCUMENT_APPEND, DOCUMENT_DELETE,
+                                      DOCUMENT_INSERT, DOCUMENT_REPLACE])
+
 
 class Operation(object):
   """Represents a generic operation applied on the server.
@@ -63,6 +89,9 @@ class Operation(object):
 
   java_class = 'com.google.wave.api.impl.OperationImpl'
 
+  __slots__ = ('type', 'wave_id', 'wavelet_id', 'blip_id', 'index',
+               'property')
+
   def __init__(self, op_type, wave_id, wavelet_id, blip_id='', index=-1,
                prop=None):
     """Initializes this operation with contextual data.
@@ -193,7 +222,10 @@ class OpBasedDocument(model.Document):
   Any mutation-based methods will likely result in one or more operations
   being applied locally and sent to the server.
 
-  TODO(davidbyttow): Manage annotations and elements as content is updated.
+  Text edits are applied to the TextBuffer of the blip and move the local
+  annotations along with the text, through the AnnotationIndex of the blip.
+
+  TODO(davidbyttow): Manage elements as content is updated.
   """
 
   def __init__(self, blip_data, context):
@@ -210,10 +242,19 @@ class OpBasedDocument(model.Document):
     Returns:
       True if the annotation exists.
     """
-    for annotation in self._blip_data.annotations:
-      if annotation.name == name:
-        return True
-    return False
+    return self._blip_data.GetAnnotationIndex().HasAnnotation(name)
+
+  def GetAnnotationsInRange(self, r, name=None):
+    """Returns the annotations overlapping a range.
+
+    Args:
+      r: A Range to look up.
+      name: Optionally, the key name of the annotations to return.
+
+    Returns:
+      A list of annotations ordered by their start position.
+    """
+    return self._blip_data.GetAnnotationIndex().GetAnnotationsInRange(r, name)
 
   def SetText(self, text):
     """Clears and sets the text of this document.
@@ -226,7 +267,8 @@ class OpBasedDocument(model.Document):
                                           self._blip_data.wavelet_id,
                                           self._blip_data.blip_id,
                                           text)
-    self._blip_data.content = text
+    self._blip_data.GetTextBuffer().Insert(0, text)
+    self._blip_data.GetAnnotationIndex().Shift(0, len(text))
 
   def SetTextInRange(self, r, text):
     """Deletes text within a range and sets the supplied text in its place.
@@ -249,9 +291,8 @@ class OpBasedDocument(model.Document):
                                           self._blip_data.wavelet_id,
                                           self._blip_data.blip_id,
                                           text, index=start)
-    left = self._blip_data.content[:start]
-    right = self._blip_data.content[start:]
-    self._blip_data.content = left + text + right
+    self._blip_data.GetTextBuffer().Insert(start, text)
+    self._blip_data.GetAnnotationIndex().Shift(start, len(text))
 
   def AppendText(self, text):
     """Appends text to the end of this document.
@@ -263,15 +304,19 @@ class OpBasedDocument(model.Document):
                                           self._blip_data.wavelet_id,
                                           self._blip_data.blip_id,
                                           text)
-    self._blip_data.content += text
+    text_buffer = self._blip_data.GetTextBuffer()
+    self._blip_data.GetAnnotationIndex().Shift(len(text_buffer), len(text))
+    text_buffer.Append(text)
 
   def Clear(self):
     """Clears the content of this document."""
+    size = len(self._blip_data.GetTextBuffer())
     self.__context.builder.DocumentDelete(self._blip_data.wave_id,
                                           self._blip_data.wavelet_id,
                                           self._blip_data.blip_id,
-                                          0, len(self._blip_data.content))
+                                          0, size)
     self._blip_data.content = ''
+    self._blip_data.GetAnnotationIndex().Clip(0, size)
 
   def DeleteRange(self, r):
     """Deletes the content in the specified range.
@@ -283,9 +328,12 @@ class OpBasedDocument(model.Document):
                                           self._blip_data.wavelet_id,
                                           self._blip_data.blip_id,
                                           r.start, r.end)
-    left = self._blip_data.content[:r.start]
-    right = self._blip_data.content[r.end + 1:]
-    self._blip_data.content = left + right
+    # Locally the character at the end of the range is deleted as well.
+    text_buffer = self._blip_data.GetTextBuffer()
+    start = min(r.start, len(text_buffer))
+    end = min(r.end + 1, len(text_buffer))
+    text_buffer.Delete(start, end)
+    self._blip_data.GetAnnotationIndex().Clip(start, end)
 
   def AnnotateDocument(self, name, value):
     """Annotates the entire document.
@@ -299,8 +347,9 @@ class OpBasedDocument(model.Document):
                                    self._blip_data.wavelet_id,
                                    self._blip_data.blip_id,
                                    name, value)
-    r = document.Range(0, len(self._blip_data.content))
-    self._blip_data.annotations.append(document.Annotation(name, value, r))
+    r = document.Range(0, len(self._blip_data.GetTextBuffer()))
+    self._blip_data.GetAnnotationIndex().Add(
+        document.Annotation(name, value, r))
 
   def SetAnnotation(self, r, name, value):
     """Sets an annotation on a given range.
@@ -315,7 +364,9 @@ class OpBasedDocument(model.Document):
                                                  self._blip_data.blip_id,
                                                  r.start, r.end,
                                                  name, value)
-    self._blip_data.annotations.append(document.Annotation(name, value, r))
+    # The index moves its ranges in place, so it gets a copy of this one.
+    self._blip_data.GetAnnotationIndex().Add(
+        document.Annotation(name, value, document.Range(r.start, r.end)))
 
   def DeleteAnnotationsByName(self, name):
     """Deletes all annotations with a given key name.
@@ -323,15 +374,12 @@ class OpBasedDocument(model.Document):
     Args:
       name: A string as the key for the annotation to delete.
     """
-    size = len(self._blip_data.content)
+    size = len(self._blip_data.GetTextBuffer())
     self.__context.builder.DocumentAnnotationDelete(self._blip_data.wave_id,
                                                     self._blip_data.wavelet_id,
                                                     self._blip_data.blip_id,
                                                     0, size, name)
-    for index in range(len(self._blip_data.annotations)):
-      annotation = self._blip_data.annotations[index]
-      if annotation.name == name:
-        del self._blip_data.annotations[index]
+    self._blip_data.GetAnnotationIndex().RemoveByName(name)
 
   def DeleteAnnotationsInRange(self, r, name):
     """Clears all of the annotations within a given range with a given key.
@@ -345,7 +393,7 @@ class OpBasedDocument(model.Document):
                                                     self._blip_data.blip_id,
                                                     r.start, r.end,
                                                     name)
-    # TODO(davidbyttow): split local annotations.
+    self._blip_data.GetAnnotationIndex().RemoveInRange(r, name)
 
   def AppendInlineBlip(self):
     """Appends an inline blip to this blip.
@@ -439,12 +487,84 @@ class _ContextImpl(model.Context):
 
   Operations are applied in the order that they are received. Adding
   operations manually will not be reflected in the state of the context.
+
+  The context keeps the root wavelet of every wave, the ids of the blips of
+  every wavelet and the ids of the children of every blip as it is built, so
+  these lookups do not scan the whole context. Blips that are still raw are
+  indexed from their metadata and only built when they are returned.
   """
 
   def __init__(self):
     super(_ContextImpl, self).__init__()
+    self._raw_blips = {}
+    self._root_wavelets = {}
+    self._blip_ids_by_wavelet = {}
+    self._child_blip_ids = {}
+    self._blip_parents = {}
     self.builder = OpBuilder(self)
 
+  def GetBlipById(self, blip_id):
+    """Returns a blip by id or None if it does not exist."""
+    if blip_id in self._raw_blips:
+      return self.__MaterializeBlip(blip_id)
+    return self._blips.get(blip_id, None)
+
+  def GetBlips(self):
+    """Returns the list of blips associated with this session."""
+    for blip_id in self._raw_blips.keys():
+      self.__MaterializeBlip(blip_id)
+    return self._blips.values()
+
+  def GetRootWavelet(self, wave_id=None):
+    """Returns the root wavelet or None if it is not in this context.
+
+    Args:
+      wave_id: Optionally, the id of the wave to return the root wavelet of.
+    """
+    if wave_id is None:
+      wavelets = self._root_wavelets.values()
+      wavelet = wavelets and wavelets[0] or None
+    else:
+      wavelet = self._root_wavelets.get(wave_id)
+    if wavelet is None:
+      logging.warning("Could not retrieve root wavelet.")
+    return wavelet
+
+  def GetBlipsByWaveletId(self, wavelet_id):
+    """Returns the list of blips of a wavelet in this context."""
+    return self.__GetBlipsByIds(self._blip_ids_by_wavelet.get(wavelet_id, ()))
+
+  def GetChildBlips(self, blip_id):
+    """Returns the list of blips in this context that are children of a blip."""
+    return self.__GetBlipsByIds(self._child_blip_ids.get(blip_id, ()))
+
+  def __GetBlipsByIds(self, blip_ids):
+    """Returns the blips with the given ids, building raw ones as needed."""
+    blips = []
+    for blip_id in list(blip_ids):
+      blips.append(self.GetBlipById(blip_id))
+    return blips
+
+  def __IndexBlip(self, blip_id, wavelet_id, parent_blip_id):
+    """Adds a blip to the per wavelet and per parent indexes."""
+    self.__UnindexBlip(blip_id)
+    self._blip_ids_by_wavelet.setdefault(wavelet_id, set()).add(blip_id)
+    self._child_blip_ids.setdefault(parent_blip_id, set()).add(blip_id)
+    self._blip_parents[blip_id] = (wavelet_id, parent_blip_id)
+
+  def __UnindexBlip(self, blip_id):
+    """Removes a blip from the per wavelet and per parent indexes."""
+    if blip_id not in self._blip_parents:
+      return
+    wavelet_id, parent_blip_id = self._blip_parents.pop(blip_id)
+    self._blip_ids_by_wavelet[wavelet_id].discard(blip_id)
+    self._child_blip_ids[parent_blip_id].discard(blip_id)
+
+  def __MaterializeBlip(self, blip_id):
+    """Builds and adds a blip from its raw data."""
+    raw_blip_data = self._raw_blips.pop(blip_id)
+    return self.AddBlip(model.CreateBlipData(raw_blip_data))
+
   def AddOperation(self, op):
     """Adds an operation to the list of operations to applied by the server.
 
@@ -457,6 +577,16 @@ class _ContextImpl(model.Context):
     """
     self._operations.append(op)
 
+  def CompactOperations(self):
+    """Compacts the pending operations, see CompactOperations.
+
+    Returns:
+      The number of operations that were removed.
+    """
+    count = len(self._operations)
+    self._operations = CompactOperations(self._operations)
+    return count - len(self._operations)
+
   def AddWave(self, wave_data):
     """Adds a transient wave based on the data supplied.
 
@@ -481,6 +611,8 @@ class _ContextImpl(model.Context):
     """
     wavelet = OpBasedWavelet(wavelet_data, self)
     self._wavelets[wavelet.GetId()] = wavelet
+    if wavelet.GetId().endswith(model.ROOT_WAVELET_ID_SUFFIX):
+      self._root_wavelets[wavelet.GetWaveId()] = wavelet
     return wavelet
 
   def AddBlip(self, blip_data):
@@ -493,9 +625,26 @@ class _ContextImpl(model.Context):
       An OpBasedBlip that may have operations applied to it.
     """
     blip = OpBasedBlip(blip_data, self)
+    self._raw_blips.pop(blip.GetId(), None)
     self._blips[blip.GetId()] = blip
+    self.__IndexBlip(blip.GetId(), blip.GetWaveletId(), blip.GetParentBlipId())
     return blip
 
+  def AddRawBlip(self, raw_blip_data):
+    """Adds a blip based on raw data without building it yet.
+
+    The BlipData, its annotations and document are only built the first time
+    the blip is accessed through GetBlipById or GetBlips, so handlers that
+    never look at blips do not pay for them.
+
+    Args:
+      raw_blip_data: Blip data as decoded from the wire protocol.
+    """
+    blip_id = raw_blip_data['blipId']
+    self._raw_blips[blip_id] = raw_blip_data
+    self.__IndexBlip(blip_id, raw_blip_data['waveletId'],
+                     raw_blip_data['parentBlipId'])
+
   def RemoveWave(self, wave_id):
     """Removes a wave locally."""
     if wave_id in self._waves:
@@ -504,10 +653,14 @@ class _ContextImpl(model.Context):
   def RemoveWavelet(self, wavelet_id):
     """Removes a wavelet locally."""
     if wavelet_id in self._wavelets:
-      del self._wavelets[wavelet_id]
+      wavelet = self._wavelets.pop(wavelet_id)
+      if self._root_wavelets.get(wavelet.GetWaveId()) is wavelet:
+        del self._root_wavelets[wavelet.GetWaveId()]
 
   def RemoveBlip(self, blip_id):
     """Removes a blip locally."""
+    self._raw_blips.pop(blip_id, None)
+    self.__UnindexBlip(blip_id)
     if blip_id in self._blips:
       del self._blips[blip_id]
 
@@ -523,6 +676,138 @@ class _ContextImpl(model.Context):
     }
     return data
 
+  def WriteJson(self, out):
+    """Writes the operation bundle as JSON, see WriteOperationBundle."""
+    WriteOperationBundle(self._operations, out)
+
+
+def _EncodeValue(value):
+  """Returns the JSON encoding of an operation field."""
+  if isinstance(value, basestring):
+    return simplejson.encoder.encode_basestring_ascii(value)
+  if isinstance(value, (int, long)) and not isinstance(value, bool):
+    return str(value)
+  return simplejson.dumps(util.Serialize(value))
+
+
+def EncodeOperation(op):
+  """Returns the JSON encoding of an operation in the wire format.
+
+  This gives the same string as encoding util.Serialize(op) with simplejson,
+  without building the intermediate dict. The key fragments are precomputed
+  and the closing fragment is computed once per operation type.
+
+  Args:
+    op: The Operation to encode.
+  """
+  if op.__class__ is not Operation or op.type is None:
+    return simplejson.dumps(util.Serialize(op))
+  type_fragment = _OPERATION_TYPE_FRAGMENTS.get(op.type)
+  if type_fragment is None:
+    type_fragment = '%s%s}' % (_OPERATION_KEYS['type'], _EncodeValue(op.type))
+    _OPERATION_TYPE_FRAGMENTS[op.type] = type_fragment
+  parts = []
+  for attr_name, _ in _OPERATION_FIELDS[:-1]:
+    value = getattr(op, attr_name)
+    if value is not None:
+      parts.append(_OPERATION_KEYS[attr_name] + _EncodeValue(value))
+  parts.append(type_fragment)
+  return '{' + ', '.join(parts)
+
+
+def WriteOperationBundle(operations, out):
+  """Writes an operation bundle as JSON to a stream.
+
+  The bundle is written one operation at a time in the wire format, the same
+  as encoding the dict of _ContextImpl.Serialize with simplejson, without
+  building the dict or the whole string.
+
+  Args:
+    operations: The list of Operations in the bundle.
+    out: A file-like object to write to.
+  """
+  out.write(_BUNDLE_PREFIX)
+  separator = ''
+  for op in operations:
+    out.write(separator)
+    out.write(EncodeOperation(op))
+    separator = ', '
+  out.write(_BUNDLE_SUFFIX)
+
+
+def _IsText(value):
+  """Returns whether an operation property is plain text."""
+  return isinstance(value, basestring)
+
+
+def _OnSameBlip(op, other):
+  """Returns whether two operations apply to the same blip."""
+  return (op.blip_id == other.blip_id and
+          op.wavelet_id == other.wavelet_id and
+          op.wave_id == other.wave_id)
+
+
+def CompactOperations(operations):
+  """Returns a shorter list of operations with the same effect.
+
+  The following rewrites are applied to operations that directly follow
+  each other on the same blip:
+    - Consecutive appends are merged.
+    - An insert into the text of the preceding insert is merged into it.
+    - An insert directly followed by a delete of exactly the inserted text
+      is dropped along with the delete, as happens when SetText is called
+      repeatedly.
+    - Content operations directly followed by a replace are dropped.
+  Repeated requests to add the same participant to a wavelet are dropped
+  wherever they are.
+
+  Args:
+    operations: A list of Operation instances, in the order they are to be
+        applied.
+
+  Returns:
+    A new list of Operation instances.
+  """
+  compacted = []
+  added_participants = set()
+  for op in operations:
+    last = None
+    if compacted and _OnSameBlip(compacted[-1], op):
+      last = compacted[-1]
+
+    if op.type == WAVELET_ADD_PARTICIPANT:
+      key = (op.wave_id, op.wavelet_id, op.property)
+      if key in added_participants:
+        continue
+      added_participants.add(key)
+    elif last is None:
+      pass
+    elif (op.type == DOCUMENT_APPEND and last.type == DOCUMENT_APPEND and
+          _IsText(op.property) and _IsText(last.property)):
+      compacted[-1] = Operation(DOCUMENT_APPEND, op.wave_id, op.wavelet_id,
+                                op.blip_id, prop=last.property + op.property)
+      continue
+    elif (op.type == DOCUMENT_INSERT and last.type == DOCUMENT_INSERT and
+          _IsText(op.property) and _IsText(last.property) and
+          last.index <= op.index <= last.index + len(last.property)):
+      offset = op.index - last.index
+      text = last.property[:offset] + op.property + last.property[offset:]
+      compacted[-1] = Operation(DOCUMENT_INSERT, op.wave_id, op.wavelet_id,
+                                op.blip_id, index=last.index, prop=text)
+      continue
+    elif (op.type == DOCUMENT_DELETE and last.type == DOCUMENT_INSERT and
+          op.property is not None and _IsText(last.property) and
+          op.property.start == last.index and
+          op.property.end == last.index + len(last.property)):
+      compacted.pop()
+      continue
+    elif op.type == DOCUMENT_REPLACE:
+      while (compacted and _OnSameBlip(compacted[-1], op) and
+             compacted[-1].type in _CONTENT_OPERATION_TYPES):
+        compacted.pop()
+    compacted.append(op)
+  return compacted
+
 
 def CreateContext(data):
   """Creates a Context instance from raw data supplied by the server.
@@ -535,8 +820,7 @@ def CreateContext(data):
   """
   context = _ContextImpl()
   for raw_blip_data in data['blips'].values():
-    blip_data = model.CreateBlipData(raw_blip_data)
-    context.AddBlip(blip_data)
+    context.AddRawBlip(raw_blip_data)
 
   # Currently only one wavelet is sent.
   wavelet_data = model.CreateWaveletData(data['wavelet'])
@@ -555,13 +839,18 @@ def CreateContext(data):
 
   for wave_id, wavelet_ids in wave_wavelet_map.iteritems():
     wave_data = model.WaveData()
-    wave_data.wave_id = wave_id
+    wave_data.id = wave_id
     wave_data.wavelet_ids = set(wavelet_ids)
     context.AddWave(wave_data)
 
   return context
 
 
+def CreateEmptyContext():
+  """Creates a Context without any waves, for requests that carry none."""
+  return _ContextImpl()
+
+
 class OpBuilder(object):
   """Wraps all currently supportable operations as functions.
 
@@ -688,6 +977,7 @@ class OpBuilder(object):
       BlipData instance for which further operations can be applied.
     """
     blip_data = self.__CreateNewBlipData(wave_id, wavelet_id)
+    blip_data.parent_blip_id = blip_id
     op = Operation(BLIP_CREATE_CHILD, wave_id, wavelet_id,
                    blip_id=blip_id,
                    prop=blip_data)
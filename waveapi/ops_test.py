@@ -8,11 +8,14 @@
 __author__ = 'davidbyttow@google.com (David Byttow)'
 
 
+import StringIO
 import unittest
 
 import document
 import model
 import ops
+import simplejson
+import util
 
 
 class TestOperation(unittest.TestCase):
@@ -40,6 +43,117 @@ class TestOperation(unittest.TestCase):
     self.assertEquals('foo', op.property)
 
 
+class TestEncodeOperations(unittest.TestCase):
+  """Test case for encoding operation bundles without simplejson."""
+
+  def AssertEncodedLikeSimplejson(self, op):
+    self.assertEquals(simplejson.dumps(util.Serialize(op)),
+                      ops.EncodeOperation(op))
+
+  def testEncodeOperation(self):
+    self.AssertEncodedLikeSimplejson(
+        ops.Operation(ops.WAVELET_APPEND_BLIP, 'wave-id', 'wavelet-id'))
+    self.AssertEncodedLikeSimplejson(
+        ops.Operation(ops.DOCUMENT_INSERT, 'wave-id', 'wavelet-id',
+                      blip_id='blip-id', index=3, prop=u'\xe9t\xe9 "quoted"'))
+    self.AssertEncodedLikeSimplejson(
+        ops.Operation(ops.DOCUMENT_DELETE, 'wave-id', None,
+                      prop=document.Range(1, 2)))
+    self.AssertEncodedLikeSimplejson(
+        ops.Operation(ops.DOCUMENT_ANNOTATION_SET, 'wave-id', 'wavelet-id',
+                      prop=document.Annotation('name', 'value',
+                                               document.Range(0, 1))))
+    self.AssertEncodedLikeSimplejson(
+        ops.Operation(None, 'wave-id', 'wavelet-id', prop=True))
+
+  def testWriteJson(self):
+    context = ops._ContextImpl()
+    context.builder.WaveletAddParticipant('wave', 'wavelet', 'a@example.com')
+    context.builder.DocumentInsert('wave', 'wavelet', 'blip', 'text', index=2)
+    out = StringIO.StringIO()
+    context.WriteJson(out)
+    self.assertEquals(simplejson.dumps(util.Serialize(context)),
+                      out.getvalue())
+
+    out = StringIO.StringIO()
+    ops._ContextImpl().WriteJson(out)
+    self.assertEquals(simplejson.dumps(util.Serialize(ops._ContextImpl())),
+                      out.getvalue())
+
+
+class TestCompactOperations(unittest.TestCase):
+  """Test case for compacting operation bundles."""
+
+  def setUp(self):
+    self.context = ops._ContextImpl()
+    self.builder = self.context.builder
+
+  def Compact(self):
+    removed = self.context.CompactOperations()
+    return removed, [(op.type, op.index, op.property)
+                     for op in self.context._operations]
+
+  def testMergeAppends(self):
+    self.builder.DocumentAppend('wave', 'wavelet', 'blip', 'a')
+    self.builder.DocumentAppend('wave', 'wavelet', 'blip', 'b')
+    self.builder.DocumentAppend('wave', 'wavelet', 'other', 'c')
+    removed, compacted = self.Compact()
+    self.assertEquals(1, removed)
+    self.assertEquals([(ops.DOCUMENT_APPEND, -1, 'ab'),
+                       (ops.DOCUMENT_APPEND, -1, 'c')], compacted)
+
+  def testMergeInserts(self):
+    self.builder.DocumentInsert('wave', 'wavelet', 'blip', 'abc', index=2)
+    self.builder.DocumentInsert('wave', 'wavelet', 'blip', 'def', index=5)
+    self.builder.DocumentInsert('wave', 'wavelet', 'blip', 'X', index=3)
+    self.builder.DocumentInsert('wave', 'wavelet', 'blip', 'Y', index=20)
+    removed, compacted = self.Compact()
+    self.assertEquals(2, removed)
+    self.assertEquals([(ops.DOCUMENT_INSERT, 2, 'aXbcdef'),
+                       (ops.DOCUMENT_INSERT, 20, 'Y')], compacted)
+
+  def testRepeatedSetText(self):
+    context = ops._ContextImpl()
+    blip_data = model.BlipData()
+    blip_data.blip_id = 'blip'
+    blip_data.content = 'old'
+    doc = context.AddBlip(blip_data).GetDocument()
+    doc.SetText('first')
+    doc.SetText('second')
+    doc.SetText('third')
+    removed = context.CompactOperations()
+    self.assertEquals(4, removed)
+    self.assertEquals([ops.DOCUMENT_DELETE, ops.DOCUMENT_INSERT],
+                      [op.type for op in context._operations])
+    self.assertEquals(3, context._operations[0].property.end)
+    self.assertEquals('third', context._operations[1].property)
+
+  def testDeleteOfOtherTextKept(self):
+    self.builder.DocumentInsert('wave', 'wavelet', 'blip', 'abc', index=0)
+    self.builder.DocumentDelete('wave', 'wavelet', 'blip', 0, 2)
+    self.assertEquals(0, self.context.CompactOperations())
+
+  def testReplaceSupersedesContentOps(self):
+    self.builder.DocumentAnnotationSet('wave', 'wavelet', 'blip', 0, 1,
+                                       'key', 'value')
+    self.builder.DocumentInsert('wave', 'wavelet', 'blip', 'abc')
+    self.builder.DocumentAppend('wave', 'wavelet', 'blip', 'def')
+    self.builder.DocumentReplace('wave', 'wavelet', 'blip', 'new')
+    removed, compacted = self.Compact()
+    self.assertEquals(2, removed)
+    self.assertEquals([ops.DOCUMENT_ANNOTATION_SET, ops.DOCUMENT_REPLACE],
+                      [op_type for op_type, _, _ in compacted])
+
+  def testDuplicateParticipants(self):
+    self.builder.WaveletAddParticipant('wave', 'wavelet', 'a@example.com')
+    self.builder.DocumentAppend('wave', 'wavelet', 'blip', 'a')
+    self.builder.WaveletAddParticipant('wave', 'wavelet', 'a@example.com')
+    self.builder.WaveletAddParticipant('wave', 'other', 'a@example.com')
+    removed, compacted = self.Compact()
+    self.assertEquals(1, removed)
+    self.assertEquals(3, len(compacted))
+
+
 class TestOpBasedClasses(unittest.TestCase):
   """Base class for op-based test classes. Sets up some test data."""
 
@@ -95,6 +209,106 @@ class TestOpBasedContext(TestOpBasedClasses):
     self.test_context.RemoveBlip('blip-1')
     self.assertEquals(None, self.test_context.GetBlipById('blip-1'))
 
+  def testDeferredWork(self):
+    first = object()
+    second = object()
+    self.test_context.DeferPut([first, second])
+    self.test_context.DeferPut(first)
+    self.test_context.Defer(max, 1, 2, key=None)
+    puts, calls = self.test_context.PopDeferredWork()
+    self.assertEquals([first, second], puts)
+    self.assertEquals([(max, (1, 2), {'key': None})], calls)
+    self.assertEquals(([], []), self.test_context.PopDeferredWork())
+
+
+class TestCreateContext(unittest.TestCase):
+  """Test case for building a context from raw data."""
+
+  def setUp(self):
+    def RawBlip(blip_id, parent_blip_id=None):
+      return {
+          'annotations': [{'name': 'key', 'value': 'value',
+                           'range': {'start': 0, 'end': 1}}],
+          'blipId': blip_id,
+          'childBlipIds': [],
+          'content': 'text of ' + blip_id,
+          'contributors': ['creator@google.com'],
+          'creator': 'creator@google.com',
+          'elements': {},
+          'lastModifiedTime': 101,
+          'parentBlipId': parent_blip_id,
+          'version': 1,
+          'waveId': 'my-wave',
+          'waveletId': 'wavelet-1',
+      }
+    self.data = {
+        'blips': {'blip-1': RawBlip('blip-1'),
+                  'blip-2': RawBlip('blip-2', 'blip-1')},
+        'events': [],
+        'wavelet': {
+            'creationTime': 100,
+            'creator': 'creator@google.com',
+            'dataDocuments': None,
+            'lastModifiedTime': 101,
+            'participants': ['robot@google.com'],
+            'rootBlipId': 'blip-1',
+            'title': '',
+            'version': 1,
+            'waveId': 'my-wave',
+            'waveletId': 'wavelet-1',
+        },
+    }
+
+  def testBlipsBuiltLazily(self):
+    context = ops.CreateContext(self.data)
+    self.assertEquals({}, context._blips)
+    blip = context.GetBlipById('blip-2')
+    self.assertEquals('blip-1', blip.GetParentBlipId())
+    self.assertEquals('text of blip-2', blip.GetDocument().GetText())
+    self.assertTrue(blip.GetDocument().HasAnnotation('key'))
+    self.assertEquals(['blip-2'], context._blips.keys())
+    self.assertTrue(blip is context.GetBlipById('blip-2'))
+    self.assertEquals(2, len(context.GetBlips()))
+    self.assertEquals(None, context.GetBlipById('blip-3'))
+
+  def testRemoveUnbuiltBlip(self):
+    context = ops.CreateContext(self.data)
+    context.RemoveBlip('blip-1')
+    self.assertEquals(None, context.GetBlipById('blip-1'))
+    self.assertEquals(1, len(context.GetBlips()))
+
+  def testWavelet(self):
+    context = ops.CreateContext(self.data)
+    wavelet = context.GetWaveletById('wavelet-1')
+    self.assertEquals('my-wave', wavelet.GetWaveId())
+    self.assertEquals('blip-1', wavelet.GetRootBlipId())
+    wave = context.GetWaveById('my-wave')
+    self.assertEquals(set(['wavelet-1']), wave.GetWaveletIds())
+
+  def testIndexedLookups(self):
+    self.data['wavelet']['waveletId'] = 'my-wave!conv+root'
+    for raw_blip_data in self.data['blips'].values():
+      raw_blip_data['waveletId'] = 'my-wave!conv+root'
+    context = ops.CreateContext(self.data)
+    root_wavelet = context.GetRootWavelet()
+    self.assertEquals('my-wave!conv+root', root_wavelet.GetId())
+    self.assertTrue(root_wavelet is context.GetRootWavelet('my-wave'))
+    self.assertEquals(None, context.GetRootWavelet('other-wave'))
+
+    children = context.GetChildBlips('blip-1')
+    self.assertEquals(['blip-2'], [blip.GetId() for blip in children])
+    # Only the blips that were looked up are built.
+    self.assertEquals(['blip-2'], context._blips.keys())
+    blips = context.GetBlipsByWaveletId('my-wave!conv+root')
+    self.assertEquals(['blip-1', 'blip-2'],
+                      sorted(blip.GetId() for blip in blips))
+
+    context.RemoveBlip('blip-2')
+    self.assertEquals([], context.GetChildBlips('blip-1'))
+    self.assertEquals(1, len(context.GetBlipsByWaveletId('my-wave!conv+root')))
+    context.RemoveWavelet('my-wave!conv+root')
+    self.assertEquals(None, context.GetRootWavelet())
+
 
 class TestOpBasedWave(TestOpBasedClasses):
   """Test case for OpBasedWave class."""
@@ -141,6 +355,9 @@ class TestOpBasedBlip(TestOpBasedClasses):
     self.assertEquals('wavelet-1', blip.GetWaveletId())
     self.assertTrue(blip.GetId().startswith('TBD'))
     self.assertEquals(blip, self.test_context.GetBlipById(blip.GetId()))
+    self.assertEquals(self.test_blip.GetId(), blip.GetParentBlipId())
+    self.assertEquals([blip],
+                      self.test_context.GetChildBlips(self.test_blip.GetId()))
 
   def testDelete(self):
     self.test_blip.Delete()
@@ -184,6 +401,18 @@ class TestOpBasedDocument(TestOpBasedClasses):
     self.test_doc.DeleteRange(document.Range(0, 0))
     self.assertEquals('456', self.test_doc.GetText())
 
+  def testAnnotationsFollowText(self):
+    self.test_doc.SetAnnotation(document.Range(2, 4), 'key', 'value')
+    self.test_doc.InsertText(0, 'ab')
+    self.test_doc.AppendText('789')
+    annotation = self.test_blip_data.annotations[-1]
+    self.assertEquals((4, 6), (annotation.range.start, annotation.range.end))
+    self.test_doc.DeleteRange(document.Range(0, 4))
+    self.assertEquals('456789', self.test_doc.GetText())
+    self.assertEquals((0, 1), (annotation.range.start, annotation.range.end))
+    self.test_doc.Clear()
+    self.assertFalse(self.test_doc.HasAnnotation('key'))
+
   def testAnnotateDocument(self):
     self.test_doc.AnnotateDocument('key', 'value')
     self.assertTrue(self.test_doc.HasAnnotation('key'))
@@ -193,6 +422,17 @@ class TestOpBasedDocument(TestOpBasedClasses):
     self.test_doc.SetAnnotation(document.Range(0, 1), 'key', 'value')
     self.assertTrue(self.test_doc.HasAnnotation('key'))
 
+  def testGetAnnotationsInRange(self):
+    r = document.Range(1, 3)
+    self.test_doc.SetAnnotation(r, 'key', 'value')
+    self.test_doc.SetAnnotation(document.Range(4, 5), 'key', 'other')
+    found = self.test_doc.GetAnnotationsInRange(document.Range(0, 2))
+    self.assertEquals(['value'], [a.value for a in found])
+    # The document keeps its own copy of the range it was given.
+    self.test_doc.InsertText(0, 'abc')
+    self.assertEquals((1, 3), (r.start, r.end))
+    self.assertEquals((4, 6), (found[0].range.start, found[0].range.end))
+
   def testDeleteAnnotationByName(self):
     self.assertRaises(NotImplementedError,
                       self.test_doc.DeleteAnnotationsByName, 'key')
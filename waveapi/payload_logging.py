@@ -0,0 +1,137 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc. All Rights Reserved.
+
+"""Logs the payloads exchanged with the wave server.
+
+Payloads can be hundreds of kilobytes, so the PayloadLogger only logs a
+sample of the requests, truncates what it logs and only formats a message
+when the logger would emit it. In digest mode it logs the event types and
+the number of operations instead of the payloads.
+"""
+
+
+import logging
+import random
+
+MODE_OFF = 'off'
+MODE_DIGEST = 'digest'
+MODE_FULL = 'full'
+
+
+class _Truncated(object):
+  """Formats a payload cut to a maximum size, only when it is logged."""
+
+  __slots__ = ('text', 'max_bytes')
+
+  def __init__(self, text, max_bytes):
+    self.text = text
+    self.max_bytes = max_bytes
+
+  def __str__(self):
+    text = self.text
+    if isinstance(text, unicode):
+      text = text.encode('utf-8')
+    if self.max_bytes is None or len(text) <= self.max_bytes:
+      return text
+    return '%s... (%d more bytes)' % (text[:self.max_bytes],
+                                      len(text) - self.max_bytes)
+
+
+class _EventDigest(object):
+  """Formats the number of events of every type, only when it is logged."""
+
+  __slots__ = ('events',)
+
+  def __init__(self, events):
+    self.events = events
+
+  def __str__(self):
+    counts = {}
+    types = []
+    for event in self.events:
+      if event.type not in counts:
+        counts[event.type] = 0
+        types.append(event.type)
+      counts[event.type] += 1
+    return ', '.join(['%s x%d' % (t, counts[t]) for t in types]) or 'none'
+
+
+class PayloadLogger(object):
+  """Logs sampled, size-capped payloads of the robot endpoint.
+
+  A request is either sampled or not as a whole, so that its incoming and
+  outgoing payloads are logged together.
+  """
+
+  def __init__(self, mode=MODE_FULL, sample_rate=1.0, max_bytes=16384,
+               level=logging.INFO, logger=None):
+    """Initializes the payload logger.
+
+    Args:
+      mode: MODE_FULL logs the payloads, MODE_DIGEST only their sizes, the
+          event types and the number of operations, and MODE_OFF nothing.
+      sample_rate: Fraction of the requests that are logged.
+      max_bytes: Number of bytes of a payload logged in full mode before it
+          is truncated, or None to log payloads whole.
+      level: Logging level of the messages.
+      logger: Optional logging.Logger to log to instead of the root logger.
+    """
+    self.mode = mode
+    self.sample_rate = sample_rate
+    self.max_bytes = max_bytes
+    self.level = level
+    self.logger = logger or logging.getLogger()
+
+  def StartRequest(self):
+    """Returns whether the payloads of a new request are to be logged."""
+    if self.mode == MODE_OFF or not self.logger.isEnabledFor(self.level):
+      return False
+    return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+  def LogIncoming(self, sampled, json_body):
+    """Logs the incoming payload of a request.
+
+    This is called before the payload is decoded, so that payloads that fail
+    to decode are logged as well.
+
+    Args:
+      sampled: Whether the request is logged, as returned by StartRequest.
+      json_body: The JSON body received from the server.
+    """
+    if not sampled:
+      return
+    if self.mode == MODE_DIGEST:
+      self.logger.log(self.level, 'Incoming: %d bytes', len(json_body))
+    else:
+      self.logger.log(self.level, 'Incoming: %s',
+                      _Truncated(json_body, self.max_bytes))
+
+  def LogEvents(self, sampled, events):
+    """Logs the types of the events decoded from the incoming payload.
+
+    Only digest mode logs them, since full mode logged the payload itself.
+
+    Args:
+      sampled: Whether the request is logged, as returned by StartRequest.
+      events: The list of Events decoded from the payload.
+    """
+    if sampled and self.mode == MODE_DIGEST:
+      self.logger.log(self.level, 'Incoming events: %s', _EventDigest(events))
+
+  def LogOutgoing(self, sampled, json_response, operation_count):
+    """Logs the outgoing payload of a request.
+
+    Args:
+      sampled: Whether the request is logged, as returned by StartRequest.
+      json_response: The JSON response sent to the server.
+      operation_count: The number of operations in the response.
+    """
+    if not sampled:
+      return
+    if self.mode == MODE_DIGEST:
+      self.logger.log(self.level, 'Outgoing: %d bytes, %d operations',
+                      len(json_response), operation_count)
+    else:
+      self.logger.log(self.level, 'Outgoing: %s',
+                      _Truncated(json_response, self.max_bytes))
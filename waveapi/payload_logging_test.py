@@ -0,0 +1,106 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc. All Rights Reserved.
+
+"""Unit tests for the payload_logging module."""
+
+
+import logging
+import unittest
+
+import model
+import payload_logging
+
+
+class ListHandler(logging.Handler):
+  """Keeps the formatted messages of the records it handles."""
+
+  def __init__(self):
+    logging.Handler.__init__(self)
+    self.messages = []
+
+  def emit(self, record):
+    self.messages.append(record.getMessage())
+
+
+class TestPayloadLogger(unittest.TestCase):
+  """Tests for the payload_logging.PayloadLogger class."""
+
+  def setUp(self):
+    self.logger = logging.getLogger('payload_logging_test')
+    self.logger.propagate = False
+    self.logger.setLevel(logging.INFO)
+    self.handler = ListHandler()
+    self.logger.addHandler(self.handler)
+
+  def tearDown(self):
+    self.logger.removeHandler(self.handler)
+
+  def testFull(self):
+    payload_logger = payload_logging.PayloadLogger(logger=self.logger)
+    sampled = payload_logger.StartRequest()
+    self.assertTrue(sampled)
+    payload_logger.LogIncoming(sampled, '{"events": []}')
+    payload_logger.LogEvents(sampled, [])
+    payload_logger.LogOutgoing(sampled, '[]', 0)
+    self.assertEquals(['Incoming: {"events": []}', 'Outgoing: []'],
+                      self.handler.messages)
+
+  def testTruncate(self):
+    payload_logger = payload_logging.PayloadLogger(max_bytes=4,
+                                                   logger=self.logger)
+    payload_logger.LogIncoming(True, '0123456789')
+    payload_logger.LogOutgoing(True, u'\xe9t\xe9', 1)
+    self.assertEquals(['Incoming: 0123... (6 more bytes)',
+                       'Outgoing: \xc3\xa9t\xc3... (1 more bytes)'],
+                      self.handler.messages)
+
+  def testDigest(self):
+    payload_logger = payload_logging.PayloadLogger(
+        mode=payload_logging.MODE_DIGEST, logger=self.logger)
+    events = []
+    for event_type in ('BLIP_SUBMITTED', 'DOCUMENT_CHANGED', 'BLIP_SUBMITTED'):
+      event = model.Event()
+      event.type = event_type
+      events.append(event)
+    payload_logger.LogIncoming(True, 'x' * 100)
+    payload_logger.LogEvents(True, events)
+    payload_logger.LogOutgoing(True, 'x' * 10, 3)
+    self.assertEquals(
+        ['Incoming: 100 bytes',
+         'Incoming events: BLIP_SUBMITTED x2, DOCUMENT_CHANGED x1',
+         'Outgoing: 10 bytes, 3 operations'],
+        self.handler.messages)
+
+  def testNotSampled(self):
+    payload_logger = payload_logging.PayloadLogger(sample_rate=0.0,
+                                                   logger=self.logger)
+    self.assertFalse(payload_logger.StartRequest())
+    payload_logger.mode = payload_logging.MODE_OFF
+    payload_logger.sample_rate = 1.0
+    self.assertFalse(payload_logger.StartRequest())
+    payload_logger.mode = payload_logging.MODE_FULL
+    self.logger.setLevel(logging.WARNING)
+    self.assertFalse(payload_logger.StartRequest())
+    payload_logger.LogIncoming(False, '{}')
+    payload_logger.mode = payload_logging.MODE_DIGEST
+    payload_logger.LogEvents(False, [])
+    self.assertEquals([], self.handler.messages)
+
+  def testLazyFormatting(self):
+    self.logger.setLevel(logging.WARNING)
+    payload_logger = payload_logging.PayloadLogger(logger=self.logger)
+
+    class Unformattable(object):
+      def __len__(self):
+        return 0
+
+      def __str__(self):
+        raise AssertionError('formatted a payload that was not logged')
+
+    payload_logger.LogIncoming(True, Unformattable())
+    self.assertEquals([], self.handler.messages)
+
+
+if __name__ == '__main__':
+  unittest.main()
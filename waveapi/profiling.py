@@ -0,0 +1,195 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc. All Rights Reserved.
+
+"""Collects timings of the requests handled by a robot.
+
+A RequestProfile records the wall time of the phases of a single request and
+of every handler it calls, along with its operation count and payload sizes.
+A Profiler aggregates the profiles of all requests served by an instance and
+runs a sample of them under cProfile.
+"""
+
+
+import gc
+import logging
+import random
+import StringIO
+import time
+
+try:
+  import cProfile
+  import pstats
+except ImportError:
+  cProfile = None
+
+# Number of functions listed in the report of a sampled request.
+PROFILE_LINES = 25
+
+
+class NullProfile(object):
+  """Stands in for a RequestProfile when profiling is disabled."""
+
+  def Mark(self, phase):
+    pass
+
+  def TimeHandler(self, name, handler, *args):
+    return handler(*args)
+
+  def Finish(self):
+    pass
+
+
+NULL_PROFILE = NullProfile()
+
+
+class RequestProfile(object):
+  """Timings and sizes of a single request.
+
+  Phases are consecutive: each one lasts from the end of the previous one,
+  or the creation of the profile, to the call to Mark.
+  """
+
+  def __init__(self, sampled=False):
+    """Starts profiling a request.
+
+    Args:
+      sampled: If True, the request is also run under cProfile and the
+          number of objects it leaves allocated is counted. Only objects
+          tracked by the garbage collector, such as instances, dicts and
+          lists, are counted.
+    """
+    self.phases = []
+    self.handlers = []
+    self.operations = 0
+    self.request_bytes = 0
+    self.response_bytes = 0
+    self.allocated = None
+    self.report = None
+    self._start = time.time()
+    self._last = self._start
+    self._objects = None
+    self._profile = None
+    if sampled:
+      self._objects = len(gc.get_objects())
+      if cProfile is not None:
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+  def Mark(self, phase):
+    """Records the end of a phase."""
+    now = time.time()
+    self.phases.append((phase, now - self._last))
+    self._last = now
+
+  def TimeHandler(self, name, handler, *args):
+    """Calls a handler and records its wall time.
+
+    Args:
+      name: Name of the handler in the profile.
+      handler: The function to call.
+      *args: Arguments for the call.
+
+    Returns:
+      The result of the handler.
+    """
+    start = time.time()
+    try:
+      return handler(*args)
+    finally:
+      self.handlers.append((name, time.time() - start))
+
+  def Finish(self):
+    """Stops profiling the request.
+
+    For sampled requests, this fills in the number of objects allocated and
+    the cProfile report. Calling it again has no effect.
+    """
+    if self._profile is not None:
+      self._profile.disable()
+      stream = StringIO.StringIO()
+      stats = pstats.Stats(self._profile, stream=stream)
+      stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+      self.report = stream.getvalue()
+      self._profile = None
+    if self._objects is not None:
+      self.allocated = len(gc.get_objects()) - self._objects
+      self._objects = None
+
+
+class Profiler(object):
+  """Aggregates the profiles of the requests served by this instance."""
+
+  def __init__(self, sample_rate=0.0):
+    """Initializes the profiler.
+
+    Args:
+      sample_rate: Fraction of the requests that are run under cProfile,
+          whose reports are logged.
+    """
+    self.sample_rate = sample_rate
+    self.Reset()
+
+  def Reset(self):
+    """Forgets all recorded requests."""
+    self._requests = 0
+    self._phases = {}
+    self._handlers = {}
+    self._counters = {}
+
+  def StartRequest(self):
+    """Returns a new RequestProfile, sampled at the sample rate."""
+    return RequestProfile(sampled=random.random() < self.sample_rate)
+
+  def Record(self, profile):
+    """Finishes a RequestProfile and adds it to the aggregates."""
+    profile.Finish()
+    self._requests += 1
+    total = 0.0
+    for phase, seconds in profile.phases:
+      _Add(self._phases, phase, seconds * 1000)
+      total += seconds
+    _Add(self._phases, 'total', total * 1000)
+    for name, seconds in profile.handlers:
+      _Add(self._handlers, name, seconds * 1000)
+    _Add(self._counters, 'operations', profile.operations)
+    _Add(self._counters, 'requestBytes', profile.request_bytes)
+    _Add(self._counters, 'responseBytes', profile.response_bytes)
+    if profile.allocated is not None:
+      _Add(self._counters, 'allocatedObjects', profile.allocated)
+    if profile.report:
+      logging.info('Profile of a sampled request:\n%s', profile.report)
+
+  def GetStats(self):
+    """Returns the aggregates as a dict that can be encoded as JSON.
+
+    Times are in milliseconds. Every aggregate has a count, total, mean and
+    max.
+    """
+    return {
+        'requests': self._requests,
+        'sampleRate': self.sample_rate,
+        'phases': _Summarize(self._phases),
+        'handlers': _Summarize(self._handlers),
+        'counters': _Summarize(self._counters),
+    }
+
+
+def _Add(table, name, value):
+  """Adds a value to the [count, total, max] aggregate of a name."""
+  aggregate = table.get(name)
+  if aggregate is None:
+    table[name] = [1, value, value]
+  else:
+    aggregate[0] += 1
+    aggregate[1] += value
+    aggregate[2] = max(aggregate[2], value)
+
+
+def _Summarize(table):
+  """Returns the aggregates of a table as dicts."""
+  summary = {}
+  for name, (count, total, maximum) in table.iteritems():
+    summary[name] = {'count': count, 'total': total,
+                     'mean': total / float(count), 'max': maximum}
+  return summary
@@ -0,0 +1,76 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc. All Rights Reserved.
+
+"""Unit tests for the profiling module."""
+
+
+import unittest
+
+import profiling
+
+
+class TestRequestProfile(unittest.TestCase):
+  """Tests for the profiling.RequestProfile class."""
+
+  def testPhases(self):
+    profile = profiling.RequestProfile()
+    profile.Mark('parse')
+    profile.Mark('handle')
+    self.assertEquals(['parse', 'handle'],
+                      [phase for phase, _ in profile.phases])
+    for _, seconds in profile.phases:
+      self.assertTrue(seconds >= 0)
+
+  def testTimeHandler(self):
+    profile = profiling.RequestProfile()
+    self.assertEquals(3, profile.TimeHandler('add', lambda a, b: a + b, 1, 2))
+    self.assertRaises(ZeroDivisionError, profile.TimeHandler, 'div',
+                      lambda: 1 / 0)
+    self.assertEquals(['add', 'div'], [name for name, _ in profile.handlers])
+
+  def testSampled(self):
+    profile = profiling.RequestProfile(sampled=True)
+    kept = [[] for _ in range(100)]
+    profile.Finish()
+    self.assertTrue(profile.allocated >= 100)
+    if profiling.cProfile is not None:
+      self.assertTrue('function calls' in profile.report)
+
+  def testNullProfile(self):
+    profiling.NULL_PROFILE.Mark('parse')
+    self.assertEquals(2, profiling.NULL_PROFILE.TimeHandler('h', abs, -2))
+    profiling.NULL_PROFILE.Finish()
+
+
+class TestProfiler(unittest.TestCase):
+  """Tests for the profiling.Profiler class."""
+
+  def MakeProfile(self, operations):
+    profile = profiling.RequestProfile()
+    profile.phases = [('parse', 0.001), ('handle', 0.003)]
+    profile.handlers = [('event:Handler', 0.002)]
+    profile.operations = operations
+    profile.request_bytes = 100
+    return profile
+
+  def testAggregates(self):
+    profiler = profiling.Profiler()
+    self.assertFalse(profiler.StartRequest().report)
+    profiler.Record(self.MakeProfile(1))
+    profiler.Record(self.MakeProfile(3))
+    stats = profiler.GetStats()
+    self.assertEquals(2, stats['requests'])
+    self.assertEquals(2, stats['phases']['parse']['count'])
+    self.assertAlmostEquals(4.0, stats['phases']['total']['max'])
+    self.assertAlmostEquals(2.0, stats['handlers']['event:Handler']['mean'])
+    self.assertEquals({'count': 2, 'total': 4, 'mean': 2.0, 'max': 3},
+                      stats['counters']['operations'])
+    self.assertFalse('allocatedObjects' in stats['counters'])
+
+    profiler.Reset()
+    self.assertEquals(0, profiler.GetStats()['requests'])
+
+
+if __name__ == '__main__':
+  unittest.main()
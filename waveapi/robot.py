@@ -7,13 +7,264 @@
 __author__ = 'davidbyttow@google.com (David Byttow)'
 
 
+import datetime
 import logging
+import time
 import traceback
 
+from google.appengine.api import users
+from google.appengine.ext import db
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp.util import run_wsgi_app
 
+import ops
 import robot_abstract
+import simplejson
+
+# Largest number of entities written by a single datastore put.
+MAX_ENTITIES_PER_PUT = 500
+
+# Seconds that clients may reuse the capabilities and profile documents
+# without checking their ETag again.
+DOCUMENT_MAX_AGE = 300
+
+
+def FlushDeferredWork(context):
+  """Writes the deferred entities of a context and makes its deferred calls.
+
+  Entities are written in batches of up to MAX_ENTITIES_PER_PUT. Deferred
+  work that is deferred again while flushing is flushed as well. Errors are
+  logged so that one failure does not prevent the rest of the work, except
+  that the calls deferred with entities are dropped when one of their puts
+  fails, since they usually depend on the entities having been written.
+
+  Args:
+    context: The Context that the handlers deferred work on.
+  """
+  while True:
+    puts, calls = context.PopDeferredWork()
+    if not puts and not calls:
+      return
+    put_failed = False
+    for start in range(0, len(puts), MAX_ENTITIES_PER_PUT):
+      try:
+        db.put(puts[start:start + MAX_ENTITIES_PER_PUT])
+      except:
+        logging.error(traceback.format_exc())
+        put_failed = True
+    if put_failed:
+      logging.error('Dropped %d deferred calls after a failed put',
+                    len(calls))
+      continue
+    for function, args, kwargs in calls:
+      try:
+        function(*args, **kwargs)
+      except:
+        logging.error(traceback.format_exc())
+
+
+def WriteCachedDocument(handler, content_type, body, etag):
+  """Writes a cacheable document, or a 304 if the client has it already.
+
+  Args:
+    handler: The RequestHandler to respond with.
+    content_type: Content type of the document.
+    body: The document string.
+    etag: Quoted ETag of the document.
+  """
+  handler.response.headers['ETag'] = etag
+  handler.response.headers['Cache-Control'] = (
+      'public, max-age=%d' % DOCUMENT_MAX_AGE)
+  if_none_match = handler.request.headers.get('If-None-Match', '')
+  for tag in if_none_match.split(','):
+    tag = tag.strip()
+    if tag.startswith('W/'):
+      tag = tag[2:]
+    if tag == etag or tag == '*':
+      handler.response.set_status(304)
+      return
+  handler.response.headers['Content-Type'] = content_type
+  handler.response.out.write(body)
+
+
+class WorkItem(db.Model):
+  """Pending work of a CronWorkQueue for a single wavelet.
+
+  Keyed by queue name and wavelet, so that a wavelet has at most one pending
+  item per queue.
+  """
+  queue = db.StringProperty(required=True)
+  wave_id = db.StringProperty()
+  wavelet_id = db.StringProperty()
+  payload = db.TextProperty()
+  attempts = db.IntegerProperty(default=0)
+  created = db.DateTimeProperty(auto_now_add=True)
+
+
+class WorkQueueStats(db.Model):
+  """Counters of a CronWorkQueue, keyed by queue name."""
+  enqueued = db.IntegerProperty(default=0)
+  rejected = db.IntegerProperty(default=0)
+  processed = db.IntegerProperty(default=0)
+  requeued = db.IntegerProperty(default=0)
+  failed = db.IntegerProperty(default=0)
+  ticks = db.IntegerProperty(default=0)
+  last_tick = db.DateTimeProperty()
+  last_lag = db.FloatProperty(default=0.0)
+
+
+class CronWorkQueue(object):
+  """Queue of work in the datastore that is drained by a cron job.
+
+  Event handlers enqueue work for a wavelet when there is more of it than
+  they should do in one request. Every cron tick then processes a bounded
+  slice of the oldest pending items across all wavelets, so each tick costs
+  about the same no matter how much work is pending. Items that are not
+  finished go to the back of the queue.
+
+  Enqueue refuses new items while max_pending items are pending, which is
+  the backpressure on the producers. Counters of the queue are kept in a
+  WorkQueueStats entity and returned by GetStats.
+
+  For example:
+    invites = CronWorkQueue('invites', InviteMore)
+    robot.RegisterCronJob('/_wave/robot/update', 10, invites.RunSlice)
+  """
+
+  def __init__(self, name, process, slice_size=10, max_pending=1000,
+               max_attempts=3):
+    """Initializes the queue.
+
+    Args:
+      name: Name of the queue, unique within the application.
+      process: Function called with the Context of the tick and a WorkItem.
+          It returns True once the item is done; otherwise the item is
+          processed again on a later tick. Exceptions count as failed
+          attempts.
+      slice_size: Maximum number of items processed per tick.
+      max_pending: Maximum number of items pending at once.
+      max_attempts: Number of failed attempts after which an item is
+          dropped.
+    """
+    self.name = name
+    self.process = process
+    self.slice_size = slice_size
+    self.max_pending = max_pending
+    self.max_attempts = max_attempts
+
+  def Enqueue(self, wave_id, wavelet_id, payload=None, context=None):
+    """Adds work for a wavelet, unless it is pending already.
+
+    Args:
+      wave_id: Id of the wave of the wavelet.
+      wavelet_id: Id of the wavelet.
+      payload: Optional text passed along with the item.
+      context: Optional Context to defer the writes on. Without one they
+          are done right away.
+
+    Returns:
+      True if work for the wavelet is pending, False if the queue is full.
+    """
+    key_name = '%s:%s/%s' % (self.name, wave_id, wavelet_id)
+    if WorkItem.get_by_key_name(key_name) is not None:
+      return True
+    query = WorkItem.all(keys_only=True).filter('queue =', self.name)
+    if query.count(self.max_pending) >= self.max_pending:
+      logging.warning('Work queue %s is full', self.name)
+      self._Update(context, rejected=1)
+      return False
+    item = WorkItem(key_name=key_name, queue=self.name, wave_id=wave_id,
+                    wavelet_id=wavelet_id, payload=payload)
+    if context is None:
+      item.put()
+    else:
+      context.DeferPut(item)
+    self._Update(context, enqueued=1)
+    return True
+
+  def RunSlice(self, context):
+    """Processes the oldest slice of pending items.
+
+    The writes are deferred on the context, so they happen once the
+    response has been written.
+
+    Args:
+      context: The Context of the cron request, passed on to the items.
+
+    Returns:
+      The number of items that were done.
+    """
+    start = time.time()
+    now = datetime.datetime.now()
+    items = (WorkItem.all().filter('queue =', self.name).order('created')
+             .fetch(self.slice_size))
+    lag = 0.0
+    if items:
+      age = now - items[0].created
+      lag = age.days * 86400 + age.seconds + age.microseconds / 1e6
+    done = []
+    requeued = []
+    failed = []
+    for item in items:
+      try:
+        finished = self.process(context, item)
+      except:
+        logging.error(traceback.format_exc())
+        item.attempts += 1
+        if item.attempts >= self.max_attempts:
+          failed.append(item)
+          continue
+        finished = False
+      if finished:
+        done.append(item)
+      else:
+        item.created = now
+        requeued.append(item)
+    if done or failed:
+      context.Defer(db.delete, done + failed)
+    context.DeferPut(requeued)
+    self._Update(context, processed=len(done), requeued=len(requeued),
+                 failed=len(failed), ticks=1, last_tick=now, last_lag=lag)
+    logging.info('Work queue %s: %d done, %d requeued, %d failed, '
+                 'lag %.1fs, %.3fs', self.name, len(done), len(requeued),
+                 len(failed), lag, time.time() - start)
+    return len(done)
+
+  def GetStats(self):
+    """Returns a dict of the counters of this queue.
+
+    The number of pending items is counted up to max_pending.
+    """
+    stats = (WorkQueueStats.get_by_key_name(self.name) or
+             WorkQueueStats(key_name=self.name))
+    result = {}
+    for name in WorkQueueStats.properties():
+      result[name] = getattr(stats, name)
+    query = WorkItem.all(keys_only=True).filter('queue =', self.name)
+    result['pending'] = query.count(self.max_pending)
+    return result
+
+  def _Update(self, context, last_tick=None, last_lag=None, **counts):
+    """Adds to the counters of this queue, deferred on a context if given."""
+    if context is not None:
+      context.Defer(self._Update, None, last_tick, last_lag, **counts)
+      return
+
+    def Transaction():
+      stats = (WorkQueueStats.get_by_key_name(self.name) or
+               WorkQueueStats(key_name=self.name))
+      for name, count in counts.items():
+        setattr(stats, name, getattr(stats, name) + count)
+      if last_tick is not None:
+        stats.last_tick = last_tick
+        stats.last_lag = last_lag
+      stats.put()
+
+    try:
+      db.run_in_transaction(Transaction)
+    except db.Error:
+      # The counters are only informational, so contention is not fatal.
+      logging.warning('Could not update the counters of %s', self.name)
 
 
 class RobotCapabilitiesHandler(webapp.RequestHandler):
@@ -25,9 +276,8 @@ class RobotCapabilitiesHandler(webapp.RequestHandler):
 
   def get(self):
     """Handles HTTP GET request."""
-    xml = self._robot.GetCapabilitiesXml()
-    self.response.headers['Content-Type'] = 'text/xml'
-    self.response.out.write(xml)
+    WriteCachedDocument(self, 'text/xml', self._robot.GetCapabilitiesXml(),
+                        self._robot.GetCapabilitiesETag())
 
 
 class RobotProfileHandler(webapp.RequestHandler):
@@ -39,8 +289,9 @@ class RobotProfileHandler(webapp.RequestHandler):
 
   def get(self):
     """Handles HTTP GET request."""
-    self.response.headers['Content-Type'] = 'application/json'
-    self.response.out.write(self._robot.GetProfileJson())
+    WriteCachedDocument(self, 'application/json',
+                        self._robot.GetProfileJson(),
+                        self._robot.GetProfileETag())
 
 
 class RobotEventHandler(webapp.RequestHandler):
@@ -71,20 +322,126 @@ class RobotEventHandler(webapp.RequestHandler):
     if not json_body:
       # TODO(davidbyttow): Log error?
       return
-    logging.info('Incoming: ' + json_body)
+    payload_logger = self._robot.payload_logger
+    sampled = payload_logger.StartRequest()
+    payload_logger.LogIncoming(sampled, json_body)
+    profile = self._robot.StartProfile()
+    try:
+      # Bundles without subscribed events are answered with an empty bundle,
+      # without decoding them or building their context.
+      event_types = self._robot.GetSubscribedEventTypes()
+      if robot_abstract.MayContainEvents(json_body, event_types):
+        data = robot_abstract.DecodeJSONBody(json_body)
+        profile.Mark('parse')
+        context, events = robot_abstract.CreateContextAndEvents(data,
+                                                                event_types)
+      else:
+        profile.Mark('parse')
+        context, events = ops.CreateEmptyContext(), []
+      profile.Mark('context')
+      payload_logger.LogEvents(sampled, events)
+      coalesced = set()
+      for event in events:
+        try:
+          self._robot.HandleEvent(event, context, coalesced, profile)
+        except:
+          logging.error(traceback.format_exc())
+      profile.Mark('handle')
 
-    context, events = robot_abstract.ParseJSONBody(json_body)
-    for event in events:
-      try:
-        self._robot.HandleEvent(event, context)
-      except:
-        logging.error(traceback.format_exc())
+      # Build the response. The operations are encoded straight into the
+      # response stream, which makes the serialize and write phases one.
+      self.response.headers['Content-Type'] = 'application/json'
+      out = self.response.out
+      start = out.tell()
+      robot_abstract.WriteContext(context, out)
+      response_bytes = out.tell() - start
+      profile.Mark('serialize')
+      if sampled:
+        payload_logger.LogOutgoing(sampled, out.getvalue()[start:],
+                                   context.GetOperationCount())
+      profile.Mark('write')
+
+      # The operations do not depend on the deferred work, so it is done once
+      # the response is complete.
+      FlushDeferredWork(context)
+      profile.Mark('deferred')
+
+      profile.operations = context.GetOperationCount()
+      profile.request_bytes = len(json_body)
+      profile.response_bytes = response_bytes
+      self._robot.RecordProfile(profile)
+    finally:
+      # Stops cProfile when the request fails before it is recorded.
+      profile.Finish()
+
+
+class RobotStatsHandler(webapp.RequestHandler):
+  """Handler for serving the profiling statistics of a robot.
+
+  Only served once profiling is enabled, and only to administrators of the
+  application. The statistics cover the requests served by the instance that
+  answers, since the last reset.
+  """
+
+  def __init__(self, robot):
+    """Initializes this handler with a specific robot."""
+    self._robot = robot
+
+  def get(self):
+    """Handles HTTP GET requests."""
+    self._ServeStats(reset=False)
+
+  def post(self):
+    """Handles HTTP POST requests. Resets the statistics once served."""
+    self._ServeStats(reset=True)
+
+  def _ServeStats(self, reset):
+    """Writes the statistics as JSON, or a 403 to users who are not admins."""
+    if not users.is_current_user_admin():
+      self.error(403)
+      return
+    stats = self._robot.profiler.GetStats()
+    stats['coalescedHits'] = self._robot.GetCoalescedHits()
+    if reset:
+      self._robot.profiler.Reset()
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(simplejson.dumps(stats))
+
+
+class RobotCronHandler(webapp.RequestHandler):
+  """Handler for the cron jobs of a robot.
+
+  Calls the handler registered for the cron path with the context of the
+  request. The wave server may send a context along with the tick, like it
+  does with events; otherwise the context is empty. Operations created by
+  the handler are sent back in the response.
+  """
+
+  def __init__(self, robot, handler):
+    """Initializes self with a specific robot and cron handler."""
+    self._robot = robot
+    self._handler = handler
+
+  def get(self):
+    """Handles HTTP GET requests."""
+    self.post()
+
+  def post(self):
+    """Handles HTTP POST requests."""
+    json_body = self.request.body
+    if json_body:
+      context, _ = robot_abstract.ParseJSONBody(json_body)
+    else:
+      context = ops.CreateEmptyContext()
+    try:
+      self._handler(context)
+    except:
+      logging.error(traceback.format_exc())
 
     json_response = robot_abstract.SerializeContext(context)
-    # Build the response.
-    logging.info('Outgoing: ' + json_response)
     self.response.headers['Content-Type'] = 'application/json'
     self.response.out.write(json_response)
+    FlushDeferredWork(context)
 
 
 class Robot(robot_abstract.Robot):
@@ -93,7 +450,9 @@ class Robot(robot_abstract.Robot):
   A robot is typically setup in the following steps:
     1. Instantiate and define robot.
     2. Register various handlers that it is interested in.
-    3. Call Run, which will setup the handlers for the app.
+    3. Optionally, call EnableProfiling to serve /_wave/robot/stats to the
+       administrators of the application.
+    4. Call Run, which will setup the handlers for the app.
 
   For example:
     robot = Robot('Terminator',
@@ -110,12 +469,26 @@ class Robot(robot_abstract.Robot):
       debug: Optional variable that defaults to False and is passed through
           to the webapp application to determine if it should show debug info.
     """
+    run_wsgi_app(self.CreateApplication(debug))
+
+  def CreateApplication(self, debug=False):
+    """Returns the webapp application serving the handlers of this robot.
+
+    Args:
+      debug: Whether the application shows debug info.
+    """
     # App Engine expects to construct a class with no arguments, so we
     # pass a lambda that constructs the appropriate handler with
     # arguments from the enclosing scope.
-    app = webapp.WSGIApplication([
+    handlers = [
         ('/_wave/capabilities.xml', lambda: RobotCapabilitiesHandler(self)),
         ('/_wave/robot/profile', lambda: RobotProfileHandler(self)),
         ('/_wave/robot/jsonrpc', lambda: RobotEventHandler(self)),
-    ], debug=debug)
-    run_wsgi_app(app)
+    ]
+    if self.profiler is not None:
+      handlers.append(
+          ('/_wave/robot/stats', lambda: RobotStatsHandler(self)))
+    for path, handler in self.GetCronHandlers().items():
+      handlers.append(
+          (path, lambda handler=handler: RobotCronHandler(self, handler)))
+    return webapp.WSGIApplication(handlers, debug=debug)
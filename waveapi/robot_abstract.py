@@ -10,26 +10,108 @@ as well as some helper functions for web requests and responses.
 
 __author__ = 'davidbyttow@google.com (David Byttow)'
 
+import hashlib
+import logging
+import StringIO
+
 import model
 import ops
+import payload_logging
+import profiling
 import simplejson
 import util
 
 
-def ParseJSONBody(json_body):
-  """Parse a JSON string and return a context and an event list."""
-  json = simplejson.loads(json_body)
-  # TODO(davidbyttow): Remove this once no longer needed.
-  data = util.CollapseJavaCollections(json)
+def DecodeJSONBody(json_body):
+  """Decodes a JSON string into the raw data of a context and events."""
+  # TODO(davidbyttow): Remove the collapsing once no longer needed.
+  return simplejson.loads(json_body,
+                          object_hook=util.CollapseJavaCollectionsHook)
+
+
+def MayContainEvents(json_body, event_types):
+  """Returns whether a JSON body may hold events of the given types.
+
+  Event types are plain identifiers that the server never escapes, so a body
+  that does not mention a type as a JSON string cannot hold an event of that
+  type. This is checked without decoding the body.
+
+  Args:
+    json_body: The JSON string sent by the server.
+    event_types: A collection of event types, or None for all of them.
+  """
+  if event_types is None:
+    return True
+  for event_type in event_types:
+    if '"%s"' % event_type in json_body:
+      return True
+  return False
+
+
+def CreateContextAndEvents(data, event_types=None):
+  """Returns a context and an event list built from decoded raw data.
+
+  Args:
+    data: Raw data decoded from JSON sent by the server.
+    event_types: Optional collection of the event types to build events for.
+        Other events are dropped without being built, and if no event is
+        left, an empty context is returned without building the blips and
+        wavelets of the data.
+  """
+  raw_events = data['events']
+  if event_types is not None:
+    raw_events = [event_data for event_data in raw_events
+                  if event_data['type'] in event_types]
+    if not raw_events:
+      return ops.CreateEmptyContext(), []
   context = ops.CreateContext(data)
-  events = [model.CreateEvent(event_data) for event_data in data['events']]
+  events = [model.CreateEvent(event_data) for event_data in raw_events]
   return context, events
 
 
-def SerializeContext(context):
-  """Return a JSON string representing the given context."""
-  context_dict = util.Serialize(context)
-  return simplejson.dumps(context_dict)
+def ParseJSONBody(json_body, event_types=None):
+  """Parse a JSON string and return a context and an event list.
+
+  Args:
+    json_body: The JSON string sent by the server.
+    event_types: Optional collection of the event types to build events for,
+        see CreateContextAndEvents. A body that cannot hold any of them is
+        not decoded at all.
+  """
+  if not MayContainEvents(json_body, event_types):
+    return ops.CreateEmptyContext(), []
+  return CreateContextAndEvents(DecodeJSONBody(json_body), event_types)
+
+
+def WriteContext(context, out, compact=True):
+  """Writes the JSON representing the given context to a stream.
+
+  The operations are encoded one at a time, see ops.WriteOperationBundle.
+
+  Args:
+    context: The Context to serialize.
+    out: A file-like object to write to, such as the response stream.
+    compact: Optional flag that defaults to True. If set, the operations of
+        the context are compacted first, see ops.CompactOperations.
+  """
+  if compact:
+    removed = context.CompactOperations()
+    if removed:
+      logging.info('Compacted away %d operations', removed)
+  context.WriteJson(out)
+
+
+def SerializeContext(context, compact=True):
+  """Return a JSON string representing the given context.
+
+  Args:
+    context: The Context to serialize.
+    compact: Optional flag that defaults to True. If set, the operations of
+        the context are compacted first, see ops.CompactOperations.
+  """
+  out = StringIO.StringIO()
+  WriteContext(context, out, compact)
+  return out.getvalue()
 
 
 class RobotListener(object):
@@ -79,17 +161,29 @@ class Robot(object):
   This class holds on to basic robot information like the name and profile.
   It also maintains the list of event handlers and cron jobs and
   dispatches events to the appropriate handlers.
+
+  The capabilities and profile documents are rendered once along with a
+  strong ETag, and rendered again after a handler or cron job is registered
+  or the name or urls of the robot are changed.
   """
 
   def __init__(self, name, image_url='', profile_url=''):
     """Initializes self with robot information."""
     self._handlers = {}
+    self._coalesced_handlers = set()
+    self._dispatch = {}
+    self._subscribed = frozenset()
+    self._coalesced_hits = {}
     self.name = name
     self.image_url = image_url
     self.profile_url = profile_url
     self.cron_jobs = []
+    self.payload_logger = payload_logging.PayloadLogger()
+    self.profiler = None
+    self._cron_handlers = {}
+    self._documents = {}
 
-  def RegisterHandler(self, event_type, handler):
+  def RegisterHandler(self, event_type, handler, coalesce=False):
     """Registers a handler on a specific event type.
 
     Multiple handlers may be registered on a single event type and are
@@ -105,22 +199,137 @@ class Robot(object):
       event_type: An event type to listen for.
       handler: A function handler which takes two arguments, event properties
           and the Context of this session.
+      coalesce: Optional flag that defaults to False. If True, the handler is
+          called only once per bundle for each event type, no matter how
+          many events of that type the bundle holds. Only suitable for
+          idempotent handlers that do not depend on the event properties.
     """
     self._handlers.setdefault(event_type, []).append(handler)
+    self._documents.clear()
+    if coalesce:
+      self._coalesced_handlers.add((event_type, handler))
+    self._dispatch[event_type] = tuple([
+        (h, (event_type, h) in self._coalesced_handlers,
+         '%s:%s' % (event_type, getattr(h, '__name__', h)))
+        for h in self._handlers[event_type]])
+    self._subscribed = frozenset(self._handlers)
+
+  def GetSubscribedEventTypes(self):
+    """Returns a frozenset of the event types that have handlers."""
+    return self._subscribed
+
+  def RegisterCronJob(self, path, seconds, handler=None):
+    """Registers a cron job to surface in capabilities.xml.
 
-  def RegisterCronJob(self, path, seconds):
-    """Registers a cron job to surface in capabilities.xml."""
+    Args:
+      path: Path that the wave server requests on every tick.
+      seconds: Number of seconds between ticks.
+      handler: Optional function called on every tick with the Context of
+          the request. Without one, the path has to be served separately.
+    """
     self.cron_jobs.append((path, seconds))
+    if handler is not None:
+      self._cron_handlers[path] = handler
+    self._documents.clear()
+
+  def GetCronHandlers(self):
+    """Returns a dict of cron job path to the handler registered for it."""
+    return dict(self._cron_handlers)
+
+  def EnableProfiling(self, sample_rate=0.0):
+    """Starts recording timings of the requests handled by this robot.
+
+    Args:
+      sample_rate: Optional fraction of the requests, defaulting to none,
+          that are also run under cProfile.
+    """
+    self.profiler = profiling.Profiler(sample_rate)
+
+  def StartProfile(self):
+    """Returns a profile for a new request, a no-op one if not enabled."""
+    if self.profiler is None:
+      return profiling.NULL_PROFILE
+    return self.profiler.StartRequest()
 
-  def HandleEvent(self, event, context):
-    """Calls all of the handlers associated with an event."""
-    for handler in self._handlers.get(event.type, []):
+  def RecordProfile(self, profile):
+    """Adds the profile of a finished request to the aggregates."""
+    if self.profiler is not None and profile is not profiling.NULL_PROFILE:
+      self.profiler.Record(profile)
+
+  def HandleEvent(self, event, context, coalesced=None, profile=None):
+    """Calls all of the handlers associated with an event.
+
+    Args:
+      event: The Event to dispatch.
+      context: The Context of this session.
+      coalesced: Optional set shared by all events of a bundle. Handlers
+          registered with coalesce=True are skipped if they already ran for
+          an event of the same type in this bundle. Since a bundle carries a
+          single wavelet, this collapses duplicates per wavelet.
+      profile: Optional RequestProfile that records the time of each
+          handler.
+    """
+    for handler, coalesce, name in self._dispatch.get(event.type, ()):
+      if coalesce and coalesced is not None:
+        if (event.type, handler) in coalesced:
+          self._coalesced_hits[event.type] = (
+              self._coalesced_hits.get(event.type, 0) + 1)
+          continue
+        coalesced.add((event.type, handler))
       # TODO(jacobly): pass the event in to the handlers directly
       # instead of passing the properties dictionary.
-      handler(event.properties, context)
+      if profile is None:
+        handler(event.properties, context)
+      else:
+        profile.TimeHandler(name, handler, event.properties, context)
+
+  def GetCoalescedHits(self):
+    """Returns a dict of event type to the number of handler calls skipped."""
+    return dict(self._coalesced_hits)
+
+  def _GetDocument(self, name, render):
+    """Returns a rendered document and its ETag, rendering it if needed.
+
+    Args:
+      name: Name of the document in the cache.
+      render: Function that renders the document.
+
+    Returns:
+      A tuple of the document string and its quoted ETag.
+    """
+    key = (self.name, self.image_url, self.profile_url)
+    cached = self._documents.get(name)
+    if cached is None or cached[0] != key:
+      body = render()
+      data = body
+      if isinstance(data, unicode):
+        data = data.encode('utf-8')
+      cached = (key, body, '"%s"' % hashlib.sha1(data).hexdigest())
+      self._documents[name] = cached
+    return cached[1], cached[2]
 
   def GetCapabilitiesXml(self):
     """Return this robot's capabilities as an XML string."""
+    return self._GetDocument('capabilities', self._RenderCapabilitiesXml)[0]
+
+  def GetCapabilitiesETag(self):
+    """Returns the ETag of the capabilities XML."""
+    return self._GetDocument('capabilities', self._RenderCapabilitiesXml)[1]
+
+  def GetProfileJson(self):
+    """Returns JSON body for any profile handler.
+
+    Returns:
+      String of JSON to be sent as a response.
+    """
+    return self._GetDocument('profile', self._RenderProfileJson)[0]
+
+  def GetProfileETag(self):
+    """Returns the ETag of the profile JSON."""
+    return self._GetDocument('profile', self._RenderProfileJson)[1]
+
+  def _RenderCapabilitiesXml(self):
+    """Renders this robot's capabilities as an XML string."""
     lines = ['<w:capabilities>']
     for capability in self._handlers:
       lines.append('  <w:capability name="%s"/>' % capability)
@@ -142,12 +351,8 @@ class Robot(object):
             '<w:robot xmlns:w="http://wave.google.com/extensions/robots/1.0">\n'
             '%s\n</w:robot>\n') % ('\n'.join(lines))
 
-  def GetProfileJson(self):
-    """Returns JSON body for any profile handler.
-
-    Returns:
-      String of JSON to be sent as a response.
-    """
+  def _RenderProfileJson(self):
+    """Renders the JSON body of the profile handler."""
     data = {}
     data['name'] = self.name
     data['imageUrl'] = self.image_url
@@ -8,6 +8,7 @@ __author__ = 'jacobly@google.com (Jacob Lee)'
 
 import unittest
 
+import model
 import robot_abstract
 
 DEBUG_DATA = r'{"blips":{"map":{"wdykLROk*13":{"lastModifiedTime":1242079608457,"contributors":{"javaClass":"java.util.ArrayList","list":["davidbyttow@google.com"]},"waveletId":"conv+root","waveId":"wdykLROk*11","parentBlipId":null,"version":3,"creator":"davidbyttow@google.com","content":"\n","blipId":"wdykLROk*13","javaClass":"com.google.wave.api.impl.BlipData","annotations":{"javaClass":"java.util.ArrayList","list":[{"range":{"start":0,"javaClass":"com.google.wave.api.Range","end":1},"name":"user/e/davidbyttow@google.com","value":"David","javaClass":"com.google.wave.api.Annotation"}]},"elements":{"map":{},"javaClass":"java.util.HashMap"},"childBlipIds":{"javaClass":"java.util.ArrayList","list":[]}}},"javaClass":"java.util.HashMap"},"events":{"javaClass":"java.util.ArrayList","list":[{"timestamp":1242079611003,"modifiedBy":"davidbyttow@google.com","javaClass":"com.google.wave.api.impl.EventData","properties":{"map":{"participantsRemoved":{"javaClass":"java.util.ArrayList","list":[]},"participantsAdded":{"javaClass":"java.util.ArrayList","list":["monty@appspot.com"]}},"javaClass":"java.util.HashMap"},"type":"WAVELET_PARTICIPANTS_CHANGED"}]},"wavelet":{"lastModifiedTime":1242079611003,"title":"","waveletId":"conv+root","rootBlipId":"wdykLROk*13","javaClass":"com.google.wave.api.impl.WaveletData","dataDocuments":null,"creationTime":1242079608457,"waveId":"wdykLROk*11","participants":{"javaClass":"java.util.ArrayList","list":["davidbyttow@google.com","monty@appspot.com"]},"creator":"davidbyttow@google.com","version":5}}'
@@ -34,6 +35,35 @@ class TestHelpers(unittest.TestCase):
                       'participantsAdded': ['monty@appspot.com']},
                      event.properties)
 
+  def testParseJSONBodySubscribedEvents(self):
+    context, events = robot_abstract.ParseJSONBody(
+        DEBUG_DATA, frozenset(['WAVELET_PARTICIPANTS_CHANGED']))
+    self.assertEqual(1, len(context.GetBlips()))
+    self.assertEqual(['WAVELET_PARTICIPANTS_CHANGED'],
+                     [event.type for event in events])
+
+  def testParseJSONBodyUnsubscribedEvents(self):
+    for event_types in (frozenset(), frozenset(['BLIP_SUBMITTED'])):
+      context, events = robot_abstract.ParseJSONBody(DEBUG_DATA, event_types)
+      self.assertEqual([], events)
+      self.assertEqual([], context.GetBlips())
+      self.assertEqual([], context.GetWavelets())
+
+    # Mentioned in the body, but not as the type of an event.
+    body = DEBUG_DATA.replace('"title":""', '"title":"BLIP_SUBMITTED"')
+    context, events = robot_abstract.ParseJSONBody(
+        body, frozenset(['BLIP_SUBMITTED']))
+    self.assertEqual([], events)
+    self.assertEqual([], context.GetWavelets())
+
+  def testMayContainEvents(self):
+    self.assertTrue(robot_abstract.MayContainEvents(DEBUG_DATA, None))
+    self.assertTrue(robot_abstract.MayContainEvents(
+        DEBUG_DATA, ['BLIP_SUBMITTED', 'WAVELET_PARTICIPANTS_CHANGED']))
+    self.assertFalse(robot_abstract.MayContainEvents(DEBUG_DATA, []))
+    self.assertFalse(robot_abstract.MayContainEvents(DEBUG_DATA,
+                                                     ['WAVELET']))
+
   def testSerializeContextSansOps(self):
     context, _ = robot_abstract.ParseJSONBody(DEBUG_DATA)
     serialized = robot_abstract.SerializeContext(context)
@@ -56,6 +86,86 @@ class TestHelpers(unittest.TestCase):
         serialized)
 
 
+class TestHandleEvent(unittest.TestCase):
+  """Tests for dispatching events to registered handlers."""
+
+  def setUp(self):
+    self.robot = robot_abstract.Robot('Testy')
+    self.calls = []
+
+  def MakeEvent(self, event_type):
+    event = model.Event()
+    event.type = event_type
+    return event
+
+  def Handler(self, properties, context):
+    self.calls.append('handler')
+
+  def CoalescedHandler(self, properties, context):
+    self.calls.append('coalesced')
+
+  def testHandlersCalledInOrder(self):
+    self.robot.RegisterHandler('myevent', self.Handler)
+    self.robot.RegisterHandler('myevent', self.CoalescedHandler)
+    self.robot.HandleEvent(self.MakeEvent('myevent'), None)
+    self.robot.HandleEvent(self.MakeEvent('otherevent'), None)
+    self.assertEquals(['handler', 'coalesced'], self.calls)
+
+  def testCoalesceWithinBundle(self):
+    self.robot.RegisterHandler('myevent', self.Handler)
+    self.robot.RegisterHandler('myevent', self.CoalescedHandler, coalesce=True)
+    coalesced = set()
+    for _ in range(3):
+      self.robot.HandleEvent(self.MakeEvent('myevent'), None, coalesced)
+    self.assertEquals(['handler', 'coalesced', 'handler', 'handler'],
+                      self.calls)
+    self.assertEquals({'myevent': 2}, self.robot.GetCoalescedHits())
+
+    # A new bundle gets a fresh set and calls the handler again.
+    self.robot.HandleEvent(self.MakeEvent('myevent'), None, set())
+    self.assertEquals(2, self.calls.count('coalesced'))
+
+  def testCoalescePerEventType(self):
+    self.robot.RegisterHandler('myevent', self.CoalescedHandler, coalesce=True)
+    self.robot.RegisterHandler('otherevent', self.CoalescedHandler,
+                               coalesce=True)
+    coalesced = set()
+    self.robot.HandleEvent(self.MakeEvent('myevent'), None, coalesced)
+    self.robot.HandleEvent(self.MakeEvent('otherevent'), None, coalesced)
+    self.assertEquals(['coalesced', 'coalesced'], self.calls)
+    self.assertEquals({}, self.robot.GetCoalescedHits())
+
+  def testProfileHandlers(self):
+    self.robot.EnableProfiling()
+    self.robot.RegisterHandler('myevent', self.Handler)
+    profile = self.robot.StartProfile()
+    self.robot.HandleEvent(self.MakeEvent('myevent'), None, None, profile)
+    self.assertEquals(['handler'], self.calls)
+    self.assertEquals(['myevent:Handler'],
+                      [name for name, _ in profile.handlers])
+    self.robot.RecordProfile(profile)
+    self.assertEquals(1, self.robot.profiler.GetStats()['requests'])
+
+  def testProfilingDisabled(self):
+    profile = self.robot.StartProfile()
+    self.robot.RecordProfile(profile)
+    self.assertEquals(None, self.robot.profiler)
+
+  def testSubscribedEventTypes(self):
+    self.assertEquals(frozenset(), self.robot.GetSubscribedEventTypes())
+    self.robot.RegisterHandler('myevent', self.Handler)
+    self.robot.RegisterHandler('myevent', self.CoalescedHandler)
+    self.robot.RegisterHandler('otherevent', self.Handler)
+    self.assertEquals(frozenset(['myevent', 'otherevent']),
+                      self.robot.GetSubscribedEventTypes())
+
+  def testNoCoalescingWithoutBundleSet(self):
+    self.robot.RegisterHandler('myevent', self.CoalescedHandler, coalesce=True)
+    self.robot.HandleEvent(self.MakeEvent('myevent'), None)
+    self.robot.HandleEvent(self.MakeEvent('myevent'), None)
+    self.assertEquals(['coalesced', 'coalesced'], self.calls)
+
+
 class TestGetCapabilitiesXml(unittest.TestCase):
 
   def setUp(self):
@@ -104,6 +214,53 @@ class TestGetCapabilitiesXml(unittest.TestCase):
     xml = self.robot.GetCapabilitiesXml()
     self.assertStringsEqual(expected, xml)
 
+  def testCronHandlers(self):
+    handler = lambda context: None
+    self.robot.RegisterCronJob('/ping', 20)
+    self.robot.RegisterCronJob('/tick', 10, handler)
+    self.assertEquals({'/tick': handler}, self.robot.GetCronHandlers())
+    self.assertTrue('<w:cron path="/tick" timerinseconds="10"/>' in
+                    self.robot.GetCapabilitiesXml())
+
+
+class TestCachedDocuments(unittest.TestCase):
+  """Tests for caching the capabilities and profile documents."""
+
+  def setUp(self):
+    self.robot = robot_abstract.Robot('Testy')
+
+  def testRenderedOnce(self):
+    xml = self.robot.GetCapabilitiesXml()
+    self.assertTrue(xml is self.robot.GetCapabilitiesXml())
+    profile = self.robot.GetProfileJson()
+    self.assertTrue(profile is self.robot.GetProfileJson())
+
+  def testETags(self):
+    etag = self.robot.GetCapabilitiesETag()
+    self.assertTrue(etag.startswith('"') and etag.endswith('"'))
+    self.assertEquals(etag, self.robot.GetCapabilitiesETag())
+    self.assertNotEquals(etag, self.robot.GetProfileETag())
+    other = robot_abstract.Robot('Testy')
+    self.assertEquals(etag, other.GetCapabilitiesETag())
+
+  def testInvalidatedOnRegistration(self):
+    etag = self.robot.GetCapabilitiesETag()
+    self.robot.RegisterHandler('myevent', None)
+    self.assertTrue('myevent' in self.robot.GetCapabilitiesXml())
+    handler_etag = self.robot.GetCapabilitiesETag()
+    self.assertNotEquals(etag, handler_etag)
+    self.robot.RegisterCronJob('/ping', 20)
+    self.assertTrue('/ping' in self.robot.GetCapabilitiesXml())
+    self.assertNotEquals(handler_etag, self.robot.GetCapabilitiesETag())
+
+  def testInvalidatedOnProfileChange(self):
+    etag = self.robot.GetProfileETag()
+    self.robot.image_url = 'http://example.com/image.png'
+    self.assertTrue('image.png' in self.robot.GetProfileJson())
+    self.assertNotEquals(etag, self.robot.GetProfileETag())
+    self.robot.name = u'Test\xe9'
+    self.assertTrue(u'Test\xe9' in self.robot.GetCapabilitiesXml())
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc. All Rights Reserved.
+
+"""Measures the request path of a robot, one stage at a time.
+
+Replays a fixed corpus of generated bundles through ParseJSONBody, the
+handlers of a robot and SerializeContext, which is what the robot endpoint
+does for every request, and reports the throughput and the p50/p99 latency
+of every stage. Run it before and after touching any of them.
+"""
+
+
+import time
+
+import benchmark
+import document
+import events
+import robot_abstract
+
+# Bundles replayed, as (num_blips, num_annotations, num_events) tuples.
+CORPUS = [
+    (1, 0, 1),
+    (10, 5, 1),
+    (10, 5, 10),
+    (100, 10, 5),
+    (500, 20, 5),
+]
+NUM_REQUESTS = 200
+
+
+def OnDocumentChanged(properties, context):
+  """Edits the blip that changed the way a typical robot does."""
+  blip = context.GetBlipById(properties['blipId'])
+  doc = blip.GetDocument()
+  doc.AppendText('\nseen')
+  doc.SetAnnotation(document.Range(0, 4), 'robot/seen', 'true')
+  blip.CreateChild().GetDocument().SetText('reply')
+
+
+def MakeRobot():
+  """Returns the robot whose handlers are run by the benchmark."""
+  robot = robot_abstract.Robot('Benchmark')
+  robot.RegisterHandler(events.DOCUMENT_CHANGED, OnDocumentChanged)
+  return robot
+
+
+def RunRequest(robot, json_body):
+  """Runs a request through every stage.
+
+  Returns:
+    A list of the wall times of the parse, handle and serialize stages.
+  """
+  start = time.time()
+  context, event_list = robot_abstract.ParseJSONBody(
+      json_body, robot.GetSubscribedEventTypes())
+  parsed = time.time()
+  for event in event_list:
+    robot.HandleEvent(event, context)
+  handled = time.time()
+  robot_abstract.SerializeContext(context)
+  serialized = time.time()
+  return [parsed - start, handled - parsed, serialized - handled]
+
+
+def RunBenchmarks():
+  """Runs the request path benchmarks and prints the results."""
+  robot = MakeRobot()
+  for num_blips, num_annotations, num_events in CORPUS:
+    json_body = benchmark.MakeWireBundle(num_blips, num_annotations,
+                                         num_events)
+    RunRequest(robot, json_body)
+    stages = [[], [], [], []]
+    for _ in range(NUM_REQUESTS):
+      timings = RunRequest(robot, json_body)
+      timings.append(sum(timings))
+      for samples, seconds in zip(stages, timings):
+        samples.append(seconds)
+    print '%d blips, %d annotations, %d events (%d bytes)' % (
+        num_blips, num_annotations, num_events, len(json_body))
+    for name, samples in zip(('parse', 'handle', 'serialize', 'total'),
+                             stages):
+      benchmark.ReportLatencies('  ' + name, samples)
+
+
+if __name__ == '__main__':
+  RunBenchmarks()
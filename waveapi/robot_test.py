@@ -0,0 +1,392 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc. All Rights Reserved.
+
+"""Unit tests for the robot module.
+
+These tests run against the datastore and memcache stubs of the App Engine
+SDK vendored next to this package.
+"""
+
+
+import logging
+import os
+import sys
+import unittest
+
+SDK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        os.pardir, 'google_appengine')
+sys.path.extend([SDK_PATH,
+                 os.path.join(SDK_PATH, 'lib', 'webob'),
+                 os.path.join(SDK_PATH, 'lib', 'yaml', 'lib')])
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore_file_stub
+from google.appengine.api.memcache import memcache_stub
+from google.appengine.ext import db
+from google.appengine.ext import webapp
+
+import events
+import ops
+import payload_logging
+import robot
+import simplejson
+
+APP_ID = 'test-robot'
+
+
+class Note(db.Model):
+  text = db.StringProperty()
+
+
+class ListHandler(logging.Handler):
+  """Keeps the formatted messages of the records it handles."""
+
+  def __init__(self):
+    logging.Handler.__init__(self)
+    self.messages = []
+
+  def emit(self, record):
+    self.messages.append(record.getMessage())
+
+
+class StubTestCase(unittest.TestCase):
+  """Runs each test against empty datastore and memcache stubs."""
+
+  def setUp(self):
+    os.environ['APPLICATION_ID'] = APP_ID
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    apiproxy_stub_map.apiproxy.RegisterStub(
+        'datastore_v3',
+        datastore_file_stub.DatastoreFileStub(APP_ID, '/dev/null',
+                                              '/dev/null'))
+    apiproxy_stub_map.apiproxy.RegisterStub(
+        'memcache', memcache_stub.MemcacheServiceStub())
+
+
+class TestFlushDeferredWork(StubTestCase):
+
+  def setUp(self):
+    StubTestCase.setUp(self)
+    self.calls = []
+    self.put = db.put
+
+  def tearDown(self):
+    db.put = self.put
+
+  def CountNotes(self):
+    self.calls.append(Note.all().count())
+
+  def testPutsBeforeCalls(self):
+    context = ops.CreateEmptyContext()
+    context.DeferPut([Note(text='a'), Note(text='b')])
+    context.Defer(self.CountNotes)
+    robot.FlushDeferredWork(context)
+    self.assertEqual([2], self.calls)
+
+  def testWorkDeferredWhileFlushing(self):
+    context = ops.CreateEmptyContext()
+    context.Defer(context.DeferPut, Note(text='a'))
+    context.Defer(context.Defer, self.CountNotes)
+    robot.FlushDeferredWork(context)
+    self.assertEqual([1], self.calls)
+
+  def testCallsDroppedWhenPutFails(self):
+    def FailingPut(entities):
+      raise db.Error('put failed')
+    db.put = FailingPut
+    context = ops.CreateEmptyContext()
+    context.DeferPut(Note(text='a'))
+    context.Defer(self.CountNotes)
+    robot.FlushDeferredWork(context)
+    self.assertEqual([], self.calls)
+
+  def testCallsWithoutPuts(self):
+    context = ops.CreateEmptyContext()
+    context.Defer(self.CountNotes)
+    robot.FlushDeferredWork(context)
+    self.assertEqual([0], self.calls)
+
+
+class TestDocumentHandlers(StubTestCase):
+
+  def setUp(self):
+    StubTestCase.setUp(self)
+    self.robot = robot.Robot('Testy', image_url='http://testy.com/icon.png',
+                             profile_url='http://testy.com/')
+    self.app = self.robot.CreateApplication()
+
+  def Get(self, path, if_none_match=None):
+    request = webapp.Request.blank(path)
+    if if_none_match is not None:
+      request.headers['If-None-Match'] = if_none_match
+    return request.get_response(self.app)
+
+  def testCapabilities(self):
+    response = self.Get('/_wave/capabilities.xml')
+    self.assertEqual(200, response.status_int)
+    self.assertEqual(self.robot.GetCapabilitiesXml(), response.body)
+    self.assertEqual(self.robot.GetCapabilitiesETag(),
+                     response.headers['ETag'])
+    self.assertTrue(response.headers['Content-Type'].startswith('text/xml'))
+
+  def testProfile(self):
+    response = self.Get('/_wave/robot/profile')
+    self.assertEqual(200, response.status_int)
+    self.assertEqual(self.robot.GetProfileJson(), response.body)
+    self.assertEqual(self.robot.GetProfileETag(), response.headers['ETag'])
+    self.assertTrue('Testy' in response.body)
+
+  def testNotModified(self):
+    etag = self.robot.GetProfileETag()
+    response = self.Get('/_wave/robot/profile', etag)
+    self.assertEqual(304, response.status_int)
+    self.assertEqual('', response.body)
+    response = self.Get('/_wave/capabilities.xml', 'W/%s, "other"' %
+                        self.robot.GetCapabilitiesETag())
+    self.assertEqual(304, response.status_int)
+
+  def testModified(self):
+    response = self.Get('/_wave/capabilities.xml', '"stale"')
+    self.assertEqual(200, response.status_int)
+    self.assertEqual(self.robot.GetCapabilitiesXml(), response.body)
+
+
+class TestEventHandler(StubTestCase):
+
+  def setUp(self):
+    StubTestCase.setUp(self)
+    self.robot = robot.Robot('Testy')
+    self.robot.RegisterHandler(events.BLIP_SUBMITTED, lambda *args: None)
+    self.app = self.robot.CreateApplication()
+
+  def Post(self, body):
+    request = webapp.Request.blank('/_wave/robot/jsonrpc')
+    request.method = 'POST'
+    request.body = body
+    return request.get_response(self.app)
+
+  def testProfileFinishedOnError(self):
+    self.robot.EnableProfiling(sample_rate=1.0)
+    response = self.Post('{"events": [{"type": "%s"' % events.BLIP_SUBMITTED)
+    self.assertEqual(500, response.status_int)
+    self.assertEqual(None, sys.getprofile())
+    self.assertEqual(0, self.robot.profiler.GetStats()['requests'])
+
+  def testPayloadLoggedOnError(self):
+    logger = logging.getLogger('robot_test')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = ListHandler()
+    logger.addHandler(handler)
+    self.robot.payload_logger = payload_logging.PayloadLogger(logger=logger)
+    try:
+      body = '{"events": [{"type": "%s"' % events.BLIP_SUBMITTED
+      self.assertEqual(500, self.Post(body).status_int)
+    finally:
+      logger.removeHandler(handler)
+    self.assertEqual(['Incoming: ' + body], handler.messages)
+
+
+class TestStatsHandler(StubTestCase):
+
+  def setUp(self):
+    StubTestCase.setUp(self)
+    os.environ['USER_IS_ADMIN'] = '1'
+    self.robot = robot.Robot('Testy')
+    self.robot.EnableProfiling()
+    self.robot.RecordProfile(self.robot.StartProfile())
+    self.app = self.robot.CreateApplication()
+
+  def tearDown(self):
+    del os.environ['USER_IS_ADMIN']
+
+  def Request(self, path, method='GET'):
+    request = webapp.Request.blank(path)
+    request.method = method
+    return request.get_response(self.app)
+
+  def Requests(self):
+    return self.robot.profiler.GetStats()['requests']
+
+  def testGet(self):
+    response = self.Request('/_wave/robot/stats?reset=1')
+    self.assertEqual(200, response.status_int)
+    self.assertEqual('application/json', response.headers['Content-Type'])
+    self.assertEqual(1, simplejson.loads(response.body)['requests'])
+    self.assertEqual(1, self.Requests())
+
+  def testPostResets(self):
+    response = self.Request('/_wave/robot/stats', 'POST')
+    self.assertEqual(200, response.status_int)
+    self.assertEqual(1, simplejson.loads(response.body)['requests'])
+    self.assertEqual(0, self.Requests())
+
+  def testAdminsOnly(self):
+    os.environ['USER_IS_ADMIN'] = '0'
+    for method in ('GET', 'POST'):
+      response = self.Request('/_wave/robot/stats', method)
+      self.assertEqual(403, response.status_int)
+      self.assertFalse('requests' in response.body)
+    self.assertEqual(1, self.Requests())
+
+
+class TestCronWorkQueue(StubTestCase):
+
+  def setUp(self):
+    StubTestCase.setUp(self)
+    self.processed = []
+    self.results = {}
+
+  def Process(self, context, item):
+    """Returns or raises the result set for the wavelet of an item."""
+    self.processed.append(item.wavelet_id)
+    result = self.results.get(item.wavelet_id, True)
+    if isinstance(result, Exception):
+      raise result
+    return result
+
+  def RunSlice(self, queue):
+    context = ops.CreateEmptyContext()
+    done = queue.RunSlice(context)
+    robot.FlushDeferredWork(context)
+    return done
+
+  def Pending(self):
+    return sorted([item.wavelet_id for item in robot.WorkItem.all()])
+
+  def testEnqueue(self):
+    queue = robot.CronWorkQueue('test', self.Process)
+    self.assertTrue(queue.Enqueue('wave', 'a', payload='data'))
+    self.assertTrue(queue.Enqueue('wave', 'a'))
+    self.assertEqual(['a'], self.Pending())
+    item = robot.WorkItem.all().get()
+    self.assertEqual('wave', item.wave_id)
+    self.assertEqual('data', item.payload)
+    self.assertEqual(1, queue.GetStats()['enqueued'])
+
+  def testEnqueueDeferred(self):
+    queue = robot.CronWorkQueue('test', self.Process)
+    context = ops.CreateEmptyContext()
+    self.assertTrue(queue.Enqueue('wave', 'a', context=context))
+    self.assertEqual([], self.Pending())
+    robot.FlushDeferredWork(context)
+    self.assertEqual(['a'], self.Pending())
+    self.assertEqual(1, queue.GetStats()['enqueued'])
+
+  def testMaxPending(self):
+    queue = robot.CronWorkQueue('test', self.Process, max_pending=2)
+    self.assertTrue(queue.Enqueue('wave', 'a'))
+    self.assertTrue(queue.Enqueue('wave', 'b'))
+    self.assertFalse(queue.Enqueue('wave', 'c'))
+    # Work that is pending already is accepted when the queue is full.
+    self.assertTrue(queue.Enqueue('wave', 'a'))
+    self.assertEqual(['a', 'b'], self.Pending())
+    stats = queue.GetStats()
+    self.assertEqual(2, stats['enqueued'])
+    self.assertEqual(1, stats['rejected'])
+    self.assertEqual(2, stats['pending'])
+
+    # Other queues have their own limit.
+    other = robot.CronWorkQueue('other', self.Process, max_pending=2)
+    self.assertTrue(other.Enqueue('wave', 'c'))
+
+    self.RunSlice(queue)
+    self.assertTrue(queue.Enqueue('wave', 'c'))
+
+  def testFinishedItemsDeleted(self):
+    queue = robot.CronWorkQueue('test', self.Process)
+    queue.Enqueue('wave', 'a')
+    queue.Enqueue('wave', 'b')
+    self.assertEqual(2, self.RunSlice(queue))
+    self.assertEqual(['a', 'b'], sorted(self.processed))
+    self.assertEqual([], self.Pending())
+    stats = queue.GetStats()
+    self.assertEqual(2, stats['processed'])
+    self.assertEqual(1, stats['ticks'])
+    self.assertEqual(0, stats['pending'])
+
+  def testSliceSize(self):
+    queue = robot.CronWorkQueue('test', self.Process, slice_size=2)
+    for wavelet_id in 'abc':
+      queue.Enqueue('wave', wavelet_id)
+    self.assertEqual(2, self.RunSlice(queue))
+    self.assertEqual(1, len(self.Pending()))
+    self.assertEqual(1, self.RunSlice(queue))
+    self.assertEqual([], self.Pending())
+    self.assertEqual(['a', 'b', 'c'], sorted(self.processed))
+
+  def testUnfinishedItemsRequeued(self):
+    queue = robot.CronWorkQueue('test', self.Process, max_attempts=2)
+    self.results['a'] = False
+    queue.Enqueue('wave', 'a')
+    for unused_tick in range(3):
+      self.assertEqual(0, self.RunSlice(queue))
+    # Unfinished items are not failed attempts.
+    self.assertEqual(['a'], self.Pending())
+    self.assertEqual(0, robot.WorkItem.all().get().attempts)
+    self.assertEqual(3, queue.GetStats()['requeued'])
+
+    self.results['a'] = True
+    self.assertEqual(1, self.RunSlice(queue))
+    self.assertEqual([], self.Pending())
+
+  def testFailingItemsDropped(self):
+    queue = robot.CronWorkQueue('test', self.Process, max_attempts=3)
+    self.results['a'] = ValueError('failed')
+    queue.Enqueue('wave', 'a')
+    queue.Enqueue('wave', 'b')
+    self.RunSlice(queue)
+    self.assertEqual(['a'], self.Pending())
+    self.RunSlice(queue)
+    self.assertEqual(2, robot.WorkItem.all().get().attempts)
+    self.RunSlice(queue)
+    self.assertEqual([], self.Pending())
+    self.assertEqual(['a', 'b', 'a', 'a'], self.processed)
+    self.RunSlice(queue)
+    self.assertEqual(4, len(self.processed))
+
+    stats = queue.GetStats()
+    self.assertEqual(1, stats['processed'])
+    self.assertEqual(2, stats['requeued'])
+    self.assertEqual(1, stats['failed'])
+    self.assertEqual(4, stats['ticks'])
+
+
+class TestCronHandler(StubTestCase):
+
+  def setUp(self):
+    StubTestCase.setUp(self)
+    self.robot = robot.Robot('Testy')
+
+  def Tick(self, context):
+    context.builder.WaveletAddParticipant('wave', 'wavelet', 'a@b.com')
+    context.DeferPut(Note(text='tick'))
+
+  def testTick(self):
+    self.robot.RegisterCronJob('/_wave/robot/tick', 10, self.Tick)
+    app = self.robot.CreateApplication()
+    response = webapp.Request.blank('/_wave/robot/tick').get_response(app)
+    self.assertEqual(200, response.status_int)
+    self.assertEqual('application/json', response.headers['Content-Type'])
+    self.assertTrue('a@b.com' in response.body)
+    self.assertEqual(1, Note.all().count())
+
+  def testFailingTick(self):
+    def FailingTick(context):
+      raise ValueError('failed')
+    self.robot.RegisterCronJob('/_wave/robot/tick', 10, FailingTick)
+    app = self.robot.CreateApplication()
+    response = webapp.Request.blank('/_wave/robot/tick').get_response(app)
+    self.assertEqual(200, response.status_int)
+    self.assertTrue('operations' in response.body)
+
+  def testCronJobWithoutHandler(self):
+    self.robot.RegisterCronJob('/_wave/robot/tick', 10)
+    app = self.robot.CreateApplication()
+    response = webapp.Request.blank('/_wave/robot/tick').get_response(app)
+    self.assertEqual(404, response.status_int)
+
+
+if __name__ == '__main__':
+  unittest.main()
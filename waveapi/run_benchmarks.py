@@ -0,0 +1,33 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc. All Rights Reserved.
+
+"""Script to run all benchmarks in this package."""
+
+
+import datastore_benchmark
+import document_benchmark
+import json_benchmark
+import model_benchmark
+import robot_benchmark
+import serialize_benchmark
+
+
+def RunBenchmarks():
+  """Runs all registered benchmarks."""
+  modules = [
+      datastore_benchmark,
+      document_benchmark,
+      json_benchmark,
+      model_benchmark,
+      robot_benchmark,
+      serialize_benchmark,
+  ]
+  for module in modules:
+    print '%s:' % module.__name__
+    module.RunBenchmarks()
+    print
+
+
+if __name__ == "__main__":
+  RunBenchmarks()
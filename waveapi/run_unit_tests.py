@@ -5,11 +5,16 @@
 """Script to run all unit tests in this package."""
 
 
+import datastore_file_stub_test
 import document_test
 import model_test
 import module_test_runner
 import ops_test
+import payload_logging_test
+import profiling_test
 import robot_abstract_test
+import robot_test
+import simplejson_test
 import util_test
 
 
@@ -17,10 +22,15 @@ def RunUnitTests():
   """Runs all registered unit tests."""
   test_runner = module_test_runner.ModuleTestRunner()
   test_runner.modules = [
+      datastore_file_stub_test,
       document_test,
       model_test,
       ops_test,
+      payload_logging_test,
+      profiling_test,
       robot_abstract_test,
+      robot_test,
+      simplejson_test,
       util_test,
   ]
   test_runner.RunAllTests()
@@ -0,0 +1,95 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc. All Rights Reserved.
+
+"""Benchmarks serializing outgoing operation bundles.
+
+Compares util.Serialize with the reflection based serializer it replaced,
+which called dir() on every instance and camel cased every key on every call,
+and encoding the serialized bundle with simplejson with writing it through
+ops.WriteOperationBundle.
+"""
+
+
+import StringIO
+
+import benchmark
+import document
+import ops
+import simplejson
+import util
+
+
+def _LegacySerialize(obj):
+  """The reflection based serializer, kept as a baseline."""
+  if util.IsInstance(obj):
+    if obj and hasattr(obj, util.CUSTOM_SERIALIZE_METHOD_NAME):
+      method = getattr(obj, util.CUSTOM_SERIALIZE_METHOD_NAME)
+      if callable(method):
+        return method()
+    data = {}
+    for attr_name in dir(obj):
+      if attr_name.startswith('_'):
+        continue
+      attr = getattr(obj, attr_name)
+      if attr is None or callable(attr):
+        continue
+      data[util.ToLowerCamelCase(attr_name)] = _LegacySerialize(attr)
+    return data
+  elif util.IsDict(obj):
+    data = {}
+    for k, v in obj.iteritems():
+      data[util.ToLowerCamelCase(k)] = _LegacySerialize(v)
+    return {'javaClass': 'java.util.HashMap', 'map': data}
+  elif util.IsListOrDict(obj):
+    return {'javaClass': 'java.util.ArrayList',
+            'list': [_LegacySerialize(v) for v in obj]}
+  return obj
+
+
+def MakeOperations(count):
+  """Returns a list of count operations of the kinds robots usually send."""
+  context = ops._ContextImpl()
+  builder = context.builder
+  for i in range(count):
+    kind = i % 4
+    if kind == 0:
+      builder.WaveletAddParticipant('wave', 'wavelet', 'user%d@example.com' % i)
+    elif kind == 1:
+      builder.DocumentInsert('wave', 'wavelet', 'blip', 'text %d' % i, index=i)
+    elif kind == 2:
+      builder.DocumentDelete('wave', 'wavelet', 'blip', i, i + 2)
+    else:
+      builder.DocumentAnnotationSet('wave', 'wavelet', 'blip', i, i + 1,
+                                    'style/fontWeight', 'bold')
+  return context._operations
+
+
+def RunBenchmarks():
+  """Runs the serializer benchmarks and prints the results."""
+  for count in (1000, 10000):
+    operations = MakeOperations(count)
+    assert _LegacySerialize(operations) == util.Serialize(operations)
+    legacy = benchmark.Time(lambda: _LegacySerialize(operations))
+    compiled = benchmark.Time(lambda: util.Serialize(operations))
+    benchmark.Report('reflection serialize %d ops' % count, legacy)
+    benchmark.Report('compiled serialize %d ops' % count, compiled, legacy)
+
+    def Dumps():
+      return simplejson.dumps(util.Serialize(operations))
+
+    def Write():
+      out = StringIO.StringIO()
+      ops.WriteOperationBundle(operations, out)
+      return out.getvalue()
+
+    assert (simplejson.loads(Write())['operations'] ==
+            simplejson.loads(Dumps()))
+    dumps = benchmark.Time(Dumps)
+    benchmark.Report('serialize and dump %d ops' % count, dumps)
+    benchmark.Report('write bundle of %d ops' % count, benchmark.Time(Write),
+                     dumps)
+
+
+if __name__ == '__main__':
+  RunBenchmarks()
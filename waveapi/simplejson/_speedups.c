@@ -0,0 +1,796 @@
+/*
+ * Optional C implementation of the hot paths of simplejson.
+ *
+ * Provides:
+ *   encode_basestring_ascii(s): same as encoder.encode_basestring_ascii.
+ *   encode(o): the JSON of a tree of dicts, lists, tuples, strings, numbers,
+ *       booleans and None, as JSONEncoder().encode(o) writes it.
+ *   scan(s, idx, encoding, object_hook): decodes the JSON value of the str
+ *       s starting at idx, as JSONDecoder.raw_decode does, and returns the
+ *       value and the index where it ends.
+ *
+ * Whenever the input is not one of the common cases handled here, including
+ * malformed JSON, encode and scan raise Fallback, and the caller runs the
+ * pure Python implementation, which raises the appropriate error. This keeps
+ * the behavior, and the error messages, of the Python implementation.
+ *
+ * Built by build_speedups.py. App Engine does not load C extensions, so the
+ * package has to work without this module.
+ */
+
+#include "Python.h"
+
+#if PY_VERSION_HEX < 0x02050000 && !defined(PY_SSIZE_T_MIN)
+typedef int Py_ssize_t;
+#define PY_SSIZE_T_MAX INT_MAX
+#define PY_SSIZE_T_MIN INT_MIN
+#endif
+
+/* Nesting depth past which the Python implementation takes over. */
+#define MAX_DEPTH 512
+
+static PyObject *Fallback;
+
+/* Encoding strings. */
+
+static int
+is_plain(unsigned long c)
+{
+    return c >= ' ' && c <= '~' && c != '\\' && c != '"';
+}
+
+static Py_ssize_t
+escaped_size(unsigned long c)
+{
+    Py_ssize_t size;
+    if (is_plain(c)) {
+        return 1;
+    }
+    switch (c) {
+    case '\\': case '"': case '\b': case '\f': case '\n': case '\r':
+    case '\t':
+        return 2;
+    }
+    /* "\\u%04x" */
+    size = 6;
+    for (c >>= 16; c; c >>= 4) {
+        size++;
+    }
+    return size;
+}
+
+static char *
+write_escaped(char *out, unsigned long c)
+{
+    if (is_plain(c)) {
+        *out++ = (char)c;
+        return out;
+    }
+    *out++ = '\\';
+    switch (c) {
+    case '\\': *out++ = '\\'; return out;
+    case '"': *out++ = '"'; return out;
+    case '\b': *out++ = 'b'; return out;
+    case '\f': *out++ = 'f'; return out;
+    case '\n': *out++ = 'n'; return out;
+    case '\r': *out++ = 'r'; return out;
+    case '\t': *out++ = 't'; return out;
+    }
+    return out + sprintf(out, "u%04lx", c);
+}
+
+static PyObject *
+encode_str(PyObject *pystr)
+{
+    const unsigned char *s = (const unsigned char *)PyString_AS_STRING(pystr);
+    Py_ssize_t len = PyString_GET_SIZE(pystr);
+    Py_ssize_t size = 2;
+    Py_ssize_t i;
+    PyObject *result;
+    char *out;
+
+    for (i = 0; i < len; i++) {
+        size += escaped_size(s[i]);
+    }
+    result = PyString_FromStringAndSize(NULL, size);
+    if (result == NULL) {
+        return NULL;
+    }
+    out = PyString_AS_STRING(result);
+    *out++ = '"';
+    for (i = 0; i < len; i++) {
+        out = write_escaped(out, s[i]);
+    }
+    *out = '"';
+    return result;
+}
+
+static PyObject *
+encode_unicode(PyObject *pystr)
+{
+    const Py_UNICODE *s = PyUnicode_AS_UNICODE(pystr);
+    Py_ssize_t len = PyUnicode_GET_SIZE(pystr);
+    Py_ssize_t size = 2;
+    Py_ssize_t i;
+    PyObject *result;
+    char *out;
+
+    for (i = 0; i < len; i++) {
+        size += escaped_size((unsigned long)s[i]);
+    }
+    result = PyString_FromStringAndSize(NULL, size);
+    if (result == NULL) {
+        return NULL;
+    }
+    out = PyString_AS_STRING(result);
+    *out++ = '"';
+    for (i = 0; i < len; i++) {
+        out = write_escaped(out, (unsigned long)s[i]);
+    }
+    *out = '"';
+    return result;
+}
+
+static PyObject *
+py_encode_basestring_ascii(PyObject *self, PyObject *pystr)
+{
+    if (PyString_Check(pystr)) {
+        return encode_str(pystr);
+    }
+    if (PyUnicode_Check(pystr)) {
+        return encode_unicode(pystr);
+    }
+    PyErr_Format(PyExc_TypeError, "first argument must be a string, not %.80s",
+                 pystr->ob_type->tp_name);
+    return NULL;
+}
+
+/* Encoding trees. */
+
+typedef struct {
+    char *buf;
+    Py_ssize_t len;
+    Py_ssize_t cap;
+} Buffer;
+
+static int
+buffer_write(Buffer *b, const char *s, Py_ssize_t len)
+{
+    if (b->len + len > b->cap) {
+        Py_ssize_t cap = b->cap * 2;
+        char *buf;
+        if (cap < b->len + len) {
+            cap = b->len + len;
+        }
+        buf = (char *)PyMem_Realloc(b->buf, cap);
+        if (buf == NULL) {
+            PyErr_NoMemory();
+            return -1;
+        }
+        b->buf = buf;
+        b->cap = cap;
+    }
+    memcpy(b->buf + b->len, s, len);
+    b->len += len;
+    return 0;
+}
+
+static int
+buffer_write_object(Buffer *b, PyObject *str)
+{
+    int result;
+    if (str == NULL) {
+        return -1;
+    }
+    result = buffer_write(b, PyString_AS_STRING(str), PyString_GET_SIZE(str));
+    Py_DECREF(str);
+    return result;
+}
+
+static int
+encode_string(Buffer *b, PyObject *o)
+{
+    if (PyString_Check(o)) {
+        return buffer_write_object(b, encode_str(o));
+    }
+    return buffer_write_object(b, encode_unicode(o));
+}
+
+static int encode_value(Buffer *b, PyObject *o, int depth);
+
+static int
+encode_list(Buffer *b, PyObject *seq, int depth)
+{
+    Py_ssize_t len = PySequence_Fast_GET_SIZE(seq);
+    PyObject **items = PySequence_Fast_ITEMS(seq);
+    Py_ssize_t i;
+
+    if (len == 0) {
+        return buffer_write(b, "[]", 2);
+    }
+    if (buffer_write(b, "[", 1) < 0) {
+        return -1;
+    }
+    for (i = 0; i < len; i++) {
+        if (i && buffer_write(b, ", ", 2) < 0) {
+            return -1;
+        }
+        if (encode_value(b, items[i], depth + 1) < 0) {
+            return -1;
+        }
+    }
+    return buffer_write(b, "]", 1);
+}
+
+static int
+encode_dict(Buffer *b, PyObject *dct, int depth)
+{
+    Py_ssize_t pos = 0;
+    PyObject *key, *value;
+    int first = 1;
+
+    if (PyDict_Size(dct) == 0) {
+        return buffer_write(b, "{}", 2);
+    }
+    if (buffer_write(b, "{", 1) < 0) {
+        return -1;
+    }
+    while (PyDict_Next(dct, &pos, &key, &value)) {
+        if (!PyString_Check(key) && !PyUnicode_Check(key)) {
+            PyErr_SetString(Fallback, "key is not a string");
+            return -1;
+        }
+        if (!first && buffer_write(b, ", ", 2) < 0) {
+            return -1;
+        }
+        first = 0;
+        if (encode_string(b, key) < 0 || buffer_write(b, ": ", 2) < 0) {
+            return -1;
+        }
+        if (encode_value(b, value, depth + 1) < 0) {
+            return -1;
+        }
+    }
+    return buffer_write(b, "}", 1);
+}
+
+static int
+encode_value(Buffer *b, PyObject *o, int depth)
+{
+    if (depth > MAX_DEPTH) {
+        /* Possibly circular, which the Python implementation reports. */
+        PyErr_SetString(Fallback, "nested too deeply");
+        return -1;
+    }
+    if (PyString_Check(o) || PyUnicode_Check(o)) {
+        return encode_string(b, o);
+    }
+    if (o == Py_None) {
+        return buffer_write(b, "null", 4);
+    }
+    if (o == Py_True) {
+        return buffer_write(b, "true", 4);
+    }
+    if (o == Py_False) {
+        return buffer_write(b, "false", 5);
+    }
+    if (PyInt_CheckExact(o) || PyLong_CheckExact(o)) {
+        return buffer_write_object(b, PyObject_Str(o));
+    }
+    if (PyFloat_CheckExact(o)) {
+        double d = PyFloat_AS_DOUBLE(o);
+        if (d != d || d - d != 0.0) {
+            PyErr_SetString(Fallback, "float is not finite");
+            return -1;
+        }
+        /* floatstr does not encode -0.0 as str() does; leave it to Python. */
+        if (d == 0.0 && copysign(1.0, d) < 0.0) {
+            PyErr_SetString(Fallback, "negative zero");
+            return -1;
+        }
+        return buffer_write_object(b, PyObject_Str(o));
+    }
+    if (PyList_CheckExact(o) || PyTuple_CheckExact(o)) {
+        int result;
+        PyObject *seq = PySequence_Fast(o, "not a sequence");
+        if (seq == NULL) {
+            return -1;
+        }
+        result = encode_list(b, seq, depth);
+        Py_DECREF(seq);
+        return result;
+    }
+    if (PyDict_CheckExact(o)) {
+        return encode_dict(b, o, depth);
+    }
+    PyErr_SetString(Fallback, "unsupported type");
+    return -1;
+}
+
+static PyObject *
+py_encode(PyObject *self, PyObject *o)
+{
+    Buffer b;
+    PyObject *result = NULL;
+
+    b.len = 0;
+    b.cap = 4096;
+    b.buf = (char *)PyMem_Malloc(b.cap);
+    if (b.buf == NULL) {
+        return PyErr_NoMemory();
+    }
+    if (encode_value(&b, o, 0) == 0) {
+        result = PyString_FromStringAndSize(b.buf, b.len);
+    }
+    PyMem_Free(b.buf);
+    return result;
+}
+
+/* Decoding. */
+
+typedef struct {
+    const char *s;
+    Py_ssize_t len;
+    const char *encoding;
+    PyObject *object_hook;
+    int depth;
+} Scanner;
+
+static PyObject *scan_once(Scanner *sc, Py_ssize_t idx, Py_ssize_t *next);
+
+static PyObject *
+fallback(Py_ssize_t idx)
+{
+    PyErr_Format(Fallback, "invalid JSON at %ld", (long)idx);
+    return NULL;
+}
+
+static Py_ssize_t
+skip_whitespace(Scanner *sc, Py_ssize_t idx)
+{
+    /* The characters matched by \s without the unicode flag. */
+    while (idx < sc->len) {
+        switch (sc->s[idx]) {
+        case ' ': case '\t': case '\n': case '\r': case '\f': case '\v':
+            idx++;
+            continue;
+        }
+        break;
+    }
+    return idx;
+}
+
+static int
+hex_value(char c)
+{
+    if (c >= '0' && c <= '9') {
+        return c - '0';
+    }
+    if (c >= 'a' && c <= 'f') {
+        return c - 'a' + 10;
+    }
+    if (c >= 'A' && c <= 'F') {
+        return c - 'A' + 10;
+    }
+    return -1;
+}
+
+static int
+append_chunk(PyObject **chunks, PyObject **first, PyObject *chunk)
+{
+    int result;
+    if (chunk == NULL) {
+        return -1;
+    }
+    if (*first == NULL && *chunks == NULL) {
+        *first = chunk;
+        return 0;
+    }
+    if (*chunks == NULL) {
+        *chunks = PyList_New(0);
+        if (*chunks == NULL || PyList_Append(*chunks, *first) < 0) {
+            Py_DECREF(chunk);
+            return -1;
+        }
+        Py_CLEAR(*first);
+    }
+    result = PyList_Append(*chunks, chunk);
+    Py_DECREF(chunk);
+    return result;
+}
+
+static PyObject *
+scan_string(Scanner *sc, Py_ssize_t idx, Py_ssize_t *next)
+{
+    const char *s = sc->s;
+    Py_ssize_t begin_string = idx - 1;
+    PyObject *chunks = NULL;
+    PyObject *first = NULL;
+    PyObject *result = NULL;
+
+    for (;;) {
+        Py_ssize_t begin = idx;
+        Py_UNICODE c;
+
+        while (idx < sc->len && s[idx] != '"' && s[idx] != '\\') {
+            idx++;
+        }
+        if (idx >= sc->len) {
+            fallback(begin_string);
+            goto error;
+        }
+        if (idx > begin) {
+            if (append_chunk(&chunks, &first,
+                             PyUnicode_Decode(s + begin, idx - begin,
+                                              sc->encoding, NULL)) < 0) {
+                goto error;
+            }
+        }
+        if (s[idx] == '"') {
+            idx++;
+            break;
+        }
+        idx++;
+        if (idx >= sc->len) {
+            fallback(begin_string);
+            goto error;
+        }
+        switch (s[idx]) {
+        case '"': c = '"'; break;
+        case '\\': c = '\\'; break;
+        case '/': c = '/'; break;
+        case 'b': c = '\b'; break;
+        case 'f': c = '\f'; break;
+        case 'n': c = '\n'; break;
+        case 'r': c = '\r'; break;
+        case 't': c = '\t'; break;
+        case 'u': {
+            int i, digit;
+            if (idx + 4 >= sc->len) {
+                fallback(idx);
+                goto error;
+            }
+            c = 0;
+            for (i = 1; i <= 4; i++) {
+                digit = hex_value(s[idx + i]);
+                if (digit < 0) {
+                    fallback(idx);
+                    goto error;
+                }
+                c = (c << 4) | digit;
+            }
+            idx += 4;
+            break;
+        }
+        default:
+            fallback(idx);
+            goto error;
+        }
+        idx++;
+        if (append_chunk(&chunks, &first, PyUnicode_FromUnicode(&c, 1)) < 0) {
+            goto error;
+        }
+    }
+
+    if (chunks != NULL) {
+        PyObject *empty = PyUnicode_FromUnicode(NULL, 0);
+        if (empty != NULL) {
+            result = PyUnicode_Join(empty, chunks);
+            Py_DECREF(empty);
+        }
+    } else if (first != NULL) {
+        result = first;
+        first = NULL;
+    } else {
+        result = PyUnicode_FromUnicode(NULL, 0);
+    }
+    *next = idx;
+
+error:
+    Py_XDECREF(chunks);
+    Py_XDECREF(first);
+    return result;
+}
+
+static PyObject *
+scan_object(Scanner *sc, Py_ssize_t idx, Py_ssize_t *next)
+{
+    const char *s = sc->s;
+    PyObject *pairs = PyDict_New();
+    PyObject *key = NULL, *value = NULL;
+    PyObject *result;
+
+    if (pairs == NULL) {
+        return NULL;
+    }
+    idx = skip_whitespace(sc, idx + 1);
+    if (idx < sc->len && s[idx] == '}') {
+        /* Like the Python implementation, no object hook for {}. */
+        *next = idx + 1;
+        return pairs;
+    }
+    if (idx >= sc->len || s[idx] != '"') {
+        fallback(idx);
+        goto error;
+    }
+    idx++;
+    for (;;) {
+        char c;
+        key = scan_string(sc, idx, &idx);
+        if (key == NULL) {
+            goto error;
+        }
+        idx = skip_whitespace(sc, idx);
+        if (idx >= sc->len || s[idx] != ':') {
+            fallback(idx);
+            goto error;
+        }
+        idx = skip_whitespace(sc, idx + 1);
+        value = scan_once(sc, idx, &idx);
+        if (value == NULL || PyDict_SetItem(pairs, key, value) < 0) {
+            goto error;
+        }
+        Py_CLEAR(key);
+        Py_CLEAR(value);
+        idx = skip_whitespace(sc, idx);
+        c = idx < sc->len ? s[idx] : '\0';
+        idx++;
+        if (c == '}') {
+            break;
+        }
+        if (c != ',') {
+            fallback(idx - 1);
+            goto error;
+        }
+        idx = skip_whitespace(sc, idx);
+        c = idx < sc->len ? s[idx] : '\0';
+        idx++;
+        if (c != '"') {
+            fallback(idx - 1);
+            goto error;
+        }
+    }
+    *next = idx;
+    if (sc->object_hook == Py_None) {
+        return pairs;
+    }
+    result = PyObject_CallFunctionObjArgs(sc->object_hook, pairs, NULL);
+    Py_DECREF(pairs);
+    return result;
+
+error:
+    Py_XDECREF(key);
+    Py_XDECREF(value);
+    Py_DECREF(pairs);
+    return NULL;
+}
+
+static PyObject *
+scan_array(Scanner *sc, Py_ssize_t idx, Py_ssize_t *next)
+{
+    const char *s = sc->s;
+    PyObject *values = PyList_New(0);
+    PyObject *value;
+
+    if (values == NULL) {
+        return NULL;
+    }
+    idx = skip_whitespace(sc, idx + 1);
+    if (idx < sc->len && s[idx] == ']') {
+        *next = idx + 1;
+        return values;
+    }
+    for (;;) {
+        char c;
+        value = scan_once(sc, idx, &idx);
+        if (value == NULL) {
+            goto error;
+        }
+        if (PyList_Append(values, value) < 0) {
+            Py_DECREF(value);
+            goto error;
+        }
+        Py_DECREF(value);
+        idx = skip_whitespace(sc, idx);
+        c = idx < sc->len ? s[idx] : '\0';
+        idx++;
+        if (c == ']') {
+            break;
+        }
+        if (c != ',') {
+            fallback(idx - 1);
+            goto error;
+        }
+        idx = skip_whitespace(sc, idx);
+    }
+    *next = idx;
+    return values;
+
+error:
+    Py_DECREF(values);
+    return NULL;
+}
+
+static int
+is_digit(Scanner *sc, Py_ssize_t idx)
+{
+    return idx < sc->len && sc->s[idx] >= '0' && sc->s[idx] <= '9';
+}
+
+static PyObject *
+scan_number(Scanner *sc, Py_ssize_t idx, Py_ssize_t *next)
+{
+    const char *s = sc->s;
+    Py_ssize_t start = idx;
+    int is_float = 0;
+    PyObject *text, *result;
+
+    if (s[idx] == '-') {
+        idx++;
+    }
+    if (idx < sc->len && s[idx] == '0') {
+        idx++;
+    } else if (is_digit(sc, idx)) {
+        while (is_digit(sc, idx)) {
+            idx++;
+        }
+    } else {
+        return fallback(start);
+    }
+    if (idx < sc->len && s[idx] == '.' && is_digit(sc, idx + 1)) {
+        idx += 2;
+        while (is_digit(sc, idx)) {
+            idx++;
+        }
+        is_float = 1;
+    }
+    if (idx < sc->len && (s[idx] == 'e' || s[idx] == 'E')) {
+        Py_ssize_t end = idx + 1;
+        if (end < sc->len && (s[end] == '+' || s[end] == '-')) {
+            end++;
+        }
+        if (is_digit(sc, end)) {
+            while (is_digit(sc, end)) {
+                end++;
+            }
+            idx = end;
+            is_float = 1;
+        }
+    }
+    text = PyString_FromStringAndSize(s + start, idx - start);
+    if (text == NULL) {
+        return NULL;
+    }
+    if (is_float) {
+        result = PyFloat_FromString(text, NULL);
+    } else {
+        result = PyInt_FromString(PyString_AS_STRING(text), NULL, 10);
+    }
+    Py_DECREF(text);
+    *next = idx;
+    return result;
+}
+
+static int
+match_word(Scanner *sc, Py_ssize_t idx, const char *word, Py_ssize_t len)
+{
+    return idx + len <= sc->len && strncmp(sc->s + idx, word, len) == 0;
+}
+
+static PyObject *
+scan_once(Scanner *sc, Py_ssize_t idx, Py_ssize_t *next)
+{
+    PyObject *result;
+
+    if (idx >= sc->len) {
+        return fallback(idx);
+    }
+    switch (sc->s[idx]) {
+    case '"':
+        return scan_string(sc, idx + 1, next);
+    case '{':
+    case '[':
+        if (++sc->depth > MAX_DEPTH) {
+            return fallback(idx);
+        }
+        if (sc->s[idx] == '{') {
+            result = scan_object(sc, idx, next);
+        } else {
+            result = scan_array(sc, idx, next);
+        }
+        sc->depth--;
+        return result;
+    case 'n':
+        if (match_word(sc, idx, "null", 4)) {
+            *next = idx + 4;
+            Py_INCREF(Py_None);
+            return Py_None;
+        }
+        break;
+    case 't':
+        if (match_word(sc, idx, "true", 4)) {
+            *next = idx + 4;
+            Py_INCREF(Py_True);
+            return Py_True;
+        }
+        break;
+    case 'f':
+        if (match_word(sc, idx, "false", 5)) {
+            *next = idx + 5;
+            Py_INCREF(Py_False);
+            return Py_False;
+        }
+        break;
+    case '-':
+        /* -Infinity is left to the Python implementation, like NaN. */
+        if (match_word(sc, idx, "-Infinity", 9)) {
+            break;
+        }
+        return scan_number(sc, idx, next);
+    default:
+        if (sc->s[idx] >= '0' && sc->s[idx] <= '9') {
+            return scan_number(sc, idx, next);
+        }
+    }
+    return fallback(idx);
+}
+
+static PyObject *
+py_scan(PyObject *self, PyObject *args)
+{
+    Scanner sc;
+    PyObject *pystr, *encoding, *result;
+    Py_ssize_t idx, next;
+    long start;
+
+    if (!PyArg_ParseTuple(args, "SlOO:scan", &pystr, &start, &encoding,
+                          &sc.object_hook)) {
+        return NULL;
+    }
+    if (encoding == Py_None) {
+        sc.encoding = "utf-8";
+    } else if (PyString_Check(encoding)) {
+        sc.encoding = PyString_AS_STRING(encoding);
+    } else {
+        PyErr_SetString(Fallback, "encoding is not a str");
+        return NULL;
+    }
+    sc.s = PyString_AS_STRING(pystr);
+    sc.len = PyString_GET_SIZE(pystr);
+    sc.depth = 0;
+    idx = (Py_ssize_t)start;
+    if (idx < 0 || idx > sc.len) {
+        return fallback(idx);
+    }
+    result = scan_once(&sc, idx, &next);
+    if (result == NULL) {
+        return NULL;
+    }
+    return Py_BuildValue("(Nl)", result, (long)next);
+}
+
+static PyMethodDef speedups_methods[] = {
+    {"encode_basestring_ascii", (PyCFunction)py_encode_basestring_ascii,
+     METH_O, "Return a JSON representation of a Python string."},
+    {"encode", (PyCFunction)py_encode, METH_O,
+     "Return the JSON representation of a tree of basic Python values."},
+    {"scan", (PyCFunction)py_scan, METH_VARARGS,
+     "Decode the JSON value of a str at an index, return it and its end."},
+    {NULL, NULL, 0, NULL}
+};
+
+PyMODINIT_FUNC
+init_speedups(void)
+{
+    PyObject *m = Py_InitModule3("_speedups", speedups_methods,
+                                 "C implementation of simplejson hot paths.");
+    if (m == NULL) {
+        return;
+    }
+    Fallback = PyErr_NewException("_speedups.Fallback", NULL, NULL);
+    if (Fallback == NULL) {
+        return;
+    }
+    Py_INCREF(Fallback);
+    PyModule_AddObject(m, "Fallback", Fallback);
+}
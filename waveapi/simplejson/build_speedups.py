@@ -0,0 +1,53 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc. All Rights Reserved.
+
+"""Builds the optional _speedups extension of simplejson in place.
+
+Run it with the Python that serves the robot:
+
+  python build_speedups.py
+
+simplejson uses the extension when it can import it, and its pure Python
+implementation otherwise. If no compiler is available, the build is skipped
+and this exits cleanly. App Engine does not load C extensions, so this only
+speeds up local servers, tests and benchmarks.
+"""
+
+
+import os
+import shutil
+import sys
+import tempfile
+
+from distutils.core import Extension
+from distutils.core import setup
+from distutils.errors import CCompilerError
+from distutils.errors import DistutilsError
+
+
+def BuildSpeedups():
+  """Builds _speedups next to this file.
+
+  Returns:
+    True if the extension was built.
+  """
+  directory = os.path.dirname(os.path.abspath(__file__))
+  build_temp = tempfile.mkdtemp()
+  os.chdir(directory)
+  try:
+    try:
+      setup(name='simplejson_speedups',
+            ext_modules=[Extension('_speedups', ['_speedups.c'])],
+            script_args=['--quiet', 'build_ext', '--inplace',
+                         '--build-temp', build_temp])
+    except (CCompilerError, DistutilsError, SystemExit), e:
+      print >>sys.stderr, 'Not building the simplejson speedups: %s' % e
+      return False
+  finally:
+    shutil.rmtree(build_temp, ignore_errors=True)
+  return True
+
+
+if __name__ == '__main__':
+  BuildSpeedups()
@@ -5,6 +5,12 @@ import re
 
 from scanner import Scanner, pattern
 
+# The optional C scanner, see build_speedups.py.
+try:
+    from _speedups import scan as c_scan, Fallback as c_Fallback
+except ImportError:
+    c_scan = None
+
 FLAGS = re.VERBOSE | re.MULTILINE | re.DOTALL
 
 def _floatconstants():
@@ -140,7 +146,7 @@ def JSONObject(match, context, _w=WHITESPACE.match):
             raise ValueError(errmsg("Expecting : delimiter", s, end))
         end = _w(s, end + 1).end()
         try:
-            value, end = JSONScanner.iterscan(s, idx=end).next()
+            value, end = JSONScanner.iterscan(s, idx=end, context=context).next()
         except StopIteration:
             raise ValueError(errmsg("Expecting object", s, end))
         pairs[key] = value
@@ -172,7 +178,7 @@ def JSONArray(match, context, _w=WHITESPACE.match):
         return values, end + 1
     while True:
         try:
-            value, end = JSONScanner.iterscan(s, idx=end).next()
+            value, end = JSONScanner.iterscan(s, idx=end, context=context).next()
         except StopIteration:
             raise ValueError(errmsg("Expecting object", s, end))
         values.append(value)
@@ -267,6 +273,14 @@ class JSONDecoder(object):
         This can be used to decode a JSON document from a string that may
         have extraneous data at the end.
         """
+        if (c_scan is not None and isinstance(s, str) and
+                'context' not in kw):
+            try:
+                return c_scan(s, kw.get('idx', 0), self.encoding,
+                              self.object_hook)
+            except c_Fallback:
+                # Let the Python scanner decode it or report the error.
+                pass
         kw.setdefault('context', self)
         try:
             obj, end = self._scanner.iterscan(s, **kw).next()
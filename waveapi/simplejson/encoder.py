@@ -54,7 +54,7 @@ def encode_basestring(s):
         return ESCAPE_DCT[match.group(0)]
     return '"' + ESCAPE.sub(replace, s) + '"'
 
-def encode_basestring_ascii(s):
+def py_encode_basestring_ascii(s):
     def replace(match):
         s = match.group(0)
         try:
@@ -62,6 +62,17 @@ def encode_basestring_ascii(s):
         except KeyError:
             return '\\u%04x' % (ord(s),)
     return '"' + str(ESCAPE_ASCII.sub(replace, s)) + '"'
+
+# The optional C encoder, see build_speedups.py.
+try:
+    from _speedups import encode_basestring_ascii as \
+        c_encode_basestring_ascii, encode as c_encode, Fallback as c_Fallback
+except ImportError:
+    c_encode_basestring_ascii = None
+    c_encode = None
+
+encode_basestring_ascii = (c_encode_basestring_ascii or
+                           py_encode_basestring_ascii)
         
 
 class JSONEncoder(object):
@@ -276,6 +287,13 @@ class JSONEncoder(object):
         >>> JSONEncoder().encode({"foo": ["bar", "baz"]})
         '{"foo":["bar", "baz"]}'
         """
+        if (c_encode is not None and self.__class__ is JSONEncoder and
+                self.ensure_ascii and not self.sort_keys and self.allow_nan):
+            try:
+                return c_encode(o)
+            except c_Fallback:
+                # Let the Python encoder encode it or report the error.
+                pass
         # This doesn't pass the iterator directly to ''.join() because it
         # sucks at reporting exceptions.  It's going to do this internally
         # anyway because it uses PySequence_Fast or similar.
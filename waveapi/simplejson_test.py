@@ -0,0 +1,75 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2009 Google Inc. All Rights Reserved.
+
+"""Unit tests for the C speedups of the vendored simplejson.
+
+Every case is encoded or decoded with and without the speedups, and the
+results must be identical. Without a built _speedups module, both runs use
+the pure Python implementation.
+"""
+
+
+import unittest
+
+import json_benchmark
+import simplejson
+
+ENCODE_CASES = [
+    None, True, False, 0, -1, 2 ** 70, -2 ** 70,
+    0.0, -0.0, 1.5, -1.5, 1e300, -1e-300, 0.1,
+    float('inf'), float('-inf'), float('nan'),
+    '', 'plain', 'quote " backslash \\ slash /', '\x00\x1f\x7f',
+    u'caf\xe9', u'\u2028 \U0001d11e', 'caf\xc3\xa9',
+    [], (), {}, [1, [2, [3, []]]], (1, 'two', 3.0),
+    {'a': 1, 'b': [True, None], 'c': {'d': -0.0}},
+    {1: 'int key', 2.5: 'float key', True: 'bool key', None: 'null key'},
+    {u'\xe9': [0.0, -0.0, float('nan')]},
+]
+
+DECODE_CASES = [
+    'null', 'true', 'false', '0', '-0', '-0.0', '1.5e3',
+    '123456789012345678901',
+    '"plain"', '"esc \\" \\\\ \\/ \\b \\f \\n \\r \\t \\u00e9 \\ud834\\udd1e"',
+    '[]', '{}', ' [1, {"a": [2, 3.5]}, "x"] ', '{"a": {"b": {"c": null}}}',
+    'NaN', 'Infinity', '-Infinity', '[NaN, -Infinity]',
+]
+
+DECODE_ERRORS = ['', '[', '{"a" 1}', '[1,]', '"unterminated', 'nul', '1 2']
+
+
+def Call(function, *args):
+  """Returns the result of a call, or the type and message of its error."""
+  try:
+    return function(*args)
+  except ValueError, e:
+    return (e.__class__, str(e))
+
+
+class TestSpeedups(unittest.TestCase):
+
+  def assertSameResults(self, function, value):
+    expected = json_benchmark.PurePython(lambda: Call(function, value))()
+    actual = Call(function, value)
+    # NaN is not equal to itself, so results are compared by repr.
+    self.assertEqual(repr(expected), repr(actual), repr(value))
+
+  def testEncode(self):
+    for value in ENCODE_CASES:
+      self.assertSameResults(simplejson.dumps, value)
+
+  def testEncodeNegativeZero(self):
+    self.assertEqual('[NaN]', simplejson.dumps([-0.0]))
+    self.assertEqual('[0.0]', simplejson.dumps([0.0]))
+
+  def testDecode(self):
+    for text in DECODE_CASES:
+      self.assertSameResults(simplejson.loads, text)
+
+  def testDecodeErrors(self):
+    for text in DECODE_ERRORS:
+      self.assertSameResults(simplejson.loads, text)
+
+
+if __name__ == '__main__':
+  unittest.main()
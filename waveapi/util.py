@@ -15,6 +15,9 @@ import document
 
 CUSTOM_SERIALIZE_METHOD_NAME = 'Serialize'
 
+# Types that are serialized as themselves.
+_PRIMITIVE_TYPES = (basestring, bool, int, long, float)
+
 
 def IsListOrDict(inst):
   """Returns whether or not this is a list, tuple, set or dict ."""
@@ -70,6 +73,28 @@ def CollapseJavaCollections(data):
   return data
 
 
+def CollapseJavaCollectionsHook(data):
+  """Object hook that collapses the Java collections while decoding JSON.
+
+  The decoder invokes this bottom-up on every decoded object, so any nested
+  values have already been collapsed by the time their parent is seen. This
+  does in a single pass what CollapseJavaCollections does on a decoded tree.
+
+  Args:
+    data: A freshly decoded dict.
+
+  Returns:
+    The collapsed map or list for Java collections, otherwise the dict with
+    its java class field removed.
+  """
+  java_class = data.pop('javaClass', None)
+  if java_class == 'java.util.HashMap':
+    return data['map']
+  elif java_class == 'java.util.ArrayList':
+    return data['list']
+  return data
+
+
 def ToLowerCamelCase(s):
   """Converts a string to lower camel case.
 
@@ -103,11 +128,75 @@ def DefaultKeyWriter(key_name):
   return ToLowerCamelCase(key_name)
 
 
+# Field plans of the classes serialized so far, keyed by class.
+_FIELD_PLANS = {}
+
+
+def _CompileFieldPlan(cls):
+  """Compiles the serialization plan of a class.
+
+  The plan lists the public, non-callable class attributes, such as
+  java_class, slots and properties, along with a cache of their default key
+  names. Instance attributes are read from the instance dict and their key
+  names are added to the cache the first time they are seen.
+
+  Args:
+    cls: The class to compile a plan for.
+
+  Returns:
+    A tuple of the class attribute names and a dict of precomputed keys.
+  """
+  class_attrs = []
+  for attr_name in dir(cls):
+    if attr_name.startswith('_'):
+      continue
+    if callable(getattr(cls, attr_name)):
+      continue
+    class_attrs.append(attr_name)
+  keys = dict((attr_name, DefaultKeyWriter(attr_name))
+              for attr_name in class_attrs)
+  plan = (class_attrs, keys)
+  _FIELD_PLANS[cls] = plan
+  return plan
+
+
+def GetPublicAttributes(obj):
+  """Returns the public, non-callable and non-None attributes of an instance.
+
+  This gives the same result as filtering dir(obj), but uses a plan compiled
+  once per class instead of reflecting on every instance.
+
+  Args:
+    obj: The instance to inspect.
+
+  Returns:
+    A list of (name, value) pairs.
+  """
+  class_attrs = _FIELD_PLANS.get(obj.__class__)
+  if class_attrs is None:
+    class_attrs = _CompileFieldPlan(obj.__class__)
+  class_attrs = class_attrs[0]
+  instance_attrs = getattr(obj, '__dict__', None) or {}
+  attrs = []
+  for attr_name in class_attrs:
+    if attr_name in instance_attrs:
+      continue
+    attr = getattr(obj, attr_name, None)
+    if attr is None or callable(attr):
+      continue
+    attrs.append((attr_name, attr))
+  for attr_name, attr in instance_attrs.iteritems():
+    if attr_name.startswith('_') or attr is None or callable(attr):
+      continue
+    attrs.append((attr_name, attr))
+  return attrs
+
+
 def _SerializeAttributes(obj, key_writer=DefaultKeyWriter):
   """Serializes attributes of an instance.
 
-  Iterates all attributes of an object and invokes serialize if they are
-  public and not callable.
+  Serializes all public attributes of an instance that are not callable.
+  Key names produced by the default key writer are computed once per class.
 
   Args:
     obj: The instance to serialize.
@@ -121,16 +210,17 @@ def _SerializeAttributes(obj, key_writer=DefaultKeyWriter):
     The serialized object.
   """
   data = {}
-  for attr_name in dir(obj):
-    if attr_name.startswith('_'):
-      continue
-    attr = getattr(obj, attr_name)
-    if attr is None:
-      continue
-    if callable(attr):
-      continue
-    # Looks okay, serialize it.
-    data[key_writer(attr_name)] = Serialize(attr)
+  attrs = GetPublicAttributes(obj)
+  if key_writer is DefaultKeyWriter:
+    keys = _FIELD_PLANS[obj.__class__][1]
+    for attr_name, attr in attrs:
+      key = keys.get(attr_name)
+      if key is None:
+        key = keys[attr_name] = DefaultKeyWriter(attr_name)
+      data[key] = Serialize(attr)
+  else:
+    for attr_name, attr in attrs:
+      data[key_writer(attr_name)] = Serialize(attr)
   return data
 
 
@@ -184,6 +274,8 @@ def Serialize(obj, key_writer=DefaultKeyWriter):
   Returns:
     The serialized object.
   """
+  if obj is None or isinstance(obj, _PRIMITIVE_TYPES):
+    return obj
   if IsInstance(obj):
     if obj and hasattr(obj, CUSTOM_SERIALIZE_METHOD_NAME):
       method = getattr(obj, CUSTOM_SERIALIZE_METHOD_NAME)
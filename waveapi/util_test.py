@@ -11,6 +11,7 @@ __author__ = 'davidbyttow@google.com (David Byttow)'
 import unittest
 
 import document
+import simplejson
 import util
 
 
@@ -71,6 +72,15 @@ class TestUtils(unittest.TestCase):
     nested = util.CollapseJavaCollections(MakeMap(MakeList(MakeMap())))
     self.assertEquals('value', nested['key'][0]['key'])
 
+  def testCollapseJavaCollectionsHook(self):
+    json = ('{"javaClass": "java.util.HashMap", "map": {"key": '
+            '{"javaClass": "java.util.ArrayList", "list": [1, '
+            '{"javaClass": "com.google.wave.api.Range", "start": 0, "end": 1}'
+            ']}}}')
+    data = simplejson.loads(json,
+                            object_hook=util.CollapseJavaCollectionsHook)
+    self.assertEquals({'key': [1, {'start': 0, 'end': 1}]}, data)
+
   def testToLowerCamelCase(self):
     self.assertEquals('foo', util.ToLowerCamelCase('foo'))
     self.assertEquals('fooBar', util.ToLowerCamelCase('foo_bar'))
@@ -124,6 +134,26 @@ class TestUtils(unittest.TestCase):
     self.assertEquals(Data.java_class, output['javaClass'])
     self.assertEquals(data.public, output['public'])
 
+  def testGetPublicAttributes(self):
+
+    class Data(object):
+      java_class = 'json.org.JSONObject'
+      shadowed = 'class'
+
+      def __init__(self):
+        self.public = 1
+        self.shadowed = None
+        self.unset = None
+        self._protected = 2
+
+    attrs = dict(util.GetPublicAttributes(Data()))
+    self.assertEquals({'java_class': Data.java_class, 'public': 1}, attrs)
+
+    # The compiled plan is reused for instances with other attributes.
+    data = Data()
+    data.extra_field = 'extra'
+    self.assertEquals('extra', util.Serialize(data)['extraField'])
+
   def testClipRange(self):
     def R(x, y):
       return document.Range(x, y)